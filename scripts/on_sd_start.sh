@@ -150,6 +150,20 @@ else
     pip install picklescan || fail "Picklescan installation failed."
 fi
 
+if python -c "import websockets" >/dev/null 2>&1; then
+    echo "Websockets is already installed."
+else
+    echo "Websockets not found, installing."
+    pip install websockets || fail "Websockets installation failed."
+fi
+
+if python -c "import safetensors" >/dev/null 2>&1; then
+    echo "Safetensors is already installed."
+else
+    echo "Safetensors not found, installing."
+    pip install safetensors || fail "Safetensors installation failed."
+fi
+
 
 
 mkdir -p "../models/stable-diffusion"
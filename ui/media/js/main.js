@@ -239,7 +239,7 @@ function showImages(reqBody, res, outputContainer, livePreview) {
     if(typeof res != 'object') return
     res.output.reverse()
     res.output.forEach((result, index) => {
-        const imageData = result?.data || result?.path + '?t=' + Date.now(),
+        const imageData = result?.data || result?.url || result?.path + '?t=' + Date.now(),
             imageSeed = result?.seed,
             imagePrompt = reqBody.prompt,
             imageInferenceSteps = reqBody.num_inference_steps,
@@ -269,6 +269,10 @@ function showImages(reqBody, res, outputContainer, livePreview) {
         }
         const imageElem = imageItemElem.querySelector('img')
         imageElem.src = imageData
+        if (!livePreview && !result?.data && result?.url) {
+            // Buttons and settings reuse img.src as base64 init image data.
+            fetchImageDataURL(result.url).then((dataURL) => imageElem.src = dataURL).catch((e) => console.log(e))
+        }
         imageElem.width = parseInt(imageWidth)
         imageElem.height = parseInt(imageHeight)
         imageElem.setAttribute('data-prompt', imagePrompt)
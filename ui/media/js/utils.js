@@ -347,6 +347,21 @@ function asyncDelay(timeout) {
     })
 }
 
+/* Download an image and return it as a data url, for code that needs base64 image data. */
+async function fetchImageDataURL(url) {
+    const res = await fetch(url)
+    if (!res.ok) {
+        throw new Error(`Could not download ${url}, status: ${res.status}`)
+    }
+    const blob = await res.blob()
+    return new Promise(function(resolve, reject) {
+        const reader = new FileReader()
+        reader.onload = () => resolve(reader.result)
+        reader.onerror = () => reject(reader.error)
+        reader.readAsDataURL(blob)
+    })
+}
+
 function preventNonNumericalInput(e) {
     e = e || window.event;
     let charCode = (typeof e.which == "undefined") ? e.keyCode : e.which;
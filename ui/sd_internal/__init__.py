@@ -25,9 +25,13 @@ class Request:
     use_vae_model: str = None
     show_only_filtered_image: bool = False
     output_format: str = "jpeg" # or "png"
+    inline_output_images: bool = False # Send base64 data in the response instead of only the image url.
 
     stream_progress_updates: bool = False
     stream_image_progress: bool = False
+    image_progress_interval: int = 5 # steps between preview images
+    image_progress_mode: str = "latent" # or "full" to decode previews with the VAE
+    image_progress_scale: float = 0.5 # preview size relative to the output size
 
     def json(self):
         return {
@@ -70,15 +74,57 @@ class Request:
     use_vae_model: {self.use_vae_model}
     show_only_filtered_image: {self.show_only_filtered_image}
     output_format: {self.output_format}
+    inline_output_images: {self.inline_output_images}
 
     stream_progress_updates: {self.stream_progress_updates}
-    stream_image_progress: {self.stream_image_progress}'''
+    stream_image_progress: {self.stream_image_progress}
+    image_progress_interval: {self.image_progress_interval}
+    image_progress_mode: {self.image_progress_mode}
+    image_progress_scale: {self.image_progress_scale}'''
+
+class FilterTaskRequest: # Filters existing images, no Stable Diffusion model is loaded.
+    session_id: str = "session"
+    name: str = "" # Base of the saved file names.
+    init_images: list = None # base64
+    filters: list = None # Model names applied in order, like "GFPGANv1.3" or "RealESRGAN_x4plus".
+    use_full_precision: bool = False
+    save_to_disk_path: str = None
+    output_format: str = "jpeg" # or "png"
+    inline_output_images: bool = False
+    stream_progress_updates: bool = False # Send each image as soon as it is filtered.
+    show_only_filtered_image: bool = True # Only the filtered images are returned.
+
+    @property
+    def num_outputs(self) -> int:
+        return len(self.init_images)
+
+    def json(self):
+        return {
+            "session_id": self.session_id,
+            "name": self.name,
+            "num_outputs": self.num_outputs,
+            "filters": self.filters,
+            "output_format": self.output_format,
+        }
+
+    def __str__(self):
+        return f'''
+    session_id: {self.session_id}
+    name: {self.name}
+    num_outputs: {self.num_outputs}
+    filters: {self.filters}
+    use_full_precision: {self.use_full_precision}
+    save_to_disk_path: {self.save_to_disk_path}
+    output_format: {self.output_format}
+    inline_output_images: {self.inline_output_images}
+    stream_progress_updates: {self.stream_progress_updates}'''
 
 class Image:
-    data: str # base64
+    data: str # base64, None when only served from url.
     seed: int
     is_nsfw: bool
     path_abs: str = None
+    url: str = None
 
     def __init__(self, data, seed):
         self.data = data
@@ -87,6 +133,7 @@ class Image:
     def json(self):
         return {
             "data": self.data,
+            "url": self.url,
             "seed": self.seed,
             "path_abs": self.path_abs,
         }
@@ -94,6 +141,7 @@ class Image:
 class Response:
     request: Request
     images: list
+    timings: dict = None # seconds - Time moving models ("transfer") and in each render stage ("stages").
 
     def json(self):
         res = {
@@ -105,4 +153,7 @@ class Response:
         for image in self.images:
             res["output"].append(image.json())
 
+        if self.timings:
+            res["timings"] = self.timings
+
         return res
@@ -0,0 +1,160 @@
+"""config_store.py: scripts/config.json kept in memory, with write-behind persistence.
+Notes:
+    The parsed config is cached and only read again when the file mtime changes.
+    set_config returns immediately, changes are coalesced and written by a background thread.
+    Unchanged configs are not written, files are replaced atomically.
+"""
+import copy
+import json
+import os
+import threading
+import time
+import traceback
+
+WRITE_DELAY = 0.5 # seconds - Changes made within this delay are written together.
+
+def get_config_bat(config):
+    config_bat = []
+
+    if 'update_branch' in config:
+        config_bat.append(f"@set update_branch={config['update_branch']}")
+
+    config_bat.append(f"@set SD_UI_BIND_PORT={config['net']['listen_port']}")
+    bind_ip = '0.0.0.0' if config['net']['listen_to_network'] else '127.0.0.1'
+    config_bat.append(f"@set SD_UI_BIND_IP={bind_ip}")
+
+    config_bat.append(f"@set test_sd2={'Y' if config.get('test_sd2', False) else 'N'}")
+    return '\r\n'.join(config_bat)
+
+def get_config_sh(config):
+    config_sh = ['#!/bin/bash']
+
+    if 'update_branch' in config:
+        config_sh.append(f"export update_branch={config['update_branch']}")
+
+    config_sh.append(f"export SD_UI_BIND_PORT={config['net']['listen_port']}")
+    bind_ip = '0.0.0.0' if config['net']['listen_to_network'] else '127.0.0.1'
+    config_sh.append(f"export SD_UI_BIND_IP={bind_ip}")
+
+    config_sh.append(f"export test_sd2=\"{'Y' if config.get('test_sd2', False) else 'N'}\"")
+    return '\n'.join(config_sh)
+
+def write_file_atomic(file_path, text):
+    # Skip the write when the file already has this content.
+    try:
+        with open(file_path, 'r', encoding='utf-8', newline='') as f:
+            if f.read() == text:
+                return False
+    except OSError:
+        pass
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        f.write(text)
+    os.replace(tmp_path, file_path)
+    return True
+
+class ConfigStore():
+    def __init__(self, config_dir: str, write_delay: float = WRITE_DELAY):
+        self._config_dir = config_dir
+        self._config_json_path = os.path.join(config_dir, 'config.json')
+        self._write_delay = write_delay
+        self._lock: threading.Lock = threading.Lock()
+        self._write_lock: threading.Lock = threading.Lock()
+        self._write_event = threading.Event()
+        self._writer_thread = None
+        self._config = None # Parsed config.json, None when missing or invalid.
+        self._mtime = None # config.json mtime of the cached config.
+        self._pending = None # Config waiting to be written, newer than the file.
+    def _reload(self) -> None: # Call with self._lock held.
+        try:
+            mtime = os.stat(self._config_json_path).st_mtime
+        except OSError:
+            self._config = None
+            self._mtime = None
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self._config_json_path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        except Exception as e:
+            print(str(e))
+            print(traceback.format_exc())
+            return # Keep the last valid config, file may be in the middle of an edit.
+        if 'net' not in config:
+            config['net'] = {}
+        if os.getenv('SD_UI_BIND_PORT') is not None:
+            config['net']['listen_port'] = int(os.getenv('SD_UI_BIND_PORT'))
+        if os.getenv('SD_UI_BIND_IP') is not None:
+            config['net']['listen_to_network'] = ( os.getenv('SD_UI_BIND_IP') == '0.0.0.0' )
+        self._config = config
+        self._mtime = mtime
+    def get(self, default_val=None):
+        # Returns a copy, callers are free to modify it.
+        with self._lock:
+            if self._pending is None: # The file is up to date.
+                self._reload()
+            config = self._config
+            if config is None:
+                config = default_val
+            return copy.deepcopy(config)
+    def set(self, config) -> None:
+        config = copy.deepcopy(config)
+        with self._lock:
+            if self._pending is None:
+                self._reload()
+            if config == self._config:
+                return # Unchanged, nothing to write.
+            print(json.dumps(config))
+            self._config = config
+            self._pending = config
+            if self._writer_thread is None:
+                self._writer_thread = threading.Thread(target=self._write_loop, name='ConfigStore-Writer', daemon=True)
+                self._writer_thread.start()
+        self._write_event.set()
+    def _write_loop(self) -> None:
+        while True:
+            self._write_event.wait()
+            time.sleep(self._write_delay)
+            self._write_event.clear()
+            self.flush()
+    def flush(self) -> None:
+        # Write the pending config now. Called by the writer thread and on shutdown.
+        with self._write_lock:
+            with self._lock:
+                config = self._pending
+            if config is None:
+                return
+            self._write(config)
+            with self._lock:
+                try:
+                    self._mtime = os.stat(self._config_json_path).st_mtime
+                except OSError:
+                    self._mtime = None
+                if self._pending is config: # Not changed again while writing.
+                    self._pending = None
+    def _write(self, config) -> None:
+        try: # config.json
+            write_file_atomic(self._config_json_path, json.dumps(config))
+        except:
+            print(traceback.format_exc())
+
+        try: # config.bat
+            write_file_atomic(os.path.join(self._config_dir, 'config.bat'), get_config_bat(config))
+        except:
+            print(traceback.format_exc())
+
+        try: # config.sh
+            write_file_atomic(os.path.join(self._config_dir, 'config.sh'), get_config_sh(config))
+        except:
+            print(traceback.format_exc())
+
+SD_UI_DIR = os.getenv('SD_UI_PATH', None)
+CONFIG_DIR = os.path.abspath(os.path.join(SD_UI_DIR or '.', '..', 'scripts'))
+config_store = ConfigStore(CONFIG_DIR)
+
+def get_config(default_val=None):
+    return config_store.get(default_val)
+
+def set_config(config) -> None:
+    config_store.set(config)
@@ -1,11 +1,18 @@
 import os
 import torch
+import threading
+import time
 import traceback
 import re
 
 COMPARABLE_GPU_PERCENTILE = 0.65 # if a GPU's free_mem is within this % of the GPU with the most free_mem, it will be picked
+DEVICE_INFO_REFRESH_INTERVAL = 5 # seconds - Time between updates of the GPUs free memory.
 
 mem_free_threshold = 0
+processor_name = None
+
+device_info_lock = threading.Lock()
+device_info = None # {device: {'name', 'mem_free', 'mem_total'}} of the compatible devices, mem_free updated in the background.
 
 def get_device_delta(render_devices, active_devices):
     '''
@@ -149,6 +156,12 @@ def is_device_compatible(device):
     return True
 
 def get_processor_name():
+    global processor_name
+    if processor_name is None: # Doesn't change while running, only look it up once.
+        processor_name = read_processor_name()
+    return processor_name
+
+def read_processor_name():
     try:
         import platform, subprocess
         if platform.system() == "Windows":
@@ -158,11 +171,53 @@ def get_processor_name():
             command = "sysctl -n machdep.cpu.brand_string"
             return subprocess.check_output(command).strip()
         elif platform.system() == "Linux":
-            command = "cat /proc/cpuinfo"
-            all_info = subprocess.check_output(command, shell=True).decode().strip()
-            for line in all_info.split("\n"):
-                if "model name" in line:
-                    return re.sub(".*model name.*:", "", line, 1).strip()
+            with open('/proc/cpuinfo', 'r') as f:
+                for line in f:
+                    if "model name" in line:
+                        return re.sub(".*model name.*:", "", line, 1).strip()
     except:
         print(traceback.format_exc())
-        return "cpu"
+    return "cpu"
+
+def collect_device_info():
+    # Static properties of the compatible devices, read once.
+    devices = {}
+    for device in range(torch.cuda.device_count()):
+        device = f'cuda:{device}'
+        if not is_device_compatible(device):
+            continue
+        mem_free, mem_total = torch.cuda.mem_get_info(device)
+        devices[device] = {
+            'name': torch.cuda.get_device_name(device),
+            'mem_free': mem_free / float(10**9),
+            'mem_total': mem_total / float(10**9),
+        }
+    devices['cpu'] = {'name': get_processor_name()}
+    return devices
+
+def refresh_device_info():
+    while True:
+        time.sleep(DEVICE_INFO_REFRESH_INTERVAL)
+        for device, info in device_info.items():
+            if device == 'cpu':
+                continue
+            try:
+                mem_free, _ = torch.cuda.mem_get_info(device)
+            except RuntimeError as e:
+                print(str(e))
+                continue
+            with device_info_lock:
+                device_info[device] = {**info, 'mem_free': mem_free / float(10**9)}
+
+def get_device_info():
+    '''
+    Returns a snapshot of the compatible devices {device: {'name', 'mem_free', 'mem_total'}}
+    Collected on the first call, then the free memory is refreshed every DEVICE_INFO_REFRESH_INTERVAL.
+    '''
+    global device_info
+    with device_info_lock:
+        if device_info is None:
+            device_info = collect_device_info()
+            refresh_thread = threading.Thread(target=refresh_device_info, name='DeviceInfo-Refresh', daemon=True)
+            refresh_thread.start()
+        return {device: dict(info) for device, info in device_info.items()}
@@ -0,0 +1,185 @@
+"""dispatch_benchmark.py: enqueue to start latency and manager_lock contention of the render thread dispatch.
+Notes:
+    Run from the stable-diffusion folder, with the server PYTHONPATH and the ui folder:
+        PYTHONPATH="$PYTHONPATH:$SD_UI_PATH" python -m sd_internal.dispatch_benchmark --workers 1 2 4 8
+    Simulated render threads run the task_manager dispatch on fake devices, rendering is a sleep.
+    'wake' is the current loop, idle threads wait on their wake event.
+    'poll' is the previous dispatch, reproduced here: render() only appends to the queue, idle threads scan it
+    with the previous thread_get_next_task and is_alive (both under manager_lock) and clean the task cache every 50ms.
+    manager_lock is replaced by a lock counting its acquisitions and the time spent waiting for it.
+"""
+import argparse
+import threading
+import time
+
+from sd_internal import Request, runtime, task_manager
+
+POLL_INTERVAL = 0.05 # seconds - Sleep of the previous render loop.
+
+class TimedLock():
+    def __init__(self, lock):
+        self._lock = lock
+        self._stats_lock = threading.Lock()
+        self.acquisitions = 0
+        self.wait_time = 0 # seconds
+    def acquire(self, blocking=True, timeout=-1):
+        start_time = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        with self._stats_lock:
+            self.acquisitions += 1
+            self.wait_time += time.perf_counter() - start_time
+        return acquired
+    def release(self):
+        self._lock.release()
+    def __enter__(self):
+        return self.acquire()
+    def __exit__(self, *args):
+        self.release()
+
+def is_alive_before(device=None):
+    with task_manager.manager_lock:
+        nbr_alive = 0
+        for rthread in task_manager.render_threads:
+            if device is not None and task_manager.weak_thread_data.get(rthread, {}).get('device') != device:
+                continue
+            if rthread.is_alive():
+                nbr_alive += 1
+        return nbr_alive
+
+def get_next_task_before():
+    # The previous thread_get_next_task, first eligible task in queue order.
+    if not task_manager.manager_lock.acquire(blocking=True, timeout=task_manager.LOCK_TIMEOUT):
+        return None
+    try:
+        task = None
+        for queued_task in task_manager.tasks_queue:
+            if queued_task.render_device and runtime.thread_data.device != queued_task.render_device:
+                if is_alive_before(queued_task.render_device) > 0:
+                    continue
+                queued_task.error = Exception(queued_task.render_device + ' is not currently active.')
+                task = queued_task
+                break
+            if not queued_task.render_device and runtime.thread_data.device == 'cpu' and is_alive_before() > 1:
+                continue
+            task = queued_task
+            break
+        if task is not None:
+            task_manager.tasks_queue.remove(task)
+        return task
+    finally:
+        task_manager.manager_lock.release()
+
+def render_before(req):
+    # The previous render(), queues the task without waking any thread.
+    r = Request()
+    r.session_id = req.session_id
+    new_task = task_manager.RenderTask(r)
+    if not task_manager.task_cache.put(req.session_id, new_task, task_manager.TASK_TTL):
+        raise RuntimeError('Failed to add task to cache.')
+    with task_manager.manager_lock:
+        new_task.enqueue_time = time.time()
+        task_manager.tasks_queue.append(new_task)
+
+def worker(device, mode, render_time, latencies: list):
+    runtime.thread_data.device = device
+    wake_event = threading.Event()
+    weak_data = {
+        'device': device,
+        'device_name': device,
+        'alive': True,
+        'idle': False,
+        'batch_key': None,
+        'wake_event': wake_event,
+        'model_key': None,
+    }
+    task_manager.weak_thread_data[threading.current_thread()] = weak_data
+    while weak_data['alive']:
+        weak_data['idle'] = True
+        wake_event.clear()
+        task_manager.task_cache.clean()
+        task = task_manager.thread_get_next_task() if mode == 'wake' else get_next_task_before()
+        if task is None:
+            if mode == 'wake':
+                wake_event.wait(timeout=task_manager.IDLE_WAKE_TIMEOUT)
+            else:
+                time.sleep(POLL_INTERVAL)
+            continue
+        weak_data['idle'] = False
+        latencies.append(time.time() - task.enqueue_time)
+        task.lock.acquire(blocking=False)
+        time.sleep(render_time) # Rendering on the device.
+        task.response = {'status': 'succeeded'}
+        task.lock.release()
+        task.buffer_queue.close()
+
+def run(mode, workers, args) -> dict:
+    lock = TimedLock(task_manager.manager_lock)
+    task_manager.manager_lock = lock
+    task_manager.task_cache.clear()
+    latencies = []
+    threads = []
+    for i in range(workers):
+        rthread = threading.Thread(target=worker, args=(f'cuda:{i}', mode, args.render_time, latencies), daemon=True)
+        rthread.name = task_manager.THREAD_NAME_PREFIX + f'cuda:{i}'
+        task_manager.render_threads.append(rthread)
+        rthread.start()
+    while len(task_manager.weak_thread_data) < workers:
+        time.sleep(0.01)
+
+    # Idle lock traffic, no task queued.
+    idle_acquisitions = lock.acquisitions
+    time.sleep(args.idle_time)
+    idle_acquisitions = lock.acquisitions - idle_acquisitions
+
+    lock.acquisitions = 0
+    lock.wait_time = 0
+    start_time = time.perf_counter()
+    for i in range(args.tasks):
+        req = task_manager.ImageRequest(session_id=f'bench{i}')
+        if mode == 'wake':
+            task_manager.render(req)
+        else:
+            render_before(req)
+        time.sleep(args.interval)
+    while len(latencies) < args.tasks:
+        time.sleep(0.01)
+    total_time = time.perf_counter() - start_time
+
+    for rthread in task_manager.render_threads:
+        weak_data = task_manager.weak_thread_data[rthread]
+        weak_data['alive'] = False
+        weak_data['wake_event'].set()
+    for rthread in task_manager.render_threads:
+        rthread.join()
+    task_manager.render_threads.clear()
+    task_manager.weak_thread_data.clear()
+    task_manager.manager_lock = lock._lock
+
+    latencies.sort()
+    return {
+        'mean_latency': sum(latencies) / len(latencies),
+        'p95_latency': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        'idle_acquisitions_per_s': idle_acquisitions / args.idle_time,
+        'acquisitions_per_task': lock.acquisitions / args.tasks,
+        'lock_wait': lock.wait_time,
+        'total': total_time,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the render thread dispatch latency and lock contention.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='numbers of render threads')
+    parser.add_argument('--tasks', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.01, help='seconds between enqueued tasks')
+    parser.add_argument('--render-time', type=float, default=0.02, help='seconds of simulated rendering per task')
+    parser.add_argument('--idle-time', type=float, default=2, help='seconds measuring the idle lock traffic')
+    args = parser.parse_args()
+
+    print(f"{'mode':<6}{'workers':>8}{'mean ms':>10}{'p95 ms':>10}{'idle locks/s':>14}{'locks/task':>12}{'lock wait ms':>14}")
+    for workers in args.workers:
+        for mode in ('poll', 'wake'):
+            result = run(mode, workers, args)
+            print(f"{mode:<6}{workers:>8}{result['mean_latency'] * 1000:>10.2f}{result['p95_latency'] * 1000:>10.2f}"
+                f"{result['idle_acquisitions_per_s']:>14.1f}{result['acquisitions_per_task']:>12.1f}{result['lock_wait'] * 1000:>14.2f}")
+
+if __name__ == '__main__':
+    main()
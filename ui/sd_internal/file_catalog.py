@@ -0,0 +1,88 @@
+"""file_catalog.py: in-memory listing of the files in watched directories.
+Notes:
+    Kept up to date by watchdog filesystem events when the package is installed,
+    otherwise by polling the watched directories from a background thread.
+    generation is increased on every change, use it to answer conditional requests.
+    It starts from the time of the process start, ETags of a previous run never match.
+"""
+import os
+import threading
+import time
+import traceback
+
+POLL_INTERVAL = 2 # seconds - Time between directory scans when watchdog is not available.
+
+class FileCatalog():
+    def __init__(self, dirs: list, poll_interval: float = POLL_INTERVAL):
+        self._dirs = [os.path.abspath(dir_path) for dir_path in dirs]
+        self._files = dict() # dir path: {file name: (size, mtime)}
+        self._lock: threading.Lock = threading.Lock()
+        self._poll_interval = poll_interval
+        self.generation = time.time_ns() // 1000 # Microseconds, stays exact in JavaScript numbers.
+        for dir_path in self._dirs:
+            self._files[dir_path] = self._scan_dir(dir_path)
+        self._start_watching()
+    def _scan_dir(self, dir_path: str) -> dict:
+        files = dict()
+        if not os.path.isdir(dir_path):
+            return files
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = (stat.st_size, stat.st_mtime)
+                except OSError: # Removed while scanning.
+                    continue
+        return files
+    def refresh(self) -> bool:
+        changed = False
+        for dir_path in self._dirs:
+            files = self._scan_dir(dir_path)
+            with self._lock:
+                if files != self._files[dir_path]:
+                    self._files[dir_path] = files
+                    self.generation += 1
+                    changed = True
+        return changed
+    def _poll(self) -> None:
+        while True:
+            time.sleep(self._poll_interval)
+            try:
+                self.refresh()
+            except:
+                print(traceback.format_exc())
+    def _start_watching(self) -> None:
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            poll_thread = threading.Thread(target=self._poll, name='FileCatalog-Poll', daemon=True)
+            poll_thread.start()
+            return
+
+        catalog = self
+        class RefreshHandler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                catalog.refresh()
+        observer = Observer()
+        for dir_path in self._dirs:
+            if os.path.isdir(dir_path):
+                observer.schedule(RefreshHandler(), dir_path, recursive=False)
+        observer.daemon = True
+        observer.start()
+    def exists(self, file_path: str) -> bool:
+        dir_path, file_name = os.path.split(os.path.abspath(file_path))
+        with self._lock:
+            files = self._files.get(dir_path)
+            if files is not None:
+                return file_name in files
+        return os.path.exists(file_path) # Not a watched directory.
+    def get_stat(self, file_path: str):
+        # Returns (size, mtime) of a file in a watched directory, None if unknown.
+        dir_path, file_name = os.path.split(os.path.abspath(file_path))
+        with self._lock:
+            return self._files.get(dir_path, {}).get(file_name)
+    def list_files(self, dir_path: str) -> list:
+        with self._lock:
+            return sorted(self._files.get(os.path.abspath(dir_path), {}).keys())
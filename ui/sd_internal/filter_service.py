@@ -0,0 +1,247 @@
+"""filter_service.py: GFPGAN and RealESRGAN filters, run by one worker thread per device.
+Notes:
+    Render threads hand the images to filter to the worker of their device and go on with their next task,
+    the post-processing of the task waits for the filtered images.
+    Each worker keeps its loaded filter models in a small LRU cache keyed by filter, model and precision.
+    The models stay on the device while there is room and are moved back to the CPU otherwise.
+    facexlib reads its device from a module global, each worker gives its face detector a private copy
+    of that module set to the worker device, instead of a lock shared by all the devices.
+    RealESRGAN runs on batches of same sized images, from one or several tasks.
+    GFPGAN detects and pastes faces per image, it runs one image at a time.
+    A stopped worker refuses new jobs, submit hands them to a new worker of the device instead.
+"""
+import importlib.util
+import queue
+import threading
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+from sd_internal.residency import ResidencyManager
+
+FILTER_QUEUE_SIZE = 8 # Filter jobs waiting per device, submit blocks above that.
+FILTER_MAX_BATCH = 4 # Images upscaled together by RealESRGAN.
+FILTER_MODEL_CACHE_SIZE = 2 # Filter models kept loaded by each worker.
+
+REAL_ESRGAN_MODELS = { # name: RRDBNet arguments
+    'RealESRGAN_x4plus': dict(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4),
+    'RealESRGAN_x4plus_anime_6B': dict(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4),
+}
+
+def get_filter_name(model_name: str):
+    # 'gfpgan' or 'real_esrgan' for the model names used by the requests, None for unknown filters.
+    if model_name is None:
+        return None
+    if model_name.startswith('GFPGAN'):
+        return 'gfpgan'
+    if model_name.startswith('RealESRGAN'):
+        return 'real_esrgan'
+    return None
+
+def load_retinaface_module(device):
+    # A private copy of facexlib.detection.retinaface, its functions use the device global of the copy.
+    spec = importlib.util.find_spec('facexlib.detection.retinaface')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.device = torch.device(device)
+    return module
+
+class FilterJob():
+    def __init__(self, images: list, filters: list, half: bool):
+        self.images: list = images # (h, w, 3) uint8 RGB arrays.
+        self.filters: list = filters # Model names applied in order, like GFPGANv1.3 or RealESRGAN_x4plus.
+        self.half: bool = half
+        self.future: Future = Future() # Result: the filtered images.
+    def get_batch_key(self):
+        # Jobs with the same key are filtered together.
+        return (tuple(self.filters), self.half, self.images[0].shape if len(self.images) > 0 else None)
+
+class FilterWorker():
+    def __init__(self, device):
+        self.device = device
+        self.residency = ResidencyManager(device) # Filter models only, the render thread of the device manages its own.
+        self._queue = queue.Queue(maxsize=FILTER_QUEUE_SIZE)
+        self._stopped = False
+        self._stop_lock: threading.Lock = threading.Lock() # Held while queueing a job, so none is queued after the stop sentinel.
+        self._models = OrderedDict() # (filter name, model name, half): loaded model, least recently used first.
+        self._retinaface = None
+        self.processed_images = 0
+        self.processed_batches = 0
+        self._thread = threading.Thread(target=self._run, name=f'Filter-{device}', daemon=True)
+        self._thread.start()
+    def submit(self, job: FilterJob) -> bool:
+        # False when the worker is stopped, the job was not queued.
+        with self._stop_lock:
+            if self._stopped:
+                return False
+            self._queue.put(job)
+            return True
+    def _run(self) -> None:
+        backlog = deque() # Jobs taken from the queue, in submission order, at most FILTER_MAX_BATCH.
+        while True:
+            if len(backlog) == 0:
+                backlog.append(self._queue.get())
+            while len(backlog) < FILTER_MAX_BATCH:
+                try:
+                    backlog.append(self._queue.get(block=False))
+                except queue.Empty:
+                    break
+            job = backlog.popleft()
+            if job is None:
+                self._unload_all()
+                self._fail_remaining(backlog)
+                return
+            # Filter the other waiting jobs that can share the batch with the oldest one.
+            batch = [job]
+            batch_size = len(job.images)
+            for queued_job in list(backlog):
+                if queued_job is not None and queued_job.get_batch_key() == job.get_batch_key() and batch_size + len(queued_job.images) <= FILTER_MAX_BATCH:
+                    backlog.remove(queued_job)
+                    batch.append(queued_job)
+                    batch_size += len(queued_job.images)
+            self._process(batch)
+    def _process(self, batch: list) -> None:
+        batch = [job for job in batch if job.future.set_running_or_notify_cancel()]
+        if len(batch) == 0:
+            return
+        try:
+            images = [img for job in batch for img in job.images]
+            with torch.no_grad():
+                for model_name in batch[0].filters:
+                    images = self._apply(model_name, images, batch[0].half)
+            self.processed_images += len(images)
+            self.processed_batches += 1
+            start = 0
+            for job in batch:
+                job.future.set_result(images[start:start + len(job.images)])
+                start += len(job.images)
+        except Exception as e:
+            print(traceback.format_exc())
+            for job in batch:
+                job.future.set_exception(e)
+    def _fail_remaining(self, backlog: deque) -> None:
+        # Jobs left behind the stop sentinel, none are expected since submit checks _stopped.
+        while True:
+            try:
+                backlog.append(self._queue.get(block=False))
+            except queue.Empty:
+                break
+        for job in backlog:
+            if job is not None and job.future.set_running_or_notify_cancel():
+                job.future.set_exception(RuntimeError(f'The filter worker of {self.device} was stopped.'))
+    def _apply(self, model_name: str, images: list, half: bool) -> list:
+        filter_name = get_filter_name(model_name)
+        print(f'Applying filter {model_name} to {len(images)} images on {self.device}')
+        key = self._get_model(filter_name, model_name, half)
+        self.residency.acquire(key)
+        try:
+            if filter_name == 'gfpgan':
+                model = self._models[key]
+                # GFPGANer works on BGR images.
+                return [model.enhance(img[:,:,::-1], has_aligned=False, only_center_face=False, paste_back=True)[2][:,:,::-1] for img in images]
+            return self._upscale(self._models[key], images)
+        finally:
+            self.residency.release(key)
+    def _upscale(self, model, images: list) -> list:
+        if model.tile_size > 0 or model.pre_pad != 0 or len(images) == 1 or any(img.shape[0] % 4 or img.shape[1] % 4 for img in images):
+            # RealESRGANer.enhance pads, tiles and handles one image.
+            return [model.enhance(img[:,:,::-1])[0][:,:,::-1] for img in images]
+        try:
+            # Same as RealESRGANer.enhance without padding, on the whole batch. The images are RGB already.
+            x = torch.from_numpy(np.stack(images)).to(model.device).permute(0, 3, 1, 2)
+            x = x.half() if model.half else x.float()
+            output = model.model(x / 255.0)
+            output = (output.float().clamp_(0, 1) * 255.0).round().to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+            return list(output)
+        except RuntimeError as e:
+            if 'out of memory' not in str(e):
+                raise
+        # Out of memory, outside of the except block to release the references held by the exception.
+        x = output = None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        print(f'Out of memory while upscaling {len(images)} images on {self.device}, upscaling one image at a time.')
+        return [model.enhance(img[:,:,::-1])[0][:,:,::-1] for img in images]
+    def _get_model(self, filter_name, model_name, half):
+        half = half and filter_name == 'real_esrgan' and self.device != 'cpu' # GFPGAN runs in full precision, cpu does not support half.
+        key = (filter_name, model_name, half)
+        if key in self._models:
+            self._models.move_to_end(key)
+            return key
+        while len(self._models) >= FILTER_MODEL_CACHE_SIZE:
+            old_key, _ = self._models.popitem(last=False)
+            self.residency.offload(old_key)
+            self.residency.unregister(old_key)
+        from gfpgan import GFPGANer
+        from realesrgan import RealESRGANer
+        from basicsr.archs.rrdbnet_arch import RRDBNet
+        device = torch.device(self.device)
+        model_path = model_name + '.pth'
+        if filter_name == 'gfpgan':
+            model = GFPGANer(device=device, model_path=model_path, upscale=1, arch='clean', channel_multiplier=2, bg_upsampler=None)
+            if self._retinaface is None:
+                self._retinaface = load_retinaface_module(self.device)
+            face_det = model.face_helper.face_det
+            face_det.__class__ = getattr(self._retinaface, face_det.__class__.__name__)
+            face_det.to(device) # Created on the device of the shared module global.
+            module = model.gfpgan
+        elif filter_name == 'real_esrgan':
+            if model_name not in REAL_ESRGAN_MODELS: raise ValueError(f'Unknown RealESRGAN model {model_name}')
+            model = RealESRGANer(device=device, scale=2, model_path=model_path, model=RRDBNet(**REAL_ESRGAN_MODELS[model_name]), pre_pad=0, half=half)
+            model.model.name = model_name
+            module = model.model
+        else:
+            raise ValueError(f'Unknown filter {model_name}')
+        self._models[key] = model
+        self.residency.register(key, module, on_device=self.device != 'cpu')
+        print('loaded', model_name, 'to', self.device, 'half' if half else 'full', 'precision')
+        return key
+    def _unload_all(self) -> None:
+        self.residency.offload_all()
+        self.residency.clear()
+        self._models.clear()
+    def stop(self) -> None:
+        with self._stop_lock: # Waits for a submit queueing its job.
+            if self._stopped:
+                return
+            self._stopped = True
+        self._queue.put(None)
+    def get_stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize(),
+            'models': [key[1] for key in self._models.keys()],
+            'processed_images': self.processed_images,
+            'processed_batches': self.processed_batches,
+        }
+
+workers = dict() # device: FilterWorker
+workers_lock: threading.Lock = threading.Lock()
+
+def get_worker(device) -> FilterWorker:
+    with workers_lock:
+        worker = workers.get(device)
+        if worker is None:
+            worker = FilterWorker(device)
+            workers[device] = worker
+        return worker
+
+def submit(device, images: list, filters: list, half: bool) -> Future:
+    # Returns a Future of the filtered images, blocks while FILTER_QUEUE_SIZE jobs are waiting for the device.
+    job = FilterJob(images, filters, half)
+    while not get_worker(device).submit(job): # Stopped meanwhile, stop_worker removed it from workers.
+        pass
+    return job.future
+
+def stop_worker(device) -> None:
+    # The worker unloads its models and exits after the jobs already queued.
+    with workers_lock:
+        worker = workers.pop(device, None)
+    if worker is not None:
+        worker.stop()
+
+def get_stats() -> dict:
+    with workers_lock:
+        return {device: worker.get_stats() for device, worker in workers.items()}
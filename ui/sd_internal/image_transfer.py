@@ -0,0 +1,38 @@
+"""image_transfer.py: decoded images converted on the device and copied to the host as uint8.
+Notes:
+    Clamping, scaling, the CHW to HWC permute and the uint8 quantization run on the device,
+    only the uint8 pixels (a quarter of the float32 bytes) are copied to the host.
+    CUDA copies go through a pinned buffer kept by the caller and grown as needed, pinned allocations are slow.
+"""
+import torch
+
+def to_uint8_hwc(x):
+    # x: (b, 3, h, w) in [-1, 1], returns (b, h, w, 3) uint8 on the same device. Truncates like numpy astype(np.uint8).
+    x = torch.clamp((x + 1.0) / 2.0, min=0.0, max=1.0)
+    return (255.0 * x).to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+
+class PinnedBuffer():
+    def __init__(self):
+        self._buffer = None
+    def get(self, shape):
+        # Returns a pinned uint8 tensor of this shape, valid until the next call.
+        size = 1
+        for dim in shape:
+            size *= dim
+        if self._buffer is None or self._buffer.numel() < size:
+            self._buffer = None
+            self._buffer = torch.empty(size, dtype=torch.uint8, pin_memory=True)
+        return self._buffer[:size].view(shape)
+    def clear(self) -> None:
+        self._buffer = None
+
+def to_host_images(x, pinned_buffer: PinnedBuffer = None) -> list:
+    # x: (b, 3, h, w) in [-1, 1] on any device, returns a list of (h, w, 3) uint8 numpy arrays.
+    x = to_uint8_hwc(x)
+    if x.device.type != 'cuda' or pinned_buffer is None:
+        return list(x.cpu().numpy())
+    host = pinned_buffer.get(x.shape)
+    host.copy_(x, non_blocking=True)
+    torch.cuda.current_stream(x.device).synchronize()
+    # Copied out of the buffer, it is reused by the next batch.
+    return [img.copy() for img in host.numpy()]
@@ -0,0 +1,52 @@
+"""image_transfer_benchmark.py: time of the decoded image conversion, per sample numpy vs batched on the device.
+Notes:
+    Run from the ui folder:
+        python -m sd_internal.image_transfer_benchmark --size 512 --batch 4
+    Uses random decoder outputs, the VAE itself is not run. Measures on CUDA when available, and on CPU.
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from einops import rearrange
+
+from sd_internal.image_transfer import PinnedBuffer, to_host_images
+
+def convert_numpy(x) -> list:
+    # The previous path, one sample at a time, float32 copied to the host and converted by numpy.
+    images = []
+    for i in range(len(x)):
+        x_sample = torch.clamp((x[i].unsqueeze(0) + 1.0) / 2.0, min=0.0, max=1.0)
+        x_sample = 255.0 * rearrange(x_sample[0].cpu().numpy(), "c h w -> h w c")
+        images.append(x_sample.astype(np.uint8))
+    return images
+
+def time_it(fn, x, repeats) -> float:
+    fn(x) # Warm up, allocates the pinned buffer.
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        fn(x)
+    return (time.perf_counter() - start_time) / repeats
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the decoded image conversion paths.')
+    parser.add_argument('--size', type=int, default=512, help='image size')
+    parser.add_argument('--batch', type=int, default=4, help='samples per batch')
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    devices = ['cuda', 'cpu'] if torch.cuda.is_available() else ['cpu']
+    pinned_buffer = PinnedBuffer() if torch.cuda.is_available() else None
+    for device in devices:
+        dtypes = [torch.float16, torch.float32] if device == 'cuda' else [torch.float32]
+        for dtype in dtypes:
+            x = (torch.rand((args.batch, 3, args.size, args.size), device=device) * 2.2 - 1.1).to(dtype)
+            # float16 samples can round differently in torch and in numpy.
+            same = all(np.array_equal(a, b) for a, b in zip(convert_numpy(x), to_host_images(x, pinned_buffer)))
+            numpy_time = time_it(convert_numpy, x, args.repeats)
+            device_time = time_it(lambda x: to_host_images(x, pinned_buffer), x, args.repeats)
+            print(f'{device} {str(dtype):<14} numpy: {numpy_time * 1000:8.2f} ms, on device: {device_time * 1000:8.2f} ms, {numpy_time / device_time:5.1f}x, same pixels: {same}')
+
+if __name__ == '__main__':
+    main()
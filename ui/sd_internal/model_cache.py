@@ -0,0 +1,98 @@
+"""model_cache.py: models unloaded by the render threads, kept in host RAM for reuse.
+Notes:
+    Entries are checked out by the thread loading them and put back when that thread unloads them,
+    a set of models is only used by one render thread at a time.
+    Least recently used entries are evicted when the total size goes over max_bytes.
+    The default budget is a fraction of the memory available at start, 0 (no cache) when it can't be read.
+"""
+import itertools
+import os
+import threading
+from collections import OrderedDict
+from typing import Hashable
+
+MODEL_CACHE_MAX_BYTES = 6 * 1024**3 # Maximum default budget, models in RAM not in use by a render thread.
+MODEL_CACHE_MEMORY_FRACTION = 0.25 # Of the available system memory, for the default budget.
+
+def get_available_memory() -> int:
+    # bytes, None when unknown.
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def get_default_max_bytes() -> int:
+    available = get_available_memory()
+    if available is None:
+        return 0
+    return min(MODEL_CACHE_MAX_BYTES, int(available * MODEL_CACHE_MEMORY_FRACTION))
+
+def get_model_size(model) -> int:
+    if model is None:
+        return 0
+    return sum(t.numel() * t.element_size() for t in itertools.chain(model.parameters(), model.buffers()))
+
+class ModelCache():
+    def __init__(self, max_bytes: int = None):
+        if max_bytes is None:
+            max_bytes = get_default_max_bytes()
+        self._max_bytes = max_bytes
+        self._lock: threading.Lock = threading.Lock()
+        self._entries = OrderedDict() # key: (models, size) in LRU order, most recently used last.
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    def get(self, key: Hashable):
+        # Removes and returns the models stored under key, None on a miss.
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            models, size = entry
+            self._size -= size
+            return models
+    def put(self, key: Hashable, models: dict) -> bool:
+        size = sum(get_model_size(model) for model in models.values())
+        if size > self._max_bytes:
+            return False
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._size -= old_entry[1]
+            self._entries[key] = (models, size)
+            self._size += size
+            while self._size > self._max_bytes:
+                evicted_key, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+                print('Model cache evicted', evicted_key)
+        return True
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self._max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
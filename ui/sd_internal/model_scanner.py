@@ -0,0 +1,129 @@
+"""model_scanner.py: picklescan results for model files, persisted on disk.
+Notes:
+    Results are keyed by path, size and mtime. Files that changed are hashed and only
+    scanned again when no previous result exists for the same content.
+    Scans run on a background thread pool, the status of unscanned files is pending.
+    Only clean files should be loaded, a file that could not be scanned is not known to be safe.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import picklescan.scanner
+import rich
+
+SCAN_WORKERS = 2 # Number of files scanned at the same time.
+HASH_BLOCK_SIZE = 16 * 1024 * 1024 # bytes - Read size when hashing model files.
+
+STATUS_PENDING = 'pending'
+STATUS_CLEAN = 'clean'
+STATUS_INFECTED = 'infected'
+STATUS_ERROR = 'error' # Could not be scanned, not reported as infected.
+
+def is_malicious_model(file_path):
+    try:
+        scan_result = picklescan.scanner.scan_file_path(file_path)
+        if scan_result.issues_count > 0 or scan_result.infected_files > 0:
+            rich.print(":warning: [bold red]Scan %s: %d scanned, %d issue, %d infected.[/bold red]" % (file_path, scan_result.scanned_files, scan_result.issues_count, scan_result.infected_files))
+            return True
+        else:
+            rich.print("Scan %s: [green]%d scanned, %d issue, %d infected.[/green]" % (file_path, scan_result.scanned_files, scan_result.issues_count, scan_result.infected_files))
+            return False
+    except Exception as e:
+        print('error while scanning', file_path, 'error:', e)
+    return None
+
+def get_file_hash(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+class ModelScanner():
+    def __init__(self, results_path: str):
+        self._results_path = results_path
+        self._results = dict() # path: {'size', 'mtime', 'hash', 'status'}
+        self._pending = dict() # path: Future of the running scan.
+        self._lock: threading.Lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix='ModelScanner')
+        self.generation = time.time_ns() // 1000 # Increased when a scan completes, starts from the time to never repeat the ETags of a previous run.
+        self._load()
+    def _load(self) -> None:
+        if not os.path.exists(self._results_path):
+            return
+        try:
+            with open(self._results_path, 'r', encoding='utf-8') as f:
+                self._results = json.load(f)
+        except:
+            print('Could not read scan results from', self._results_path)
+            print(traceback.format_exc())
+    def _save(self) -> None: # Call with self._lock held.
+        try:
+            tmp_path = self._results_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._results, f)
+            os.replace(tmp_path, self._results_path)
+        except:
+            print(traceback.format_exc())
+    def _scan(self, file_path: str, size: int, mtime: float) -> str:
+        status = STATUS_ERROR
+        try:
+            file_hash = get_file_hash(file_path)
+            status = None
+            with self._lock: # Same content already scanned, file was touched, copied or renamed.
+                for result in self._results.values():
+                    if result['hash'] == file_hash and result['size'] == size and result['status'] in (STATUS_CLEAN, STATUS_INFECTED):
+                        status = result['status']
+                        break
+            if status is None:
+                is_malicious = is_malicious_model(file_path)
+                status = STATUS_ERROR if is_malicious is None else (STATUS_INFECTED if is_malicious else STATUS_CLEAN)
+            elif status == STATUS_INFECTED:
+                rich.print(":warning: [bold red]Scan %s: known infected file.[/bold red]" % file_path)
+            with self._lock:
+                self._results[file_path] = {'size': size, 'mtime': mtime, 'hash': file_hash, 'status': status}
+                self.generation += 1
+                self._save()
+        except:
+            print('error while scanning', file_path)
+            print(traceback.format_exc())
+            status = STATUS_ERROR
+        finally:
+            with self._lock:
+                del self._pending[file_path]
+        return status
+    def get_status(self, file_path: str, file_stat: tuple = None) -> str:
+        # Returns the last scan result, or pending and starts a scan in the background if the file changed.
+        # file_stat: (size, mtime) when already known, to avoid a stat call.
+        file_path = os.path.abspath(file_path)
+        if file_stat is None:
+            stat = os.stat(file_path)
+            file_stat = (stat.st_size, stat.st_mtime)
+        size, mtime = file_stat
+        with self._lock:
+            result = self._results.get(file_path)
+            if file_path not in self._pending and result and result['size'] == size and result['mtime'] == mtime:
+                return result['status']
+            if file_path not in self._pending:
+                self._pending[file_path] = self._executor.submit(self._scan, file_path, size, mtime)
+            return STATUS_PENDING
+    def wait_for_scan(self, file_path: str) -> str:
+        # Same as get_status, but waits for a pending scan and returns its result, never pending.
+        file_path = os.path.abspath(file_path)
+        status = self.get_status(file_path)
+        if status != STATUS_PENDING:
+            return status
+        with self._lock:
+            future: Future = self._pending.get(file_path)
+        if future is not None:
+            status = future.result()
+        else: # Scan completed in between.
+            status = self.get_status(file_path)
+        if status == STATUS_PENDING: # File changed again while it was scanned.
+            raise RuntimeError(f'The file {file_path} changed while it was scanned.')
+        return status
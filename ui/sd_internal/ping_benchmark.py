@@ -0,0 +1,125 @@
+"""ping_benchmark.py: throughput of the /ping device info, collected per call vs served from the device inventory.
+Notes:
+    Run from the stable-diffusion folder, with the server PYTHONPATH and the ui folder:
+        PYTHONPATH="$PYTHONPATH:$SD_UI_PATH" python -m sd_internal.ping_benchmark --clients 1 4 16 --duration 5
+    Client threads call what /ping runs, is_alive() and get_devices(), like the endpoint thread pool would.
+    'before' is the previous implementation: processor name from a 'cat /proc/cpuinfo' subprocess,
+    compatibility and memory queried from CUDA for every GPU, manager_lock held while listing the render threads.
+    '--dispatch-load' holds manager_lock for short periods in the background, like busy render threads.
+"""
+import argparse
+import platform
+import re
+import subprocess
+import threading
+import time
+
+import torch
+
+from sd_internal import device_manager, task_manager
+
+def get_processor_name_before():
+    if platform.system() != "Linux":
+        return device_manager.read_processor_name()
+    all_info = subprocess.check_output("cat /proc/cpuinfo", shell=True).decode().strip()
+    for line in all_info.split("\n"):
+        if "model name" in line:
+            return re.sub(".*model name.*:", "", line, 1).strip()
+    return "cpu"
+
+def get_device_info_before(device):
+    if device == 'cpu':
+        return {'name': get_processor_name_before()}
+    mem_free, mem_total = torch.cuda.mem_get_info(device)
+    return {
+        'name': torch.cuda.get_device_name(device),
+        'mem_free': mem_free / float(10**9),
+        'mem_total': mem_total / float(10**9),
+    }
+
+def ping_before():
+    with task_manager.manager_lock:
+        alive = len([rthread for rthread in task_manager.render_threads if rthread.is_alive()])
+    devices = {'all': {}, 'active': {}}
+    for device in range(torch.cuda.device_count()):
+        device = f'cuda:{device}'
+        if not device_manager.is_device_compatible(device):
+            continue
+        devices['all'][device] = get_device_info_before(device)
+    devices['all']['cpu'] = get_device_info_before('cpu')
+    with task_manager.manager_lock:
+        for rthread in task_manager.render_threads:
+            weak_data = task_manager.weak_thread_data.get(rthread)
+            if rthread.is_alive() and weak_data:
+                devices['active'][weak_data['device']] = get_device_info_before(weak_data['device'])
+    return alive, devices
+
+def ping_after():
+    return task_manager.is_alive(), task_manager.get_devices()
+
+def idle_render_thread(stop_event: threading.Event):
+    stop_event.wait()
+
+def dispatch_load(stop_event: threading.Event, hold_time, interval):
+    while not stop_event.is_set():
+        with task_manager.manager_lock:
+            time.sleep(hold_time)
+        time.sleep(interval)
+
+def run(ping, clients, args) -> dict:
+    stop_event = threading.Event()
+    latencies = []
+    latencies_lock = threading.Lock()
+    def client():
+        client_latencies = []
+        while not stop_event.is_set():
+            start_time = time.perf_counter()
+            ping()
+            client_latencies.append(time.perf_counter() - start_time)
+        with latencies_lock:
+            latencies.extend(client_latencies)
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(clients)]
+    if args.dispatch_load:
+        threads.append(threading.Thread(target=dispatch_load, args=(stop_event, args.hold_time, args.hold_interval), daemon=True))
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop_event.set()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return {
+        'per_s': len(latencies) / args.duration,
+        'p50': latencies[len(latencies) // 2],
+        'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the /ping throughput before and after the device inventory.')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16], help='numbers of concurrent pinging clients')
+    parser.add_argument('--duration', type=float, default=5, help='seconds per measurement')
+    parser.add_argument('--render-threads', type=int, default=2, help='idle render threads listed as active devices')
+    parser.add_argument('--dispatch-load', action='store_true', help='hold manager_lock in the background')
+    parser.add_argument('--hold-time', type=float, default=0.005, help='seconds manager_lock is held by the dispatch load')
+    parser.add_argument('--hold-interval', type=float, default=0.005, help='seconds between two holds of the dispatch load')
+    args = parser.parse_args()
+
+    stop_event = threading.Event()
+    devices = [f'cuda:{i}' for i in range(torch.cuda.device_count())] or ['cpu']
+    for i in range(args.render_threads):
+        device = devices[i % len(devices)]
+        rthread = threading.Thread(target=idle_render_thread, args=(stop_event,), daemon=True)
+        rthread.start()
+        task_manager.render_threads.append(rthread)
+        task_manager.weak_thread_data[rthread] = {'device': device, 'device_name': device}
+    ping_after() # Collects the inventory, not part of the measurements.
+
+    print(f"{'':<8}{'clients':>8}{'pings/s':>12}{'p50 ms':>10}{'p95 ms':>10}")
+    for clients in args.clients:
+        for name, ping in (('before', ping_before), ('after', ping_after)):
+            result = run(ping, clients, args)
+            print(f"{name:<8}{clients:>8}{result['per_s']:>12.1f}{result['p50'] * 1000:>10.3f}{result['p95'] * 1000:>10.3f}")
+    stop_event.set()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""post_processing.py: bounded worker pool for the CPU work done after rendering.
+Notes:
+    Image encoding, base64 and disk writes run on worker threads while the render thread starts its next task.
+    PIL encoders, zlib and file writes release the GIL, threads avoid pickling the images to other processes.
+    At most max_pending jobs are queued or running, submit blocks above that,
+    the memory held by images waiting to be encoded stays bounded.
+    Jobs start in submission order.
+"""
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+POST_PROCESSING_WORKERS = 2
+POST_PROCESSING_MAX_PENDING = 4 # Jobs queued or running, render threads wait before handing over more.
+
+class PostProcessingPool():
+    def __init__(self, workers: int = POST_PROCESSING_WORKERS, max_pending: int = POST_PROCESSING_MAX_PENDING):
+        self._workers = workers
+        self._max_pending = max(max_pending, 1)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='PostProcessing')
+        self._slots = threading.BoundedSemaphore(self._max_pending)
+        self._lock: threading.Lock = threading.Lock()
+        self._pending = 0
+        self.completed = 0
+        self.skipped = 0 # Optional jobs not submitted because the pool was full.
+        self.wait_time = 0 # seconds - Total time spent waiting for a free slot.
+    def _submit(self, fn, args, kwargs) -> Future:
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except:
+            self._on_done(None)
+            raise
+        future.add_done_callback(self._on_done)
+        return future
+    def _on_done(self, future) -> None:
+        with self._lock:
+            self._pending -= 1
+            if future is not None:
+                self.completed += 1
+        self._slots.release()
+    def submit(self, fn, *args, **kwargs) -> Future:
+        # Waits while max_pending jobs are in the pool.
+        start_time = time.perf_counter()
+        self._slots.acquire()
+        with self._lock:
+            self.wait_time += time.perf_counter() - start_time
+        return self._submit(fn, args, kwargs)
+    def try_submit(self, fn, *args, **kwargs) -> Optional[Future]:
+        # Returns None instead of waiting when the pool is full, for work that can be skipped.
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.skipped += 1
+            return None
+        return self._submit(fn, args, kwargs)
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'workers': self._workers,
+                'max_pending': self._max_pending,
+                'pending': self._pending,
+                'completed': self.completed,
+                'skipped': self.skipped,
+                'wait_time': round(self.wait_time, 3),
+            }
@@ -0,0 +1,71 @@
+"""post_processing_benchmark.py: render thread idle time with inline and pooled image encoding.
+Notes:
+    Run from the ui folder:
+        python -m sd_internal.post_processing_benchmark --tasks 8 --images 2 --size 2048 --render-time 1.5
+    The rendering is simulated by a sleep, the device is idle whenever the render thread is not in it.
+    Each task then encodes and writes its images as PNG, like the outputs of an upscaled render.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from sd_internal.post_processing import PostProcessingPool, POST_PROCESSING_MAX_PENDING, POST_PROCESSING_WORKERS
+
+def make_images(count, size) -> list:
+    # Smooth gradients with noise, compresses like a rendered image rather than like pure noise.
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, size, dtype=np.float32)
+    images = []
+    for _ in range(count):
+        img = gradient[None, :, None] * 0.5 + gradient[:, None, None] * 0.3 + rng.normal(0, 12, (size, size, 3))
+        images.append(np.clip(img, 0, 255).astype(np.uint8))
+    return images
+
+def encode_and_save(images: list, out_dir, task_id):
+    for i, img_data in enumerate(images):
+        Image.fromarray(img_data).save(os.path.join(out_dir, f'{task_id}_{i}.png'))
+
+def run(args, images, out_dir, pool: PostProcessingPool = None) -> dict:
+    start_time = time.perf_counter()
+    futures = []
+    for task_id in range(args.tasks):
+        time.sleep(args.render_time) # Rendering on the device.
+        if pool is None:
+            encode_and_save(images, out_dir, task_id)
+        else:
+            futures.append(pool.submit(encode_and_save, images, out_dir, task_id))
+    render_thread_time = time.perf_counter() - start_time
+    for future in futures:
+        future.result()
+    total_time = time.perf_counter() - start_time
+    return {
+        'total': total_time,
+        'device_idle': render_thread_time - args.tasks * args.render_time, # Between renders, not counting the final drain.
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the device idle time with inline and pooled image encoding.')
+    parser.add_argument('--tasks', type=int, default=8)
+    parser.add_argument('--images', type=int, default=2, help='images per task')
+    parser.add_argument('--size', type=int, default=2048, help='image size')
+    parser.add_argument('--render-time', type=float, default=1.5, help='seconds of simulated rendering per task')
+    parser.add_argument('--workers', type=int, default=POST_PROCESSING_WORKERS)
+    parser.add_argument('--max-pending', type=int, default=POST_PROCESSING_MAX_PENDING)
+    args = parser.parse_args()
+
+    images = make_images(args.images, args.size)
+    with tempfile.TemporaryDirectory() as out_dir:
+        inline = run(args, images, out_dir)
+        pool = PostProcessingPool(args.workers, args.max_pending)
+        pooled = run(args, images, out_dir, pool)
+    print(f"{'':<8}{'total s':>10}{'device idle s':>16}")
+    print(f"{'inline':<8}{inline['total']:>10.2f}{inline['device_idle']:>16.2f}")
+    print(f"{'pooled':<8}{pooled['total']:>10.2f}{pooled['device_idle']:>16.2f}")
+    print('pool', pool.get_stats())
+
+if __name__ == '__main__':
+    main()
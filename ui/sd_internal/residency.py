@@ -0,0 +1,110 @@
+"""residency.py: decides which models stay in the memory of a render device.
+Notes:
+    Models are moved to the device when needed and stay there after use while they fit,
+    they are only moved back to the CPU when the memory is needed or when over the budget.
+    Least recently used models are moved out first.
+    Moves are synchronized with the device, no polling of the allocated memory.
+    The prepare stage of a render thread uses the same manager from its own thread,
+    models it pinned are not moved out until it unpins them.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+from sd_internal.model_cache import get_model_size
+
+VRAM_RESERVE = 2 * 1024**3 # bytes - Free device memory kept for the sampler activations and decoding.
+
+class ResidencyManager():
+    def __init__(self, device, budget: int = None, reserve: int = VRAM_RESERVE):
+        self.device = torch.device(device)
+        self._budget = budget # bytes - Maximum size of the models kept on the device, None to only use the free memory.
+        self._reserve = reserve
+        self._modules = dict() # name: module
+        self._resident = OrderedDict() # name: size of the models on the device, least recently used first.
+        self._pinned = dict() # name: pin count, pinned models are never moved out.
+        self._lock: threading.RLock = threading.RLock()
+        self.transfer_time = 0 # seconds - Total time spent moving models on this device.
+    def register(self, name: str, module, on_device: bool = False) -> None:
+        with self._lock:
+            self._modules[name] = module
+            self._resident.pop(name, None)
+            if on_device and self.device.type != 'cpu':
+                self._resident[name] = get_model_size(module)
+    def unregister(self, name: str) -> None:
+        with self._lock:
+            self._modules.pop(name, None)
+            self._resident.pop(name, None)
+    def clear(self) -> None:
+        with self._lock:
+            self._modules.clear()
+            self._resident.clear()
+            self._pinned.clear()
+    def get_available_memory(self) -> int:
+        mem_free, _ = torch.cuda.mem_get_info(self.device)
+        # Blocks cached by the torch allocator are free for torch but not for the driver.
+        return mem_free + torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+    def fits(self, size: int) -> bool:
+        if self._budget is not None and sum(self._resident.values()) + size > self._budget:
+            return False
+        return self.get_available_memory() - size >= self._reserve
+    def make_room(self, size: int, keep=()) -> None:
+        # Move out least recently used models until size fits on the device.
+        if self.device.type == 'cpu':
+            return
+        with self._lock:
+            for name in list(self._resident.keys()):
+                if self.fits(size):
+                    return
+                if name not in keep:
+                    self.offload(name)
+    def _move(self, module, device) -> None:
+        start_time = time.perf_counter()
+        module.to(device)
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        self.transfer_time += time.perf_counter() - start_time
+    def acquire(self, name: str):
+        # Returns the module, on the device.
+        with self._lock:
+            module = self._modules[name]
+            if self.device.type == 'cpu':
+                return module
+            if name in self._resident:
+                self._resident.move_to_end(name)
+                return module
+            size = get_model_size(module)
+            self.make_room(size, keep=(name,))
+            self._move(module, self.device)
+            self._resident[name] = size
+            return module
+    def try_acquire(self, name: str, extra_size: int = 0) -> bool:
+        # Acquire and pin the module, only when it is on the device or fits without moving other models out.
+        # extra_size: bytes that will be needed on the device by others, in addition to the module.
+        with self._lock:
+            if self.device.type != 'cpu' and name not in self._resident and not self.fits(get_model_size(self._modules[name]) + extra_size):
+                return False
+            self.acquire(name)
+            self._pinned[name] = self._pinned.get(name, 0) + 1
+            return True
+    def unpin(self, name: str) -> None:
+        with self._lock:
+            count = self._pinned.pop(name, 0) - 1
+            if count > 0:
+                self._pinned[name] = count
+    def release(self, name: str) -> None:
+        # Done with the module for now, it stays on the device if the free memory is still above the reserve.
+        with self._lock:
+            if name in self._resident and not self.fits(0):
+                self.offload(name)
+    def offload(self, name: str) -> None:
+        with self._lock:
+            if name in self._pinned or self._resident.pop(name, None) is None:
+                return
+            self._move(self._modules[name], 'cpu')
+    def offload_all(self) -> None:
+        with self._lock:
+            for name in list(self._resident.keys()):
+                self.offload(name)
@@ -4,6 +4,7 @@ Notes:
     To use a diffrent device signal the current render device to exit
     And then start a new clean thread for the new device.
 """
+import inspect
 import json
 import os, re
 import traceback
@@ -24,30 +25,61 @@ from einops import rearrange, repeat
 from ldm.util import instantiate_from_config
 from transformers import logging
 
-from gfpgan import GFPGANer
-from basicsr.archs.rrdbnet_arch import RRDBNet
-from realesrgan import RealESRGANer
-
-from threading import Lock
+from typing import Any
+from collections import OrderedDict, deque
 
 import uuid
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 logging.set_verbosity_error()
 
 # consts
 config_yaml = "optimizedSD/v1-inference.yaml"
 filename_regex = re.compile('[^a-zA-Z0-9]')
-gfpgan_temp_device_lock = Lock() # workaround: gfpgan currently can only start on one device at a time.
+CONDITIONING_CACHE_SIZE = 128 # Text conditionings kept on each render device.
+INIT_LATENT_CACHE_SIZE = 8 # Encoded img2img init images kept on each render device.
+PREPARE_MAX_REQUESTS = 2 # Queued requests whose prompts and init images are encoded while the current batch samples.
+FILTER_TASK_WORKERS = 2 # Filter tasks running at the same time, their images are batched together by the filter workers.
+FILTER_TASK_WINDOW = 8 # Images of a filter task decoded or filtered ahead of the one being sent, twice the filter worker batch.
+LOAD_STATE_DICT_ASSIGN = 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters # torch 2.1 and later, see load_part_state_dict.
+# Rough memory estimates of the sampler, see get_sampler_plan
+UNET_ATTENTION_HEADS = 8
+UNET_ATTENTION_COPIES = 3 # Attention scores, softmax and matmul temporaries of the largest UNet blocks.
+UNET_ACTIVATION_ELEMENTS_PER_TOKEN = 320 * 16 # Other activations of one latent pixel in the UNet.
+SAMPLER_STATE_COPIES = 8 # float32 latents kept per sample by the samplers: x, guidance branches, noise and history.
+SAMPLER_MEMORY_MARGIN = 0.8 # Fraction of the available device memory planned for sampling.
+LATENT_PREVIEW_RGB_FACTORS = [ # Linear projection of the 4 latent channels to RGB, used for cheap progress previews.
+    #   R       G       B
+    [ 0.298,  0.207,  0.208],
+    [ 0.187,  0.286,  0.173],
+    [-0.158,  0.189,  0.264],
+    [-0.184, -0.271, -0.473],
+]
 
 # api stuff
-from sd_internal import device_manager
-from . import Request, Response, Image as ResponseImage
+from sd_internal import config_store, device_manager, filter_service
+from sd_internal import tiled_vae, weight_cache as weight_cache_module
+from sd_internal.image_transfer import PinnedBuffer, to_host_images
+from sd_internal.post_processing import PostProcessingPool
+from sd_internal.model_cache import get_model_size
+from sd_internal.residency import ResidencyManager
+from . import FilterTaskRequest, Request, Response, Image as ResponseImage
 import base64
 from io import BytesIO
 #from colorama import Fore
 
-from threading import local as LocalThreadVars
+from threading import BoundedSemaphore, local as LocalThreadVars
 thread_data = LocalThreadVars()
+weight_cache = None # WeightCache shared by all render threads, set by the server. None loads checkpoints directly.
+model_cache = None # ModelCache shared by all render threads, set by the server. None discards unloaded models.
+weight_registry = None # WeightRegistry sharing SD1 host weights between render threads, set by the server.
+vram_budget = None # bytes - Maximum size of the models kept on each render device, None to only use the free memory.
+vae_tile_threshold = tiled_vae.TILE_THRESHOLD # pixels - Images larger than this are encoded and decoded in tiles, None to never tile.
+vae_decode_batch_size = 2 # Samples decoded together by the VAE, for outputs and full previews.
+post_processing_pool = PostProcessingPool() # Encodes and saves the images of all render threads, replaced by the server from the config.
+filter_task_executor = ThreadPoolExecutor(max_workers=FILTER_TASK_WORKERS, thread_name_prefix='FilterTask') # Runs the filter tasks, see filter_images
+filter_task_slots = BoundedSemaphore(FILTER_TASK_WINDOW) # Filter tasks taken from the queue and not completed yet, the others stay queued.
 
 def thread_init(device):
     # Thread bound properties
@@ -56,17 +88,21 @@ def thread_init(device):
 
     thread_data.ckpt_file = None
     thread_data.vae_file = None
-    thread_data.gfpgan_file = None
-    thread_data.real_esrgan_file = None
 
     thread_data.model = None
     thread_data.modelCS = None
     thread_data.modelFS = None
-    thread_data.model_gfpgan = None
-    thread_data.model_real_esrgan = None
+    thread_data.model_cache_key = None # Key of the loaded models in model_cache.
 
     thread_data.model_is_half = False
     thread_data.model_fs_is_half = False
+    thread_data.conditioning_cache = OrderedDict() # (ckpt_file, model_is_half, prompt): conditioning tensor on the device.
+    thread_data.conditioning_cache_hits = 0
+    thread_data.conditioning_cache_misses = 0
+    thread_data.init_latent_cache = OrderedDict() # (ckpt_file, vae_file, model_fs_is_half, init image hash, width, height): posterior mean and std on the device.
+    thread_data.pinned_buffer = PinnedBuffer() # Host side of the decoded images copied from the device.
+    thread_data.prepare_executor = None # Runs the prepare stage of this render thread, see start_prepare_stage
+    thread_data.prepare_future = None
     thread_data.device = None
     thread_data.device_name = None
     thread_data.unet_bs = 1
@@ -79,22 +115,13 @@ def thread_init(device):
     thread_data.test_sd2 = isSD2()
 
     device_manager.device_init(thread_data, device)
+    thread_data.residency = ResidencyManager(thread_data.device, budget=vram_budget)
 
 # temp hack, will remove soon
 def isSD2():
-    try:
-        SD_UI_DIR = os.getenv('SD_UI_PATH', None)
-        CONFIG_DIR = os.path.abspath(os.path.join(SD_UI_DIR, '..', 'scripts'))
-        config_json_path = os.path.join(CONFIG_DIR, 'config.json')
-        if not os.path.exists(config_json_path):
-            return False
-        with open(config_json_path, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-            return config.get('test_sd2', False)
-    except Exception as e:
-        return False
+    return config_store.get_config({}).get('test_sd2', False)
 
-def load_model_ckpt():
+def load_model_ckpt(cached_models=None, check_cache=True):
     if not thread_data.ckpt_file: raise ValueError(f'Thread ckpt_file is undefined.')
     if not os.path.exists(thread_data.ckpt_file + '.ckpt'): raise FileNotFoundError(f'Cannot find {thread_data.ckpt_file}.ckpt')
 
@@ -109,12 +136,93 @@ def load_model_ckpt():
 
     print('loading', thread_data.ckpt_file + '.ckpt', 'to device', thread_data.device, 'using precision', thread_data.precision)
 
-    if thread_data.test_sd2:
-        load_model_ckpt_sd2()
+    model_cache_key = get_model_cache_key(thread_data.ckpt_file, thread_data.vae_file, thread_data.precision)
+    if weight_registry is not None and not thread_data.test_sd2:
+        use_cached_models(weight_registry.acquire(model_cache_key, load_model_templates_sd1))
     else:
-        load_model_ckpt_sd1()
+        if cached_models is None and check_cache and model_cache is not None:
+            cached_models = model_cache.get(model_cache_key)
+        if cached_models is not None:
+            use_cached_models(cached_models)
+            print(f'loaded model from the model cache {model_cache.get_stats()}')
+        elif thread_data.test_sd2:
+            load_model_ckpt_sd2()
+        else:
+            load_model_ckpt_sd1()
+    thread_data.model_cache_key = model_cache_key
+    if not thread_data.test_sd2:
+        thread_data.residency.register('cs', thread_data.modelCS)
+        thread_data.residency.register('fs', thread_data.modelFS)
+
+def load_model_templates_sd1():
+    # Models shared by the weight registry, they stay on the CPU.
+    load_model_ckpt_sd1()
+    templates = {
+        'model': thread_data.model,
+        'modelCS': thread_data.modelCS,
+        'modelFS': thread_data.modelFS,
+    }
+    thread_data.model = None
+    thread_data.modelCS = None
+    thread_data.modelFS = None
+    return templates
 
-def load_model_ckpt_sd1():
+def get_model_cache_key(ckpt_file, vae_file, precision):
+    return (ckpt_file, vae_file, precision, thread_data.test_sd2)
+
+def prefetch_model(ckpt_file, vae_file, device, precision):
+    '''
+    Load a SD1 model in host RAM and store it in the model_cache, for a render thread to pick up later.
+    Runs on a prefetch thread with its own thread_data, the models never leave the CPU.
+    Returns True when a model was loaded.
+    '''
+    thread_data.test_sd2 = isSD2()
+    if model_cache is None or thread_data.test_sd2: # SD2 models are loaded directly on the device.
+        return False
+    thread_data.device = device
+    thread_data.ckpt_file = ckpt_file
+    thread_data.vae_file = vae_file
+    thread_data.precision = 'full' if device == 'cpu' else precision
+    thread_data.unet_bs = 1
+    thread_data.turbo = False
+    thread_data.model = None
+    thread_data.modelCS = None
+    thread_data.modelFS = None
+    thread_data.conditioning_cache = OrderedDict()
+    model_cache_key = get_model_cache_key(ckpt_file, vae_file, thread_data.precision)
+    if model_cache_key in model_cache or (weight_registry is not None and model_cache_key in weight_registry):
+        return False
+    print('prefetching', ckpt_file + '.ckpt', 'for device', device, 'using precision', thread_data.precision)
+    model_cache.put(model_cache_key, load_model_templates_sd1())
+    gc()
+    return True
+
+def use_cached_models(models):
+    # Reuse models loaded earlier or by another render thread, only needs to bind them to this thread's device.
+    thread_data.model = models['model']
+    thread_data.modelCS = models['modelCS']
+    thread_data.modelFS = models['modelFS']
+    thread_data.model_is_half = thread_data.device != "cpu" and thread_data.precision == "autocast"
+    thread_data.model_fs_is_half = thread_data.model_is_half
+    if thread_data.test_sd2:
+        thread_data.model.to(thread_data.device)
+        thread_data.model.cond_stage_model.device = torch.device(thread_data.device)
+    else:
+        thread_data.model.cdevice = torch.device(thread_data.device)
+        thread_data.model.unet_bs = thread_data.unet_bs
+        thread_data.model.turbo = thread_data.turbo
+        thread_data.modelCS.cond_stage_model.device = torch.device(thread_data.device)
+
+def get_sd1_state_dicts():
+    # Returns a function giving the state_dict of a model part 'unet', 'cs' or 'fs'.
+    if weight_cache is not None and weight_cache_module.is_available():
+        half = thread_data.device != "cpu" and thread_data.precision == "autocast"
+        try: # All parts are opened here, a missing or damaged file falls back to the checkpoint.
+            part_sds = weight_cache.load(thread_data.ckpt_file + '.ckpt', half=half)
+            return lambda part: part_sds[part]
+        except:
+            print(traceback.format_exc())
+            print(f'Could not use the converted weights of {thread_data.ckpt_file}.ckpt, loading the checkpoint instead.')
     sd = load_model_from_config(thread_data.ckpt_file + '.ckpt')
     li, lo = [], []
     for key, value in sd.items():
@@ -132,11 +240,21 @@ def load_model_ckpt_sd1():
         sd["model1." + key[6:]] = sd.pop(key)
     for key in lo:
         sd["model2." + key[6:]] = sd.pop(key)
+    return lambda part: sd
+
+def load_part_state_dict(model, sd):
+    # assign keeps the loaded, memory mapped, tensors as the parameters instead of copying them into the initialized ones.
+    if LOAD_STATE_DICT_ASSIGN:
+        return model.load_state_dict(sd, strict=False, assign=True)
+    return model.load_state_dict(sd, strict=False) # Before torch 2.1, copies.
+
+def load_model_ckpt_sd1():
+    get_part_sd = get_sd1_state_dicts()
 
     config = OmegaConf.load(f"{config_yaml}")
 
     model = instantiate_from_config(config.modelUNet)
-    _, _ = model.load_state_dict(sd, strict=False)
+    _, _ = load_part_state_dict(model, get_part_sd('unet'))
     model.eval()
     model.cdevice = torch.device(thread_data.device)
     model.unet_bs = thread_data.unet_bs
@@ -149,7 +267,7 @@ def load_model_ckpt_sd1():
     thread_data.model = model
 
     modelCS = instantiate_from_config(config.modelCondStage)
-    _, _ = modelCS.load_state_dict(sd, strict=False)
+    _, _ = load_part_state_dict(modelCS, get_part_sd('cs'))
     modelCS.eval()
     modelCS.cond_stage_model.device = torch.device(thread_data.device)
     # if thread_data.device != 'cpu':
@@ -160,7 +278,7 @@ def load_model_ckpt_sd1():
     thread_data.modelCS = modelCS
 
     modelFS = instantiate_from_config(config.modelFirstStage)
-    _, _ = modelFS.load_state_dict(sd, strict=False)
+    _, _ = load_part_state_dict(modelFS, get_part_sd('fs'))
 
     if thread_data.vae_file is not None:
         try:
@@ -189,7 +307,7 @@ def load_model_ckpt_sd1():
     #     else:
     #         modelFS.to(thread_data.device) # Preload on device if not already there.
     thread_data.modelFS = modelFS
-    del sd
+    del get_part_sd
 
     if thread_data.device != "cpu" and thread_data.precision == "autocast":
         thread_data.model.half()
@@ -243,21 +361,13 @@ def load_model_ckpt_sd2():
  using precision: {thread_data.precision}''')
 
 def unload_filters():
-    if thread_data.model_gfpgan is not None:
-        if thread_data.device != 'cpu': thread_data.model_gfpgan.gfpgan.to('cpu')
-
-        del thread_data.model_gfpgan
-    thread_data.model_gfpgan = None
-
-    if thread_data.model_real_esrgan is not None:
-        if thread_data.device != 'cpu': thread_data.model_real_esrgan.model.to('cpu')
-
-        del thread_data.model_real_esrgan
-    thread_data.model_real_esrgan = None
-
-    gc()
+    # The filter worker of the device unloads its models once done with the images already handed to it.
+    filter_service.stop_worker(thread_data.device)
 
 def unload_models():
+    wait_for_prepare_stage() # It uses the models.
+    thread_data.residency.unregister('cs')
+    thread_data.residency.unregister('fs')
     if thread_data.model is not None:
         print('Unloading models...')
         if thread_data.device != 'cpu':
@@ -266,14 +376,31 @@ def unload_models():
                 thread_data.modelCS.to('cpu')
                 thread_data.model.model1.to("cpu")
                 thread_data.model.model2.to("cpu")
+            elif model_cache is not None:
+                thread_data.model.to('cpu')
+
+        shared_weights_key = None
+        if weight_registry is not None and not thread_data.test_sd2:
+            shared_weights_key = thread_data.model_cache_key # Released once the copies are gone.
+        elif model_cache is not None and thread_data.model_cache_key is not None:
+            model_cache.put(thread_data.model_cache_key, {
+                'model': thread_data.model,
+                'modelCS': thread_data.modelCS,
+                'modelFS': thread_data.modelFS,
+            })
 
         del thread_data.model
         del thread_data.modelCS
         del thread_data.modelFS
+        if shared_weights_key is not None:
+            weight_registry.release(shared_weights_key)
 
     thread_data.model = None
     thread_data.modelCS = None
     thread_data.modelFS = None
+    thread_data.model_cache_key = None
+    thread_data.conditioning_cache.clear()
+    thread_data.init_latent_cache.clear()
 
     gc()
 
@@ -301,42 +428,6 @@ def unload_models():
 #             time_step = time.time()
 #     print(f'Device {thread_data.device} - {model_name} Moved: {round(start_mem - last_mem)}Mb in {round(time.time() - start_time, 3)} seconds to {target_device}')
 
-def move_to_cpu(model):
-    if thread_data.device != "cpu":
-        d = torch.device(thread_data.device)
-        mem = torch.cuda.memory_allocated(d) / 1e6
-        model.to("cpu")
-        while torch.cuda.memory_allocated(d) / 1e6 >= mem:
-            time.sleep(1)
-
-def load_model_gfpgan():
-    if thread_data.gfpgan_file is None: raise ValueError(f'Thread gfpgan_file is undefined.')
-    model_path = thread_data.gfpgan_file + ".pth"
-    thread_data.model_gfpgan = GFPGANer(device=torch.device(thread_data.device), model_path=model_path, upscale=1, arch='clean', channel_multiplier=2, bg_upsampler=None)
-    print('loaded', thread_data.gfpgan_file, 'to', thread_data.model_gfpgan.device, 'precision', thread_data.precision)
-
-def load_model_real_esrgan():
-    if thread_data.real_esrgan_file is None: raise ValueError(f'Thread real_esrgan_file is undefined.')
-    model_path = thread_data.real_esrgan_file + ".pth"
-
-    RealESRGAN_models = {
-        'RealESRGAN_x4plus': RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4),
-        'RealESRGAN_x4plus_anime_6B': RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4)
-    }
-
-    model_to_use = RealESRGAN_models[thread_data.real_esrgan_file]
-
-    if thread_data.device == 'cpu':
-        thread_data.model_real_esrgan = RealESRGANer(device=torch.device(thread_data.device), scale=2, model_path=model_path, model=model_to_use, pre_pad=0, half=False) # cpu does not support half
-        #thread_data.model_real_esrgan.device = torch.device(thread_data.device)
-        thread_data.model_real_esrgan.model.to('cpu')
-    else:
-        thread_data.model_real_esrgan = RealESRGANer(device=torch.device(thread_data.device), scale=2, model_path=model_path, model=model_to_use, pre_pad=0, half=thread_data.model_is_half)
-
-    thread_data.model_real_esrgan.model.name = thread_data.real_esrgan_file
-    print('loaded ', thread_data.real_esrgan_file, 'to', thread_data.model_real_esrgan.device, 'precision', thread_data.precision)
-
-
 def get_session_out_path(disk_path, session_id):
     if disk_path is None: return None
     if session_id is None: return None
@@ -358,45 +449,6 @@ def get_base_path(disk_path, session_id, prompt, img_id, ext, suffix=None):
         return os.path.join(session_out_path, f"{prompt_flattened}_{img_id}_{suffix}.{ext}")
     return os.path.join(session_out_path, f"{prompt_flattened}_{img_id}.{ext}")
 
-def apply_filters(filter_name, image_data, model_path=None):
-    print(f'Applying filter {filter_name}...')
-    gc() # Free space before loading new data.
-
-    if isinstance(image_data, torch.Tensor):
-        image_data.to(thread_data.device)
-
-    if filter_name == 'gfpgan':
-        # This lock is only ever used here. No need to use timeout for the request. Should never deadlock.
-        with gfpgan_temp_device_lock: # Wait for any other devices to complete before starting.
-            # hack for a bug in facexlib: https://github.com/xinntao/facexlib/pull/19/files
-            from facexlib.detection import retinaface
-            retinaface.device = torch.device(thread_data.device)
-            print('forced retinaface.device to', thread_data.device)
-
-            if model_path is not None and model_path != thread_data.gfpgan_file:
-                thread_data.gfpgan_file = model_path
-                load_model_gfpgan()
-            elif not thread_data.model_gfpgan:
-                load_model_gfpgan()
-            if thread_data.model_gfpgan is None: raise Exception('Model "gfpgan" not loaded.')
-
-            print('enhance with', thread_data.gfpgan_file, 'on', thread_data.model_gfpgan.device, 'precision', thread_data.precision)
-            _, _, output = thread_data.model_gfpgan.enhance(image_data[:,:,::-1], has_aligned=False, only_center_face=False, paste_back=True)
-            image_data = output[:,:,::-1]
-
-    if filter_name == 'real_esrgan':
-        if model_path is not None and model_path != thread_data.real_esrgan_file:
-            thread_data.real_esrgan_file = model_path
-            load_model_real_esrgan()
-        elif not thread_data.model_real_esrgan:
-            load_model_real_esrgan()
-        if thread_data.model_real_esrgan is None: raise Exception('Model "gfpgan" not loaded.')
-        print('enhance with', thread_data.real_esrgan_file, 'on', thread_data.model_real_esrgan.device, 'precision', thread_data.precision)
-        output, _ = thread_data.model_real_esrgan.enhance(image_data[:,:,::-1])
-        image_data = output[:,:,::-1]
-
-    return image_data
-
 def is_model_reload_necessary(req: Request):
     # custom model support:
     #  the req.use_stable_diffusion_model needs to be a valid path
@@ -418,89 +470,369 @@ def is_model_reload_necessary(req: Request):
     return needs_model_reload
 
 def reload_model():
+    wait_for_prepare_stage() # It uses the models.
+    if weight_registry is not None and not thread_data.test_sd2:
+        # Acquire the next models before releasing the current ones, they could evict them from the model cache.
+        # Without a model cache, release first to not hold both in RAM.
+        previous_key = thread_data.model_cache_key
+        if model_cache is not None:
+            thread_data.model_cache_key = None
+        unload_models()
+        load_model_ckpt()
+        if model_cache is not None and previous_key is not None:
+            weight_registry.release(previous_key)
+        return
+    if model_cache is None or thread_data.model is None:
+        unload_models()
+        load_model_ckpt()
+        return
+    # Check out the next models before the current ones go back in the cache, they could evict them.
+    cached_models = model_cache.get(get_model_cache_key(thread_data.ckpt_file, thread_data.vae_file, thread_data.precision))
     unload_models()
-    unload_filters()
-    load_model_ckpt()
+    load_model_ckpt(cached_models, check_cache=False)
+
+class RenderJob(): # One Request sharing a sampler batch with other compatible requests.
+    def __init__(self, req: Request, data_queue: queue.Queue, task_temp_images: list, step_callback, task_output_images: list=None, output_url: str=None):
+        self.req: Request = req
+        self.data_queue: queue.Queue = data_queue
+        self.task_temp_images: list = task_temp_images
+        self.step_callback = step_callback
+        self.task_output_images: list = task_output_images # Final images as (buffer, mime type), served from output_url/index
+        self.output_url: str = output_url
+        self.batch_start: int = 0 # Index of the first sample owned by this job in the sampler batch.
+        self.stopped: bool = False # Cancelled jobs keep their partial samples, the rest of the batch keeps going.
+        self.partial_x_samples = None
+        self.response: Any = None
+        self.transfer_start: float = 0 # Device transfer_time when the job started.
+        self.preview_futures: list = [] # Previews still encoding on the post-processing pool.
+        self.stage_times: dict = {} # stage: seconds, reported in the response timings.
+        self.done_x_samples: list = [] # Samples of the completed sub-batches, see sample_in_sub_batches
+    @property
+    def batch_end(self) -> int:
+        return self.batch_start + self.req.num_outputs
 
 def mk_img(req: Request, data_queue: queue.Queue, task_temp_images: list, step_callback):
+    # Renders a single request and returns its response once the images are encoded and sent.
+    return mk_img_batch([RenderJob(req, data_queue, task_temp_images, step_callback)])[0].result()
+
+def mk_img_batch(jobs: list, next_requests: list = None):
+    '''
+    Render the jobs sharing a sampler batch, returns the Futures of their responses.
+    next_requests: Requests likely to be rendered next by this thread, prepared while this batch samples.
+    '''
     try:
-        return do_mk_img(req, data_queue, task_temp_images, step_callback)
+        return do_mk_img(jobs, next_requests)
     except Exception as e:
         print(traceback.format_exc())
+        wait_for_prepare_stage()
 
         if thread_data.device != 'cpu' and not thread_data.test_sd2:
-            thread_data.modelFS.to('cpu')
-            thread_data.modelCS.to('cpu')
+            thread_data.residency.offload_all()
             thread_data.model.model1.to("cpu")
             thread_data.model.model2.to("cpu")
 
         gc() # Release from memory.
-        data_queue.put(json.dumps({
-            "status": 'failed',
-            "detail": str(e)
-        }))
+        for job in jobs:
+            if job.response is not None:
+                job.response.exception() # Already handed to post-processing, wait until it is sent.
+                continue
+            job.data_queue.put(json.dumps({
+                "status": 'failed',
+                "detail": str(e)
+            }))
         raise e
 
-def update_temp_img(req, x_samples, task_temp_images: list):
-    partial_images = []
-    for i in range(req.num_outputs):
-        if thread_data.test_sd2:
-            x_sample_ddim = thread_data.model.decode_first_stage(x_samples[i].unsqueeze(0))
-        else:
-            x_sample_ddim = thread_data.modelFS.decode_first_stage(x_samples[i].unsqueeze(0))
-        x_sample = torch.clamp((x_sample_ddim + 1.0) / 2.0, min=0.0, max=1.0)
-        x_sample = 255.0 * rearrange(x_sample[0].cpu().numpy(), "c h w -> h w c")
-        x_sample = x_sample.astype(np.uint8)
-        img = Image.fromarray(x_sample)
+def latent_to_preview(x_samples, width, height):
+    # Approximate RGB from the latent channels, avoids running the VAE for previews.
+    rgb_factors = torch.tensor(LATENT_PREVIEW_RGB_FACTORS, dtype=x_samples.dtype, device=x_samples.device)
+    x_samples = torch.einsum('bchw,cr->brhw', x_samples, rgb_factors).float()
+    x_samples = torch.nn.functional.interpolate(x_samples, size=(height, width), mode='bilinear', align_corners=False)
+    x_samples = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
+    return (255.0 * x_samples).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+
+def get_first_stage_model():
+    return thread_data.model if thread_data.test_sd2 else thread_data.modelFS
+
+def decode_first_stage(x_samples):
+    model = get_first_stage_model()
+    if tiled_vae.should_tile(x_samples.shape[3] * tiled_vae.SCALE, x_samples.shape[2] * tiled_vae.SCALE, vae_tile_threshold):
+        return tiled_vae.decode_tiled(model, x_samples)
+    return model.decode_first_stage(x_samples)
+
+def encode_first_stage_moments(image):
+    # The mean and std of the first stage posterior concatenated, (b, 8, h / 8, w / 8), see sample_first_stage.
+    model = get_first_stage_model()
+    if tiled_vae.should_tile(image.shape[3], image.shape[2], vae_tile_threshold):
+        return tiled_vae.encode_moments_tiled(model, image)
+    posterior = model.encode_first_stage(image)
+    return torch.cat([posterior.mean, posterior.std], dim=1)
+
+def sample_first_stage(moments):
+    # Same as get_first_stage_encoding of the posterior, whose sample() draws the noise on the cpu.
+    mean, std = moments.chunk(2, dim=1)
+    return get_first_stage_model().get_first_stage_encoding(mean + std * torch.randn(mean.shape).to(device=moments.device))
+
+def decode_images(x_samples) -> list:
+    # Returns the decoded samples as (h, w, 3) uint8 arrays, decoding vae_decode_batch_size samples at a time.
+    batch_size = max(1, vae_decode_batch_size)
+    if tiled_vae.should_tile(x_samples.shape[3] * tiled_vae.SCALE, x_samples.shape[2] * tiled_vae.SCALE, vae_tile_threshold):
+        batch_size = 1 # Tiles keep the memory bounded, only for one sample at a time.
+    images = []
+    start = 0
+    while start < len(x_samples):
+        try:
+            x_samples_ddim = decode_first_stage(x_samples[start:start + batch_size])
+        except RuntimeError as e:
+            if not is_out_of_memory(e) or batch_size == 1:
+                raise
+            del e
+            gc()
+            batch_size = 1
+            print('Out of memory while decoding, decoding one sample at a time.')
+            continue
+        images.extend(to_host_images(x_samples_ddim, thread_data.pinned_buffer))
+        del x_samples_ddim
+        start += batch_size
+    return images
+
+def get_preview_images(req, x_samples) -> list:
+    # Runs on the render thread, returns the previews as uint8 arrays for update_temp_img.
+    if req.image_progress_mode != 'full':
+        return list(latent_to_preview(x_samples, int(req.width * req.image_progress_scale), int(req.height * req.image_progress_scale)))
+    return decode_images(x_samples)
+
+def update_temp_img(req, img_data: list, task_temp_images: list, temp_images: dict, offset=0):
+    # offset: Index of the first of img_data in the outputs of req, the previous ones are kept from earlier sub-batches.
+    # Only uses its arguments, runs on the post-processing pool.
+    partial_images = [{'path': f'/image/tmp/{req.session_id}/{i}'} for i in range(offset)]
+    preview_width = int(req.width * req.image_progress_scale)
+    preview_height = int(req.height * req.image_progress_scale)
+    for i in range(len(img_data)):
+        img = Image.fromarray(img_data[i])
+        if img.size != (preview_width, preview_height):
+            img = img.resize((preview_width, preview_height), resample=Image.Resampling.BILINEAR)
         buf = img_to_buffer(img, output_format='JPEG')
+        del img
 
-        del img, x_sample, x_sample_ddim
-        # don't delete x_samples, it is used in the code that called this callback
-
-        thread_data.temp_images[str(req.session_id) + '/' + str(i)] = buf
-        task_temp_images[i] = buf
-        partial_images.append({'path': f'/image/tmp/{req.session_id}/{i}'})
+        temp_images[str(req.session_id) + '/' + str(offset + i)] = buf
+        task_temp_images[offset + i] = buf
+        partial_images.append({'path': f'/image/tmp/{req.session_id}/{offset + i}'})
     return partial_images
 
+def send_preview(job: RenderJob, img_data: list, temp_images: dict, offset, progress: dict, preview_start_time):
+    try:
+        progress['output'] = update_temp_img(job.req, img_data, job.task_temp_images, temp_images, offset=offset)
+        progress['preview_time'] = time.time() - preview_start_time
+    except:
+        print(traceback.format_exc()) # Send the step without its preview.
+    job.data_queue.put(json.dumps(progress))
+
 # Build and return the apropriate generator for do_mk_img
-def get_image_progress_generator(req, data_queue: queue.Queue, task_temp_images: list, step_callback, extra_props=None):
-    if not req.stream_progress_updates:
+def get_image_progress_generator(jobs: list, extra_props=None, batch_offset=0, step_offset=0):
+    '''
+    batch_offset: Index of the first sample of the sub-batch in the sampler batch of the jobs.
+    step_offset: Steps done by the previous sub-batches.
+    '''
+    if not any(job.req.stream_progress_updates for job in jobs):
         def empty_callback(x_samples, i): return x_samples
         return empty_callback
 
-    thread_data.partial_x_samples = None
     last_callback_time = -1
     def img_callback(x_samples, i):
         nonlocal last_callback_time
 
-        thread_data.partial_x_samples = x_samples
         step_time = time.time() - last_callback_time if last_callback_time != -1 else -1
         last_callback_time = time.time()
 
-        progress = {"step": i, "step_time": step_time}
-        if extra_props is not None:
-            progress.update(extra_props)
+        for job in jobs:
+            if job.stopped or not job.req.stream_progress_updates:
+                continue
+            start = max(job.batch_start, batch_offset)
+            end = min(job.batch_end, batch_offset + len(x_samples))
+            if start < end: # Job has samples in this sub-batch.
+                job_x_samples = x_samples[start - batch_offset:end - batch_offset]
+                job.partial_x_samples = job_x_samples
+
+                progress = {"step": step_offset + i, "step_time": step_time}
+                if extra_props is not None:
+                    progress.update(extra_props)
+
+                job.preview_futures = [future for future in job.preview_futures if not future.done()]
+                # Skip the preview while the previous one is still encoding, the sampler does not wait for previews.
+                if job.req.stream_image_progress and i % job.req.image_progress_interval == 0 and len(job.preview_futures) == 0:
+                    preview_start_time = time.time()
+                    img_data = get_preview_images(job.req, job_x_samples)
+                    future = post_processing_pool.try_submit(send_preview, job, img_data, thread_data.temp_images, start - job.batch_start, progress, preview_start_time)
+                    if future is not None:
+                        job.preview_futures.append(future)
+                        progress = None # Sent with its preview.
+                    del img_data
 
-        if req.stream_image_progress and i % 5 == 0:
-            progress['output'] = update_temp_img(req, x_samples, task_temp_images)
+                if progress is not None:
+                    job.data_queue.put(json.dumps(progress))
 
-        data_queue.put(json.dumps(progress))
+            job.step_callback()
 
-        step_callback()
+            if thread_data.stop_processing: # Only stop this job, other jobs in the batch are still running.
+                thread_data.stop_processing = False
+                job.stopped = True
 
-        if thread_data.stop_processing:
+        if all(job.stopped for job in jobs):
             raise UserInitiatedStop("User requested that we stop processing")
     return img_callback
 
-def do_mk_img(req: Request, data_queue: queue.Queue, task_temp_images: list, step_callback):
-    thread_data.stop_processing = False
+def get_learned_conditioning(prompts: list):
+    '''
+    Text conditioning for each prompt, using a per-device LRU cache.
+    Each unique prompt is encoded at most once, the conditioning model is only moved to the device on cache misses.
+    '''
+    cache = thread_data.conditioning_cache
+    conds = {}
+    missing = []
+    for prompt in dict.fromkeys(prompts): # Unique prompts, keeps order.
+        key = (thread_data.ckpt_file, thread_data.model_is_half, prompt)
+        if key in cache:
+            cache.move_to_end(key)
+            conds[prompt] = cache[key]
+            thread_data.conditioning_cache_hits += 1
+        else:
+            missing.append(prompt)
+    if len(missing) > 0:
+        thread_data.conditioning_cache_misses += len(missing)
+        if thread_data.test_sd2:
+            missing_conds = thread_data.model.get_learned_conditioning(missing)
+        else:
+            thread_data.residency.acquire('cs')
+            missing_conds = thread_data.modelCS.get_learned_conditioning(missing)
+        for i, prompt in enumerate(missing):
+            conds[prompt] = missing_conds[i:i+1].clone()
+            cache[(thread_data.ckpt_file, thread_data.model_is_half, prompt)] = conds[prompt]
+            if len(cache) > CONDITIONING_CACHE_SIZE:
+                cache.popitem(last=False)
+        del missing_conds
+    return torch.cat([conds[prompt] for prompt in prompts])
+
+def get_init_moments(req: Request):
+    '''
+    The first stage posterior of the img2img init image of req, mean and std (1, 8, h / 8, w / 8) on the device.
+    Uses a per-device LRU cache keyed by the hash of the image data, skips decoding, resizing and encoding on hits.
+    The posterior is cached instead of a latent, sampling it depends on the seed of each job.
+    '''
+    cache = thread_data.init_latent_cache
+    image_hash = hashlib.sha256(req.init_image.encode('utf-8')).hexdigest()
+    key = (thread_data.ckpt_file, thread_data.vae_file, thread_data.model_fs_is_half, image_hash, req.width, req.height)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+
+    init_image = load_img(req.init_image, req.width, req.height)
+    init_image = init_image.to(thread_data.device)
 
-    res = Response()
-    res.request = req
-    res.images = []
+    if thread_data.device != "cpu" and thread_data.precision == "autocast":
+        init_image = init_image.half()
+
+    if not thread_data.test_sd2:
+        thread_data.residency.acquire('fs')
+    with torch.no_grad():
+        init_moments = encode_first_stage_moments(init_image) # move to latent space
+    if not thread_data.test_sd2:
+        thread_data.residency.release('fs')
+    del init_image
+
+    cache[key] = init_moments
+    if len(cache) > INIT_LATENT_CACHE_SIZE:
+        cache.popitem(last=False)
+    return init_moments
+
+def get_init_latent(req: Request):
+    # The img2img init image of req in latent space, (1, 4, h / 8, w / 8) on the device. Call after the seed of the job is set.
+    with torch.no_grad():
+        return sample_first_stage(get_init_moments(req))
+
+def get_conditioning(req: Request):
+    uc = None
+    if req.guidance_scale != 1.0:
+        uc = get_learned_conditioning(req.num_outputs * [req.negative_prompt])
+
+    subprompts, weights = split_weighted_subprompts(req.prompt)
+    if len(subprompts) > 1:
+        c = torch.zeros_like(uc)
+        totalWeight = sum(weights)
+        # normalize each "sub prompt" and add it
+        for i in range(len(subprompts)):
+            weight = weights[i]
+            # if not skip_normalize:
+            weight = weight / totalWeight
+            c = torch.add(c, get_learned_conditioning([subprompts[i]]), alpha=weight)
+    else:
+        c = get_learned_conditioning(req.num_outputs * [req.prompt])
+    return c, uc
+
+def record_stage(jobs: list, stage, start_time):
+    # Adds the time since start_time (time.perf_counter) to the stage times of the jobs.
+    elapsed = time.perf_counter() - start_time
+    for job in jobs:
+        job.stage_times[stage] = round(job.stage_times.get(stage, 0) + elapsed, 3)
+
+def start_prepare_stage(requests: list, reserved_size=0):
+    '''
+    Encode the prompts and init images of the next requests on a helper thread while the current batch samples,
+    the render thread then finds them in its conditioning and init latent caches.
+    The helper uses the models of the render thread, on the same device, only when they are already there
+    or fit without moving other models out. The render thread waits for it before changing models or caches.
+    reserved_size: bytes the sampler still has to move to the device, the helper leaves room for them.
+    '''
+    if not requests or thread_data.device == 'cpu':
+        return
+    if thread_data.prepare_executor is None:
+        thread_data.prepare_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'Prepare-{thread_data.device}')
+    # At most one prepare job per render thread, it waits for the previous one before starting a new one.
+    thread_data.prepare_future = thread_data.prepare_executor.submit(run_prepare_stage, dict(thread_data.__dict__), requests[:PREPARE_MAX_REQUESTS], reserved_size)
+
+def wait_for_prepare_stage():
+    future = thread_data.prepare_future
+    if future is None:
+        return
+    future.exception()
+    thread_data.prepare_future = None
+
+def run_prepare_stage(render_thread_data: dict, requests: list, reserved_size):
+    thread_data.__dict__.update(render_thread_data) # Same models, caches and residency as the render thread.
+    precision_scope = autocast if thread_data.precision == "autocast" else nullcontext
+    for req in requests:
+        start_time = time.perf_counter()
+        pinned = []
+        try:
+            if req.init_image is not None:
+                if thread_data.test_sd2 or thread_data.residency.try_acquire('fs', reserved_size):
+                    pinned.append('fs')
+                    get_init_moments(req) # Sampled after the seed is set, see get_init_latent.
+            if thread_data.test_sd2 or thread_data.residency.try_acquire('cs', reserved_size):
+                pinned.append('cs')
+                with torch.no_grad():
+                    with precision_scope("cuda"):
+                        get_conditioning(req)
+        except Exception as e:
+            print('Prepare stage failed for session', req.session_id, str(e)) # The render thread will do it.
+        finally:
+            if not thread_data.test_sd2:
+                for name in pinned:
+                    thread_data.residency.unpin(name)
+        print(f'Prepare stage for session {req.session_id} ({", ".join(pinned) or "skipped"}) took {round(time.perf_counter() - start_time, 3)}s on {thread_data.device}')
+
+def do_mk_img(jobs: list, next_requests: list = None):
+    stage_start = time.perf_counter()
+    wait_for_prepare_stage()
+    record_stage(jobs, 'prepare_wait', stage_start)
+
+    thread_data.stop_processing = False
 
     thread_data.temp_images.clear()
 
+    # All jobs share the sampler settings of the first request, see task_manager.get_batch_key
+    req = jobs[0].req
+    if len(jobs) > 1 and req.init_image is not None: raise ValueError('img2img requests can not share a sampler batch.')
+
     if thread_data.turbo != req.turbo and not thread_data.test_sd2:
         thread_data.turbo = req.turbo
         thread_data.model.turbo = req.turbo
@@ -508,23 +840,25 @@ def do_mk_img(req: Request, data_queue: queue.Queue, task_temp_images: list, ste
     # Start by cleaning memory, loading and unloading things can leave memory allocated.
     gc()
 
-    opt_prompt = req.prompt
+    for job in jobs:
+        job.transfer_start = thread_data.residency.transfer_time
+
     opt_seed = req.seed
-    opt_n_iter = 1
     opt_C = 4
     opt_f = 8
     opt_ddim_eta = 0.0
 
-    print(req, '\n    device', torch.device(thread_data.device), "as", thread_data.device_name)
+    batch_size = 0
+    for job in jobs:
+        job.batch_start = batch_size
+        batch_size += job.req.num_outputs
+        print(job.req, '\n    device', torch.device(thread_data.device), "as", thread_data.device_name)
     print('\n\n    Using precision:', thread_data.precision)
+    if len(jobs) > 1:
+        print(f'Rendering {len(jobs)} requests in one batch of {batch_size} samples.')
 
     seed_everything(opt_seed)
 
-    batch_size = req.num_outputs
-    prompt = opt_prompt
-    assert prompt is not None
-    data = [batch_size * [prompt]]
-
     if thread_data.precision == "autocast" and thread_data.device != "cpu":
         precision_scope = autocast
     else:
@@ -537,185 +871,384 @@ def do_mk_img(req: Request, data_queue: queue.Queue, task_temp_images: list, ste
 
         init_latent = None
         t_enc = None
+        start_code = get_start_code(jobs, opt_C, opt_f) if len(jobs) > 1 else None
     else:
         handler = _img2img
 
-        init_image = load_img(req.init_image, req.width, req.height)
-        init_image = init_image.to(thread_data.device)
-
-        if thread_data.device != "cpu" and thread_data.precision == "autocast":
-            init_image = init_image.half()
-
-        if not thread_data.test_sd2:
-            thread_data.modelFS.to(thread_data.device)
-
-        init_image = repeat(init_image, '1 ... -> b ...', b=batch_size)
-        if thread_data.test_sd2:
-            init_latent = thread_data.model.get_first_stage_encoding(thread_data.model.encode_first_stage(init_image))  # move to latent space
-        else:
-            init_latent = thread_data.modelFS.get_first_stage_encoding(thread_data.modelFS.encode_first_stage(init_image))  # move to latent space
+        # Every sample starts from the same latent, a view instead of encoding batch_size copies.
+        stage_start = time.perf_counter()
+        init_latent = get_init_latent(req).expand(batch_size, -1, -1, -1)
+        record_stage(jobs, 'init_latent', stage_start)
 
         if req.mask is not None:
             mask = load_mask(req.mask, req.width, req.height, init_latent.shape[2], init_latent.shape[3], True).to(thread_data.device)
             mask = mask[0][0].unsqueeze(0).repeat(4, 1, 1).unsqueeze(0)
-            mask = repeat(mask, '1 ... -> b ...', b=batch_size)
+            mask = mask.expand(batch_size, -1, -1, -1)
 
             if thread_data.device != "cpu" and thread_data.precision == "autocast":
                 mask = mask.half()
 
-        # Send to CPU and wait until complete.
-        # wait_model_move_to(thread_data.modelFS, 'cpu')
-        if not thread_data.test_sd2:
-            move_to_cpu(thread_data.modelFS)
-
         assert 0. <= req.prompt_strength <= 1., 'can only work with strength in [0.0, 1.0]'
         t_enc = int(req.prompt_strength * req.num_inference_steps)
         print(f"target t_enc is {t_enc} steps")
 
-    if req.save_to_disk_path is not None:
-        session_out_path = get_session_out_path(req.save_to_disk_path, req.session_id)
-    else:
-        session_out_path = None
-
     with torch.no_grad():
-        for n in trange(opt_n_iter, desc="Sampling"):
-            for prompts in tqdm(data, desc="data"):
-
-                with precision_scope("cuda"):
-                    if thread_data.reduced_memory and not thread_data.test_sd2:
-                        thread_data.modelCS.to(thread_data.device)
-                    uc = None
-                    if req.guidance_scale != 1.0:
-                        if thread_data.test_sd2:
-                            uc = thread_data.model.get_learned_conditioning(batch_size * [req.negative_prompt])
-                        else:
-                            uc = thread_data.modelCS.get_learned_conditioning(batch_size * [req.negative_prompt])
-                    if isinstance(prompts, tuple):
-                        prompts = list(prompts)
-
-                    subprompts, weights = split_weighted_subprompts(prompts[0])
-                    if len(subprompts) > 1:
-                        c = torch.zeros_like(uc)
-                        totalWeight = sum(weights)
-                        # normalize each "sub prompt" and add it
-                        for i in range(len(subprompts)):
-                            weight = weights[i]
-                            # if not skip_normalize:
-                            weight = weight / totalWeight
-                            if thread_data.test_sd2:
-                                c = torch.add(c, thread_data.model.get_learned_conditioning(subprompts[i]), alpha=weight)
-                            else:
-                                c = torch.add(c, thread_data.modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
-                    else:
-                        if thread_data.test_sd2:
-                            c = thread_data.model.get_learned_conditioning(prompts)
-                        else:
-                            c = thread_data.modelCS.get_learned_conditioning(prompts)
-
-                    if thread_data.reduced_memory and not thread_data.test_sd2:
-                        thread_data.modelFS.to(thread_data.device)
-
-                    n_steps = req.num_inference_steps if req.init_image is None else t_enc
-                    img_callback = get_image_progress_generator(req, data_queue, task_temp_images, step_callback, {"total_steps": n_steps})
-
-                    # run the handler
-                    try:
-                        print('Running handler...')
-                        if handler == _txt2img:
-                            x_samples = _txt2img(req.width, req.height, req.num_outputs, req.num_inference_steps, req.guidance_scale, None, opt_C, opt_f, opt_ddim_eta, c, uc, opt_seed, img_callback, mask, req.sampler)
-                        else:
-                            x_samples = _img2img(init_latent, t_enc, batch_size, req.guidance_scale, c, uc, req.num_inference_steps, opt_ddim_eta, opt_seed, img_callback, mask, opt_C, req.height, req.width, opt_f)
-                    except UserInitiatedStop:
-                        if not hasattr(thread_data, 'partial_x_samples'):
-                            continue
-                        if thread_data.partial_x_samples is None:
-                            del thread_data.partial_x_samples
-                            continue
-                        x_samples = thread_data.partial_x_samples
-                        del thread_data.partial_x_samples
-
-                    print("decoding images")
-                    img_data = [None] * batch_size
-                    for i in range(batch_size):
-                        if thread_data.test_sd2:
-                            x_samples_ddim = thread_data.model.decode_first_stage(x_samples[i].unsqueeze(0))
-                        else:
-                            x_samples_ddim = thread_data.modelFS.decode_first_stage(x_samples[i].unsqueeze(0))
-                        x_sample = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
-                        x_sample = 255.0 * rearrange(x_sample[0].cpu().numpy(), "c h w -> h w c")
-                        x_sample = x_sample.astype(np.uint8)
-                        img_data[i] = x_sample
-                    del x_samples, x_samples_ddim, x_sample
-
-                    print("saving images")
-                    for i in range(batch_size):
-                        img = Image.fromarray(img_data[i])
-                        img_id = base64.b64encode(int(time.time()+i).to_bytes(8, 'big')).decode() # Generate unique ID based on time.
-                        img_id = img_id.translate({43:None, 47:None, 61:None})[-8:] # Remove + / = and keep last 8 chars.
-
-                        has_filters =   (req.use_face_correction is not None and req.use_face_correction.startswith('GFPGAN')) or \
-                                        (req.use_upscale is not None and req.use_upscale.startswith('RealESRGAN'))
-
-                        return_orig_img = not has_filters or not req.show_only_filtered_image
-
-                        if thread_data.stop_processing:
-                            return_orig_img = True
-
-                        if req.save_to_disk_path is not None:
-                            if return_orig_img:
-                                img_out_path = get_base_path(req.save_to_disk_path, req.session_id, prompts[0], img_id, req.output_format)
-                                save_image(img, img_out_path)
-                            meta_out_path = get_base_path(req.save_to_disk_path, req.session_id, prompts[0], img_id, 'txt')
-                            save_metadata(meta_out_path, req, prompts[0], opt_seed)
-
-                        if return_orig_img:
-                            img_buffer = img_to_buffer(img, req.output_format)
-                            img_str = buffer_to_base64_str(img_buffer, req.output_format)
-                            res_image_orig = ResponseImage(data=img_str, seed=opt_seed)
-                            res.images.append(res_image_orig)
-                            task_temp_images[i] = img_buffer
-
-                            if req.save_to_disk_path is not None:
-                                res_image_orig.path_abs = img_out_path
-                        del img
-
-                        if has_filters and not thread_data.stop_processing:
-                            filters_applied = []
-                            if req.use_face_correction:
-                                img_data[i] = apply_filters('gfpgan', img_data[i], req.use_face_correction)
-                                filters_applied.append(req.use_face_correction)
-                            if req.use_upscale:
-                                img_data[i] = apply_filters('real_esrgan', img_data[i], req.use_upscale)
-                                filters_applied.append(req.use_upscale)
-                            if (len(filters_applied) > 0):
-                                filtered_image = Image.fromarray(img_data[i])
-                                filtered_buffer = img_to_buffer(filtered_image, req.output_format)
-                                filtered_img_data = buffer_to_base64_str(filtered_buffer, req.output_format)
-                                response_image = ResponseImage(data=filtered_img_data, seed=opt_seed)
-                                res.images.append(response_image)
-                                task_temp_images[i] = filtered_buffer
-                                if req.save_to_disk_path is not None:
-                                    filtered_img_out_path = get_base_path(req.save_to_disk_path, req.session_id, prompts[0], img_id, req.output_format, "_".join(filters_applied))
-                                    save_image(filtered_image, filtered_img_out_path)
-                                    response_image.path_abs = filtered_img_out_path
-                                del filtered_image
-                        # Filter Applied, move to next seed
-                        opt_seed += 1
-
-                    # if thread_data.reduced_memory:
-                    #     unload_filters()
-                    if not thread_data.test_sd2:
-                        move_to_cpu(thread_data.modelFS)
-                    del img_data
-                    gc()
-                    if thread_data.device != 'cpu':
-                        print(f'memory_final = {round(torch.cuda.memory_allocated(thread_data.device) / 1e6, 2)}Mb')
+        with precision_scope("cuda"):
+            stage_start = time.perf_counter()
+            c, uc = [], []
+            for job in jobs:
+                job_c, job_uc = get_conditioning(job.req)
+                c.append(job_c)
+                uc.append(job_uc)
+            c = torch.cat(c)
+            uc = torch.cat(uc) if uc[0] is not None else None
+            record_stage(jobs, 'text_encoding', stage_start)
+            print(f'Conditioning cache: {thread_data.conditioning_cache_hits} hits, {thread_data.conditioning_cache_misses} misses, {len(thread_data.conditioning_cache)} cached.')
+
+            if not thread_data.test_sd2:
+                thread_data.residency.release('cs')
+                # Room for the UNet, optimizedSD moves model1 and model2 one at a time unless turbo is on.
+                unet_size = get_model_size(thread_data.model) if thread_data.model.turbo else max(get_model_size(thread_data.model.model1), get_model_size(thread_data.model.model2))
+                thread_data.residency.make_room(unet_size)
+                if any(job.req.image_progress_mode == 'full' for job in jobs if job.req.stream_image_progress):
+                    thread_data.residency.acquire('fs') # Full previews decode with the VAE while sampling.
+            else:
+                unet_size = 0 # Already on the device.
+
+            n_steps = req.num_inference_steps if req.init_image is None else t_enc
+
+            def sample(start, end, img_callback):
+                # Samples start to end of the batch, the sampler seeds them from opt_seed + start.
+                sub_c = c[start:end]
+                sub_uc = uc[start:end] if uc is not None else None
+                sub_mask = mask[start:end] if mask is not None else None
+                if handler == _txt2img:
+                    sub_start_code = start_code[start:end] if start_code is not None else None
+                    return _txt2img(req.width, req.height, end - start, req.num_inference_steps, req.guidance_scale, sub_start_code, opt_C, opt_f, opt_ddim_eta, sub_c, sub_uc, opt_seed + start, img_callback, sub_mask, req.sampler)
+                return _img2img(init_latent[start:end], t_enc, end - start, req.guidance_scale, sub_c, sub_uc, req.num_inference_steps, opt_ddim_eta, opt_seed + start, img_callback, sub_mask, opt_C, req.height, req.width, opt_f)
+
+            start_prepare_stage(next_requests, unet_size)
+
+            # run the handler
+            stage_start = time.perf_counter()
+            try:
+                print('Running handler...')
+                sample_in_sub_batches(jobs, batch_size, n_steps, unet_size, uc is not None, sample)
+            except UserInitiatedStop:
+                pass
+            record_stage(jobs, 'sampling', stage_start)
+
+            if not thread_data.test_sd2:
+                thread_data.residency.acquire('fs')
+            for job in jobs:
+                parts = list(job.done_x_samples)
+                if job.stopped and job.partial_x_samples is not None:
+                    parts.append(job.partial_x_samples)
+                job_x_samples = torch.cat(parts) if len(parts) > 0 else None
+                job.done_x_samples = []
+                job.partial_x_samples = None
+                job.response = do_mk_img_outputs(job, job_x_samples)
+                del job_x_samples, parts
+
+            # if thread_data.reduced_memory:
+            #     unload_filters()
+            if not thread_data.test_sd2:
+                thread_data.residency.release('fs')
+            gc()
+            if thread_data.device != 'cpu':
+                print(f'memory_final = {round(torch.cuda.memory_allocated(thread_data.device) / 1e6, 2)}Mb')
 
     print('Task completed')
-    res = res.json()
-    data_queue.put(json.dumps(res))
+    return [job.response for job in jobs]
+
+def get_start_code(jobs: list, opt_C, opt_f):
+    '''
+    Starting noise of a batch of txt2img jobs, each sample seeded from the seed of its own job.
+    Seeded like the sampler does for a single request, one manual_seed and randn per sample from seed, seed + 1, ...
+    a request gets the same images rendered alone or in a batch.
+    '''
+    noise = []
+    for job in jobs:
+        req = job.req
+        for i in range(req.num_outputs):
+            torch.manual_seed(req.seed + i)
+            noise.append(torch.randn((1, opt_C, req.height // opt_f, req.width // opt_f), device=thread_data.device))
+    return torch.cat(noise)
+
+def is_out_of_memory(e: Exception) -> bool:
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+def get_sampler_plan(batch_size, width, height, unet_size, use_guidance):
+    '''
+    Returns (sub_batch_size, unet_bs) estimated to fit in the available memory of the device.
+    unet_size: bytes of UNet weights still to be moved to the device by the sampler.
+    Only an estimate, sample_in_sub_batches retries with smaller sizes when running out of memory.
+    '''
+    if thread_data.device == 'cpu':
+        return batch_size, thread_data.unet_bs
+    tokens = (width // 8) * (height // 8)
+    element_size = 2 if thread_data.model_is_half else 4
+    unet_sample_bytes = tokens * (UNET_ATTENTION_HEADS * UNET_ATTENTION_COPIES * tokens + UNET_ACTIVATION_ELEMENTS_PER_TOKEN) * element_size
+    sampler_sample_bytes = tokens * 4 * SAMPLER_STATE_COPIES * 4
+    available = int(thread_data.residency.get_available_memory() * SAMPLER_MEMORY_MARGIN) - unet_size
+
+    sub_batch_size = max(1, min(batch_size, (available - unet_sample_bytes) // sampler_sample_bytes))
+    # optimizedSD runs the UNet on the conditional and unconditional samples in chunks of unet_bs.
+    max_unet_bs = sub_batch_size * (2 if use_guidance else 1)
+    unet_bs = max(1, min(max_unet_bs, (available - sub_batch_size * sampler_sample_bytes) // unet_sample_bytes))
+    return int(sub_batch_size), int(unet_bs)
+
+def report_sampler_plan(jobs: list, batch_size, sub_batch_size, unet_bs, reason):
+    plan = {
+        'sub_batch_size': sub_batch_size,
+        'sub_batches': -(-batch_size // sub_batch_size),
+        'unet_bs': unet_bs,
+        'reason': reason,
+    }
+    print(f'Sampler plan on {thread_data.device}: {plan}')
+    for job in jobs:
+        if job.req.stream_progress_updates:
+            job.data_queue.put(json.dumps({'memory_plan': plan}))
+
+def sample_in_sub_batches(jobs: list, batch_size, n_steps, unet_size, use_guidance, sample):
+    '''
+    Run sample(start, end, img_callback) over sub-batches sized for the device memory,
+    the samples of each job are collected in job.done_x_samples.
+    On out of memory, the sub-batch is retried with a smaller UNet micro-batch, then a smaller sub-batch.
+    '''
+    req = jobs[0].req
+    sub_batch_size, unet_bs = get_sampler_plan(batch_size, req.width, req.height, unet_size, use_guidance)
+    report_sampler_plan(jobs, batch_size, sub_batch_size, unet_bs, 'estimate')
+    start = 0
+    steps_done = 0
+    while start < batch_size:
+        end = min(start + sub_batch_size, batch_size)
+        sub_jobs = [job for job in jobs if job.batch_start < end and job.batch_end > start]
+        if all(job.stopped for job in sub_jobs):
+            start = end
+            continue
+        if not thread_data.test_sd2:
+            thread_data.model.unet_bs = unet_bs
+        total_steps = steps_done + n_steps * -(-(batch_size - start) // sub_batch_size)
+        img_callback = get_image_progress_generator(jobs, {"total_steps": total_steps}, batch_offset=start, step_offset=steps_done)
+        try:
+            x_samples = sample(start, end, img_callback)
+        except RuntimeError as e:
+            if not is_out_of_memory(e) or (unet_bs <= 1 and end - start <= 1):
+                raise
+            print(f'Out of memory on {thread_data.device} with {end - start} samples and unet_bs {unet_bs}, retrying smaller.')
+            del e
+            for job in sub_jobs:
+                job.partial_x_samples = None
+            gc()
+            if unet_bs > 1:
+                unet_bs = max(1, unet_bs // 2)
+            else:
+                sub_batch_size = max(1, (end - start) // 2)
+            report_sampler_plan(jobs, batch_size, sub_batch_size, unet_bs, 'out of memory')
+            continue
+        for job in sub_jobs:
+            job.done_x_samples.append(x_samples[max(job.batch_start, start) - start:min(job.batch_end, end) - start])
+            job.partial_x_samples = None
+        del x_samples
+        steps_done += n_steps
+        start = end
+
+def get_filters(req: Request) -> list:
+    # Filter model names to apply to the outputs of req, in order.
+    return [model_name for model_name in (req.use_face_correction, req.use_upscale) if filter_service.get_filter_name(model_name) is not None]
+
+def do_mk_img_outputs(job: RenderJob, x_samples):
+    '''
+    Decodes the samples of job on the device and hands them to the filter worker of the device.
+    Returns a Future of the response, encoding and saving the images runs on the post-processing pool
+    and the render thread can start its next task.
+    '''
+    req = job.req
+    img_data = []
+    filter_future = None # Future of the filtered images.
+    if x_samples is not None:
+        print("decoding images")
+        stage_start = time.perf_counter()
+        img_data = decode_images(x_samples[:req.num_outputs])
+        del x_samples
+        record_stage([job], 'decode', stage_start)
+
+        filters = get_filters(req)
+        if len(filters) > 0 and not job.stopped:
+            filter_future = filter_service.submit(thread_data.device, img_data, filters, thread_data.model_is_half)
+
+    timings = get_job_timings(job)
+    print(f'Session {req.session_id} spent {timings["transfer"]}s moving models on {thread_data.device}')
+    return post_processing_pool.submit(finish_mk_img_outputs, job, img_data, filter_future, timings, time.perf_counter())
+
+def finish_mk_img_outputs(job: RenderJob, img_data: list, filter_future, timings: dict, submit_time):
+    # Runs on the post-processing pool, sends and returns the response JSON of job.
+    try:
+        record_stage([job], 'serialization_wait', submit_time)
+        filtered_data = [None] * len(img_data) # (image data, filters applied) of the filtered images.
+        if filter_future is not None:
+            stage_start = time.perf_counter()
+            filters = get_filters(job.req)
+            filtered_data = [(filtered, filters) for filtered in filter_future.result()]
+            record_stage([job], 'filters', stage_start) # Only the part not overlapped with the serialization_wait.
+
+        stage_start = time.perf_counter()
+        for future in job.preview_futures:
+            future.exception() # Wait, the previews are sent before the final response and must not overwrite its images.
+        job.preview_futures = []
+
+        req = job.req
+        res = Response()
+        res.request = req
+        res.images = []
+        res.timings = timings
+
+        print("saving images")
+        has_filters = len(get_filters(req)) > 0
+        return_orig_img = not has_filters or not req.show_only_filtered_image
+        if job.stopped:
+            return_orig_img = True
+
+        opt_seed = req.seed
+        for i in range(len(img_data)):
+            img = Image.fromarray(img_data[i])
+            img_id = base64.b64encode(int(time.time()+i).to_bytes(8, 'big')).decode() # Generate unique ID based on time.
+            img_id = img_id.translate({43:None, 47:None, 61:None})[-8:] # Remove + / = and keep last 8 chars.
+
+            if req.save_to_disk_path is not None:
+                if return_orig_img:
+                    img_out_path = get_base_path(req.save_to_disk_path, req.session_id, req.prompt, img_id, req.output_format)
+                    save_image(img, img_out_path)
+                meta_out_path = get_base_path(req.save_to_disk_path, req.session_id, req.prompt, img_id, 'txt')
+                save_metadata(meta_out_path, req, req.prompt, opt_seed)
+
+            if return_orig_img:
+                img_buffer = img_to_buffer(img, req.output_format)
+                res_image_orig = get_response_image(job, img_buffer, opt_seed)
+                res.images.append(res_image_orig)
+                job.task_temp_images[i] = img_buffer
+
+                if req.save_to_disk_path is not None:
+                    res_image_orig.path_abs = img_out_path
+            del img
+
+            if filtered_data[i] is not None:
+                filtered, filters_applied = filtered_data[i]
+                filtered_image = Image.fromarray(filtered)
+                filtered_buffer = img_to_buffer(filtered_image, req.output_format)
+                response_image = get_response_image(job, filtered_buffer, opt_seed)
+                res.images.append(response_image)
+                job.task_temp_images[i] = filtered_buffer
+                if req.save_to_disk_path is not None:
+                    filtered_img_out_path = get_base_path(req.save_to_disk_path, req.session_id, req.prompt, img_id, req.output_format, "_".join(filters_applied))
+                    save_image(filtered_image, filtered_img_out_path)
+                    response_image.path_abs = filtered_img_out_path
+                del filtered_image
+            # Filter Applied, move to next seed
+            opt_seed += 1
+
+        record_stage([job], 'serialization', stage_start)
+        print(f'Session {req.session_id} stage times: {job.stage_times}')
+        response = res.json()
+        job.data_queue.put(json.dumps(response))
+        return response
+    except Exception as e:
+        print(traceback.format_exc())
+        job.data_queue.put(json.dumps({
+            "status": 'failed',
+            "detail": str(e)
+        }))
+        raise e
 
-    return res
+def filter_images(job: RenderJob):
+    '''
+    Starts the FilterTaskRequest job on the filter task threads, no Stable Diffusion model is loaded.
+    Returns a Future of the response, the render thread goes back to the queue.
+    Call with a filter_task_slots slot acquired, task_manager releases it when the task completes.
+    '''
+    half = thread_data.device != 'cpu' and not job.req.use_full_precision and not thread_data.force_full_precision
+    return filter_task_executor.submit(run_filter_images, job, thread_data.device, half)
+
+def run_filter_images(job: RenderJob, device, half: bool):
+    '''
+    Runs on the filter task threads, sends the images in order as they are filtered and returns the response JSON.
+    Each image is a separate filter job, the filter worker batches them with the images of other tasks.
+    At most FILTER_TASK_WINDOW images are decoded or filtered ahead of the one being sent, the memory does not grow with the task size.
+    job.step_callback returns True once the task is stopped.
+    '''
+    req: FilterTaskRequest = job.req
+    pending = deque() # (index, Future of the filtered image) in order.
+    try:
+        res = Response()
+        res.request = req
+        res.images = []
+        res.timings = {'stages': job.stage_times}
+        next_index = 0
+        while next_index < len(req.init_images) or len(pending) > 0:
+            if job.step_callback():
+                job.stopped = True
+                break
+            stage_start = time.perf_counter()
+            while next_index < len(req.init_images) and len(pending) < FILTER_TASK_WINDOW:
+                img = np.array(base64_str_to_img(req.init_images[next_index]).convert("RGB"))
+                pending.append((next_index, filter_service.submit(device, [img], req.filters, half))) # Waits while the filter queue is full.
+                del img
+                next_index += 1
+            record_stage([job], 'load', stage_start)
+
+            i, future = pending.popleft()
+            stage_start = time.perf_counter()
+            filtered = future.result()[0]
+            record_stage([job], 'filters', stage_start)
+
+            stage_start = time.perf_counter()
+            filtered_image = Image.fromarray(filtered)
+            filtered_buffer = img_to_buffer(filtered_image, req.output_format)
+            response_image = get_response_image(job, filtered_buffer, None)
+            job.task_temp_images[i] = filtered_buffer
+            if req.save_to_disk_path is not None:
+                img_id = base64.b64encode(int(time.time()+i).to_bytes(8, 'big')).decode() # Generate unique ID based on time.
+                img_id = img_id.translate({43:None, 47:None, 61:None})[-8:] # Remove + / = and keep last 8 chars.
+                img_out_path = get_base_path(req.save_to_disk_path, req.session_id, req.name or 'filtered', img_id, req.output_format, "_".join(req.filters))
+                save_image(filtered_image, img_out_path)
+                response_image.path_abs = img_out_path
+            del filtered_image, filtered, future
+            res.images.append(response_image)
+            if req.stream_progress_updates:
+                job.data_queue.put(json.dumps({"step": i + 1, "total_steps": req.num_outputs, "image": response_image.json()}))
+            record_stage([job], 'serialization', stage_start)
+        for _, future in pending:
+            future.cancel() # Stopped, skipped by the filter worker when not started yet.
+
+        print(f'Session {req.session_id} stage times: {job.stage_times}')
+        response = res.json()
+        job.data_queue.put(json.dumps(response))
+        return response
+    except Exception as e:
+        print(traceback.format_exc())
+        for _, future in pending:
+            future.cancel()
+        job.data_queue.put(json.dumps({
+            "status": 'failed',
+            "detail": str(e)
+        }))
+        raise e
+
+def get_job_timings(job: RenderJob):
+    return {'transfer': round(thread_data.residency.transfer_time - job.transfer_start, 3), 'stages': job.stage_times}
+
+def get_response_image(job: RenderJob, img_buffer, seed):
+    # Keep the encoded image once in the task outputs, base64 data is only added for clients that ask for it.
+    req = job.req
+    img_data = None
+    if job.output_url is None or req.inline_output_images:
+        img_data = buffer_to_base64_str(img_buffer, req.output_format)
+    response_image = ResponseImage(data=img_data, seed=seed)
+    if job.output_url is not None:
+        job.task_output_images.append((img_buffer, get_mime_type(req.output_format)))
+        response_image.url = f'{job.output_url}/{len(job.task_output_images) - 1}'
+    return response_image
 
 def save_image(img, img_out_path):
     try:
@@ -747,12 +1280,6 @@ VAE model: {req.use_vae_model}
 def _txt2img(opt_W, opt_H, opt_n_samples, opt_ddim_steps, opt_scale, start_code, opt_C, opt_f, opt_ddim_eta, c, uc, opt_seed, img_callback, mask, sampler_name):
     shape = [opt_n_samples, opt_C, opt_H // opt_f, opt_W // opt_f]
 
-    # Send to CPU and wait until complete.
-    # wait_model_move_to(thread_data.modelCS, 'cpu')
-
-    if not thread_data.test_sd2:
-        move_to_cpu(thread_data.modelCS)
-
     if thread_data.test_sd2 and sampler_name not in ('plms', 'ddim', 'dpm2'):
         raise Exception('Only plms and ddim samplers are supported right now, in SD 2.0')
 
@@ -929,10 +1456,13 @@ def img_to_buffer(img, output_format="PNG"):
     buffered.seek(0)
     return buffered
 
+def get_mime_type(output_format="PNG"):
+    return "image/png" if output_format.lower() == "png" else "image/jpeg"
+
 def buffer_to_base64_str(buffered, output_format="PNG"):
     buffered.seek(0)
     img_byte = buffered.getvalue()
-    mime_type = "image/png" if output_format.lower() == "png" else "image/jpeg"
+    mime_type = get_mime_type(output_format)
     img_str = f"data:{mime_type};base64," + base64.b64encode(img_byte).decode()
     return img_str
 
@@ -8,13 +8,17 @@ import json
 import traceback
 
 TASK_TTL = 15 * 60 # seconds, Discard last session's task timeout
+TASK_CACHE_MAX_ITEMS = 1000 # Maximum number of sessions in the task cache.
+TASK_CACHE_MAX_BYTES = 1024**3 # Maximum bytes of task outputs kept in the task cache.
 
 import torch
-import queue, threading, time, weakref
-from typing import Any, Generator, Hashable, Optional, Union
+import asyncio, functools, heapq, itertools, queue, threading, time, weakref
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Generator, Hashable, List, Optional, Union
 
 from pydantic import BaseModel
-from sd_internal import Request, Response, runtime, device_manager
+from sd_internal import FilterTaskRequest, Request, Response, runtime, device_manager, filter_service
 
 THREAD_NAME_PREFIX = 'Runtime-Render/'
 ERR_LOCK_FAILED = ' failed to acquire lock within timeout.'
@@ -22,6 +26,13 @@ LOCK_TIMEOUT = 15 # Maximum locking time in seconds before failing a task.
 # It's better to get an exception than a deadlock... ALWAYS use timeout in critical paths.
 
 DEVICE_START_TIMEOUT = 60 # seconds - Maximum time to wait for a render device to init.
+IDLE_WAKE_TIMEOUT = 1 # seconds - Maximum time an idle render thread sleeps before checking its state again.
+# Not for new tasks, wake_render_thread signals those. A task left to the device that has its model loaded
+# becomes available to the others after MODEL_AFFINITY_WAIT without any event, and expired sessions are cleaned while idle.
+STREAM_KEEPALIVE_INTERVAL = 15 # seconds - Send a comment on idle Server-Sent Events streams to keep proxies from closing them.
+MODEL_AFFINITY_WAIT = 10 # seconds - Leave a task to the device that has its model loaded, unless it waited longer.
+MODEL_GROUP_MAX_WAIT = 60 # seconds - Prefer tasks for the loaded model until the oldest queued task waited longer.
+MODEL_RELOAD_WINDOW = 60 * 60 # seconds - Time window of the model reloads metric.
 
 class SymbolClass(type): # Print nicely formatted Symbol names.
     def __repr__(self): return self.__qualname__
@@ -35,22 +46,68 @@ class ServerStates:
     class Rendering(Symbol): pass
     class Unavailable(Symbol): pass
 
+class TaskBufferQueue(queue.Queue): # Queue that wakes asyncio readers when data is added or when the queue is closed.
+    def __init__(self):
+        super().__init__()
+        self.closed = False # Set when the task will not add anything more to the queue.
+        self._waiters = set()
+    def _put(self, item):
+        super()._put(item)
+        self._notify()
+    def _notify(self): # Call with self.mutex held.
+        for loop, event in self._waiters:
+            loop.call_soon_threadsafe(event.set)
+    def close(self):
+        with self.mutex:
+            self.closed = True
+            self._notify()
+    def add_waiter(self, waiter):
+        with self.mutex:
+            self._waiters.add(waiter)
+    def remove_waiter(self, waiter):
+        with self.mutex:
+            self._waiters.discard(waiter)
+
+# Browsers cache the output images by url, ids are never reused, also after a restart.
+task_ids = itertools.count(time.time_ns() // 1000)
+
 class RenderTask(): # Task with output queue and completion lock.
     def __init__(self, req: Request):
+        self.task_id: int = next(task_ids) # Used in the stream and output image urls.
         self.request: Request = req # Initial Request
         self.response: Any = None # Copy of the last reponse
         self.render_device = None # Select the task affinity. (Not used to change active devices).
         self.temp_images:list = [None] * req.num_outputs * (1 if req.show_only_filtered_image else 2)
+        self.output_images:list = [] # Final images as (buffer, mime type), served by /image/output
         self.error: Exception = None
         self.lock: threading.Lock = threading.Lock() # Locks at task start and unlocks when task is completed
-        self.buffer_queue: queue.Queue = queue.Queue() # Queue of JSON string segments
-    async def read_buffer_generator(self):
+        self.buffer_queue: TaskBufferQueue = TaskBufferQueue() # Queue of JSON string segments
+        self.enqueue_time: float = None # time.time() when added to tasks_queue, used to report dispatch latency.
+    def is_done(self) -> bool:
+        return not self.lock.locked() and (self.response is not None or self.error is not None)
+    async def read_buffer_generator(self, sse:bool=False):
+        # Stays open until the task is completed, failed or cancelled.
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = (loop, event)
+        self.buffer_queue.add_waiter(waiter)
         try:
-            while not self.buffer_queue.empty():
-                res = self.buffer_queue.get(block=False)
-                self.buffer_queue.task_done()
-                yield res
-        except queue.Empty as e: yield
+            while True:
+                event.clear() # Clear before reading, data added while reading will set the event again.
+                try:
+                    while True:
+                        res = self.buffer_queue.get(block=False)
+                        self.buffer_queue.task_done()
+                        yield f'data: {res}\n\n' if sse else res
+                except queue.Empty: pass
+                if self.buffer_queue.empty() and (self.buffer_queue.closed or self.is_done()):
+                    return
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=STREAM_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    if sse: yield ': keep-alive\n\n'
+        finally:
+            self.buffer_queue.remove_waiter(waiter)
 
 # defaults from https://huggingface.co/blog/stable_diffusion
 class ImageRequest(BaseModel):
@@ -79,15 +136,20 @@ class ImageRequest(BaseModel):
     use_vae_model: str = None
     show_only_filtered_image: bool = False
     output_format: str = "jpeg" # or "png"
+    inline_output_images: bool = False # Also send base64 data, for clients that can't download from the image url.
 
     stream_progress_updates: bool = False
     stream_image_progress: bool = False
+    image_progress_interval: int = 5 # steps between preview images
+    image_progress_mode: str = "latent" # or "full" to decode previews with the VAE
+    image_progress_scale: float = 0.5 # preview size relative to the output size
 
 class FilterRequest(BaseModel):
     session_id: str = "session"
-    model: str = None
+    model: Union[str, List[str]] = None # "GFPGANv1.3", "RealESRGAN_x4plus" or "RealESRGAN_x4plus_anime_6B", or a list applied in order.
     name: str = ""
     init_image: str = None # base64
+    init_images: List[str] = None # base64, filtered after init_image with the same models.
     width: int = 512
     height: int = 512
     save_to_disk_path: str = None
@@ -95,41 +157,87 @@ class FilterRequest(BaseModel):
     render_device: str = None
     use_full_precision: bool = False
     output_format: str = "jpeg" # or "png"
+    inline_output_images: bool = False # Also send base64 data, for clients that can't download from the image url.
+    stream_progress_updates: bool = False # Send each image as soon as it is filtered.
 
 # Temporary cache to allow to query tasks results for a short time after they are completed.
 class TaskCache():
-    def __init__(self):
-        self._base = dict()
+    '''
+    Expiry is tracked with a min-heap of (expire time, key) using lazy deletion,
+    entries refreshed by keep are only rescheduled when their old expire time is reached.
+    When max_items or max_bytes is exceeded, the least recently used entries accepted by can_evict are removed.
+    '''
+    def __init__(self, max_items:int=0, max_bytes:int=0, get_size:Callable[[Any], int]=None, can_evict:Callable[[Any], bool]=None):
+        self._base = OrderedDict() # key: (expire time, value), least recently used first.
+        self._expiry = [] # Min-heap of (expire time, counter, key), may contain outdated entries.
+        self._counter = itertools.count() # Tie-breaker, keys don't need to be comparable.
+        self._sizes = dict()
+        self._total_size = 0
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._get_size = get_size
+        self._can_evict = can_evict
         self._lock: threading.Lock = threading.Lock()
     def _get_ttl_time(self, ttl: int) -> int:
         return int(time.time()) + ttl
     def _is_expired(self, timestamp: int) -> bool:
         return int(time.time()) >= timestamp
+    def _schedule(self, key: Hashable, timestamp: int) -> None:
+        heapq.heappush(self._expiry, (timestamp, next(self._counter), key))
+    def _remove(self, key: Hashable) -> None:
+        del self._base[key]
+        self._total_size -= self._sizes.pop(key, 0)
+    def _update_size(self, key: Hashable, value: Any) -> None:
+        if self._get_size is None:
+            return
+        size = self._get_size(value)
+        self._total_size += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+    def _remove_expired(self) -> None:
+        now = int(time.time())
+        while self._expiry and self._expiry[0][0] <= now:
+            _, _, key = heapq.heappop(self._expiry)
+            if key not in self._base:
+                continue # Already deleted.
+            ttl, _ = self._base[key]
+            if not self._is_expired(ttl):
+                self._schedule(key, ttl) # Kept alive since it was scheduled.
+                continue
+            self._remove(key)
+            print(f'Session {key} expired. Data removed.')
+    def _evict(self) -> None:
+        def is_over_limits():
+            return (self._max_items > 0 and len(self._base) > self._max_items) or (self._max_bytes > 0 and self._total_size > self._max_bytes)
+        if not is_over_limits():
+            return
+        for key in list(self._base.keys()):
+            _, value = self._base[key]
+            if self._can_evict is not None and not self._can_evict(value):
+                continue
+            self._remove(key)
+            print(f'Session {key} evicted. Cache items: {len(self._base)}, size: {round(self._total_size / 1e6, 2)}Mb')
+            if not is_over_limits():
+                return
     def clean(self) -> None:
         if not self._lock.acquire(blocking=True, timeout=LOCK_TIMEOUT): raise Exception('TaskCache.clean' + ERR_LOCK_FAILED)
         try:
-            # Create a list of expired keys to delete
-            to_delete = []
-            for key in self._base:
-                ttl, _ = self._base[key]
-                if self._is_expired(ttl):
-                    to_delete.append(key)
-            # Remove Items
-            for key in to_delete:
-                del self._base[key]
-                print(f'Session {key} expired. Data removed.')
+            self._remove_expired()
         finally:
             self._lock.release()
     def clear(self) -> None:
         if not self._lock.acquire(blocking=True, timeout=LOCK_TIMEOUT): raise Exception('TaskCache.clear' + ERR_LOCK_FAILED)
-        try: self._base.clear()
+        try:
+            self._base.clear()
+            self._expiry.clear()
+            self._sizes.clear()
+            self._total_size = 0
         finally: self._lock.release()
     def delete(self, key: Hashable) -> bool:
         if not self._lock.acquire(blocking=True, timeout=LOCK_TIMEOUT): raise Exception('TaskCache.delete' + ERR_LOCK_FAILED)
         try:
             if key not in self._base:
                 return False
-            del self._base[key]
+            self._remove(key)
             return True
         finally:
             self._lock.release()
@@ -137,8 +245,14 @@ class TaskCache():
         if not self._lock.acquire(blocking=True, timeout=LOCK_TIMEOUT): raise Exception('TaskCache.keep' + ERR_LOCK_FAILED)
         try:
             if key in self._base:
-                _, value = self._base.get(key)
-                self._base[key] = (self._get_ttl_time(ttl), value)
+                old_ttl, value = self._base.get(key)
+                timestamp = self._get_ttl_time(ttl)
+                self._base[key] = (timestamp, value)
+                self._base.move_to_end(key)
+                if timestamp < old_ttl:
+                    self._schedule(key, timestamp)
+                self._update_size(key, value)
+                self._evict()
                 return True
             return False
         finally:
@@ -146,9 +260,17 @@ class TaskCache():
     def put(self, key: Hashable, value: Any, ttl: int) -> bool:
         if not self._lock.acquire(blocking=True, timeout=LOCK_TIMEOUT): raise Exception('TaskCache.put' + ERR_LOCK_FAILED)
         try:
+            self._remove_expired()
+            timestamp = self._get_ttl_time(ttl)
+            old_ttl, _ = self._base.get(key, (None, None))
             self._base[key] = (
-                self._get_ttl_time(ttl), value
+                timestamp, value
             )
+            self._base.move_to_end(key)
+            if old_ttl is None or timestamp < old_ttl:
+                self._schedule(key, timestamp)
+            self._update_size(key, value)
+            self._evict()
         except Exception as e:
             print(str(e))
             print(traceback.format_exc())
@@ -163,12 +285,31 @@ class TaskCache():
             ttl, value = self._base.get(key, (None, None))
             if ttl is not None and self._is_expired(ttl):
                 print(f'Session {key} expired. Discarding data.')
-                del self._base[key]
+                self._remove(key)
                 return None
+            if ttl is not None:
+                self._base.move_to_end(key)
             return value
         finally:
             self._lock.release()
 
+def get_task_size(task: RenderTask) -> int:
+    # Bytes held by the task outputs, image buffers and base64 images in the cached response.
+    size = 0
+    # Final images are in both temp_images and output_images, only count each buffer once.
+    img_buffers = {id(img_buffer): img_buffer for img_buffer in task.temp_images if img_buffer is not None}
+    img_buffers.update({id(img_buffer): img_buffer for img_buffer, _ in task.output_images})
+    for img_buffer in img_buffers.values():
+        size += img_buffer.getbuffer().nbytes
+    if isinstance(task.response, dict):
+        for image in task.response.get('output', []):
+            size += len(image.get('data') or '')
+    return size
+
+def is_task_evictable(task: RenderTask) -> bool:
+    # Never evict pending or running tasks, the session would lose track of them.
+    return task.error is not None or (task.response is not None and not task.lock.locked())
+
 manager_lock = threading.RLock()
 render_threads = []
 current_state = ServerStates.Init
@@ -176,10 +317,18 @@ current_state_error:Exception = None
 current_model_path = None
 current_vae_path = None
 tasks_queue = []
-task_cache = TaskCache()
+task_cache = TaskCache(max_items=TASK_CACHE_MAX_ITEMS, max_bytes=TASK_CACHE_MAX_BYTES, get_size=get_task_size, can_evict=is_task_evictable)
 default_model_to_load = None
 default_vae_to_load = None
+max_batch_size = 1 # Maximum number of samples in a sampler batch shared by compatible tasks. 1 disables batching.
+max_batch_wait = 0 # seconds - Maximum time to wait for more compatible tasks before starting a batch.
+filter_devices = set() # Devices that only run filter tasks, they never load a Stable Diffusion model.
 weak_thread_data = weakref.WeakKeyDictionary()
+model_reload_times = deque() # Time of the model reloads in the last MODEL_RELOAD_WINDOW.
+model_reload_count = 0
+model_prefetch_count = 0
+prefetch_futures = {} # (ckpt_file, vae_file): Future of a running prefetch.
+prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ModelPrefetch')
 
 def preload_model(ckpt_file_path=None, vae_file_path=None):
     global current_state, current_state_error, current_model_path, current_vae_path
@@ -215,8 +364,18 @@ def thread_get_next_task():
         manager_lock.release()
         return None
     task = None
+    filter_slot = runtime.filter_task_slots.acquire(blocking=False) # Kept by the filter task returned, if any.
     try:  # Select a render task.
+        eligible_tasks = []
         for queued_task in tasks_queue:
+            if is_filter_task(queued_task) and not filter_slot:
+                continue # Left queued until a running filter task completes.
+            if runtime.thread_data.device in filter_devices and not is_filter_task(queued_task):
+                if queued_task.render_device == runtime.thread_data.device:
+                    queued_task.error = Exception(queued_task.render_device + ' only runs filter tasks.')
+                    task = queued_task
+                    break
+                continue # Leave the task to the other devices.
             if queued_task.render_device and runtime.thread_data.device != queued_task.render_device:
                 # Is asking for a specific render device.
                 if is_alive(queued_task.render_device) > 0:
@@ -226,17 +385,222 @@ def thread_get_next_task():
                     queued_task.error = Exception(queued_task.render_device + ' is not currently active.')
                     task = queued_task
                     break
-            if not queued_task.render_device and runtime.thread_data.device == 'cpu' and is_alive() > 1:
+            if not queued_task.render_device and runtime.thread_data.device == 'cpu' and (is_alive() if is_filter_task(queued_task) else get_render_device_count()) > 1:
                 # not asking for any specific devices, cpu want to grab task but other render devices are alive.
                 continue  # Skip Tasks, don't run on CPU unless there is nothing else or user asked for it.
-            task = queued_task
-            break
+            eligible_tasks.append(queued_task)
+        if task is None and len(eligible_tasks) > 0:
+            task = thread_select_task(eligible_tasks)
         if task is not None:
             del tasks_queue[tasks_queue.index(task)]
         return task
     finally:
+        if filter_slot and (task is None or not is_filter_task(task)):
+            runtime.filter_task_slots.release()
         manager_lock.release()
 
+def is_filter_task(task: RenderTask) -> bool:
+    return isinstance(task.request, FilterTaskRequest)
+
+def get_model_key(task: RenderTask):
+    # None for filter tasks, they run on any device without loading a model.
+    if is_filter_task(task):
+        return None
+    return (task.request.use_stable_diffusion_model, task.request.use_vae_model)
+
+def get_loaded_model_keys(exclude_thread=None):
+    # Call with manager_lock held. Returns {model_key: [weak_data of the threads that have it loaded]}
+    loaded_models = {}
+    for rthread in render_threads:
+        if rthread is exclude_thread or not rthread.is_alive():
+            continue
+        weak_data = weak_thread_data.get(rthread)
+        if not weak_data or weak_data.get('model_key') is None:
+            continue
+        loaded_models.setdefault(weak_data['model_key'], []).append(weak_data)
+    return loaded_models
+
+def thread_select_task(eligible_tasks: list):
+    '''
+    Call with manager_lock held. eligible_tasks in queue order, all can run on the current thread.
+    Prefer tasks for the model already loaded on this device, grouping them to avoid reloads,
+    and leave tasks for a model loaded on another device to that device. Filter tasks need no model.
+    The oldest task is taken regardless of models once it waited too long.
+    '''
+    now = time.time()
+    def get_wait_time(task):
+        return now - task.enqueue_time if task.enqueue_time else 0
+    oldest_task = eligible_tasks[0]
+    if get_wait_time(oldest_task) > MODEL_GROUP_MAX_WAIT:
+        return oldest_task
+    current_thread = threading.current_thread()
+    weak_data = weak_thread_data.get(current_thread, {})
+    model_key = weak_data.get('model_key')
+    for task in eligible_tasks:
+        if get_model_key(task) == model_key or is_filter_task(task):
+            return task
+    other_models = get_loaded_model_keys(exclude_thread=current_thread)
+    for task in eligible_tasks:
+        if not task.render_device and get_model_key(task) in other_models and get_wait_time(task) < MODEL_AFFINITY_WAIT:
+            continue # Another device has this model loaded and will pick it up.
+        return task
+    return None
+
+def schedule_model_prefetch(model_key):
+    '''
+    Start loading in host RAM the model of the next queued task this thread is likely to render,
+    while the current batch renders. Skipped when that model is already loaded on a device.
+    '''
+    from . import runtime
+    if runtime.model_cache is None or runtime.thread_data.test_sd2:
+        return
+    if not manager_lock.acquire(blocking=True, timeout=LOCK_TIMEOUT):
+        print('Render thread on device', runtime.thread_data.device, 'failed to acquire manager lock.')
+        return
+    try:
+        loaded_models = get_loaded_model_keys()
+        next_task = None
+        for queued_task in tasks_queue:
+            if queued_task.render_device and runtime.thread_data.device != queued_task.render_device:
+                continue
+            next_model_key = get_model_key(queued_task)
+            if next_model_key is not None and next_model_key != model_key and next_model_key not in loaded_models:
+                next_task = queued_task
+                break
+        if next_task is None or next_model_key in prefetch_futures:
+            return
+        req = next_task.request
+        precision = 'full' if req.use_full_precision or runtime.thread_data.force_full_precision else 'autocast'
+        future = prefetch_executor.submit(prefetch_model, next_model_key, runtime.thread_data.device, precision)
+        prefetch_futures[next_model_key] = future
+    finally:
+        manager_lock.release()
+
+def get_next_requests(model_key):
+    '''
+    Queued requests this thread can render next without a model reload,
+    their prompts and init images are encoded while the current batch samples.
+    '''
+    from . import runtime
+    if not manager_lock.acquire(blocking=True, timeout=LOCK_TIMEOUT):
+        print('Render thread on device', runtime.thread_data.device, 'failed to acquire manager lock.')
+        return []
+    try:
+        next_requests = []
+        for queued_task in tasks_queue:
+            if queued_task.render_device and runtime.thread_data.device != queued_task.render_device:
+                continue
+            if is_filter_task(queued_task):
+                continue
+            req = queued_task.request
+            precision = 'full' if req.use_full_precision or runtime.thread_data.force_full_precision else 'autocast'
+            if get_model_key(queued_task) == model_key and precision == runtime.thread_data.precision:
+                next_requests.append(req)
+            if len(next_requests) >= runtime.PREPARE_MAX_REQUESTS:
+                break
+        return next_requests
+    finally:
+        manager_lock.release()
+
+def prefetch_model(model_key, device, precision):
+    global model_prefetch_count
+    from . import runtime
+    try:
+        if runtime.prefetch_model(*model_key, device, precision):
+            model_prefetch_count += 1
+    except:
+        print(traceback.format_exc())
+    finally:
+        if not manager_lock.acquire(blocking=True, timeout=LOCK_TIMEOUT): raise Exception('prefetch_model' + ERR_LOCK_FAILED)
+        try:
+            del prefetch_futures[model_key]
+        finally:
+            manager_lock.release()
+
+def wait_for_model_prefetch(model_key):
+    # A model being prefetched will be in the model cache, wait for it instead of loading it twice.
+    if not manager_lock.acquire(blocking=True, timeout=LOCK_TIMEOUT): raise Exception('wait_for_model_prefetch' + ERR_LOCK_FAILED)
+    try:
+        future: Future = prefetch_futures.get(model_key)
+    finally:
+        manager_lock.release()
+    if future is not None:
+        print('Waiting for the prefetch of', model_key)
+        future.result()
+
+def record_model_reload():
+    global model_reload_count
+    now = time.time()
+    model_reload_count += 1
+    model_reload_times.append(now)
+    while model_reload_times and model_reload_times[0] < now - MODEL_RELOAD_WINDOW:
+        model_reload_times.popleft()
+
+def get_model_stats():
+    now = time.time()
+    return {
+        'reloads': model_reload_count,
+        'reloads_last_hour': len([t for t in tuple(model_reload_times) if t >= now - MODEL_RELOAD_WINDOW]),
+        'prefetches': model_prefetch_count,
+    }
+
+def get_batch_key(task: RenderTask):
+    '''
+    Tasks with the same key can be rendered by the same sampler call. None when the task can't be batched.
+    Each task keeps its seed, the batch starts from the noise of every task's own seeds.
+    Limitation: the guidance scale stays in the key. The optimizedSD and ldm samplers compare
+    unconditional_guidance_scale to 1. as a number, a per-sample tensor scale fails there,
+    so only tasks with the same guidance scale share a batch.
+    Ancestral samplers draw new noise from the batch at every step, they are not batched to keep the results reproducible.
+    '''
+    req = task.request
+    if is_filter_task(task) or req.init_image is not None or req.mask is not None or req.sampler in ('euler_a', 'dpm2_a'):
+        return None
+    return (req.use_stable_diffusion_model, req.use_vae_model, req.use_full_precision, req.turbo, req.sampler, req.num_inference_steps, req.width, req.height, req.guidance_scale)
+
+def thread_get_batch_tasks(task: RenderTask, wake_event: threading.Event):
+    '''
+    Collect queued tasks that can share the sampler batch of task.
+    Waits up to max_batch_wait seconds for more compatible tasks while the batch is not full.
+    '''
+    from . import runtime
+    batch_key = get_batch_key(task)
+    if batch_key is None or task.request.num_outputs >= max_batch_size:
+        return []
+    weak_data = weak_thread_data[threading.current_thread()]
+    batch = []
+    batch_size = task.request.num_outputs
+    wait_until = time.time() + max_batch_wait
+    weak_data['batch_key'] = batch_key
+    try:
+        while True:
+            wake_event.clear()
+            if not manager_lock.acquire(blocking=True, timeout=LOCK_TIMEOUT):
+                print('Render thread on device', runtime.thread_data.device, 'failed to acquire manager lock.')
+                break
+            try:
+                for queued_task in list(tasks_queue):
+                    if batch_size + queued_task.request.num_outputs > max_batch_size:
+                        continue
+                    if queued_task.error is not None or get_batch_key(queued_task) != batch_key:
+                        continue
+                    if queued_task.render_device and runtime.thread_data.device != queued_task.render_device:
+                        continue
+                    if not queued_task.render_device and runtime.thread_data.device == 'cpu' and get_render_device_count() > 1:
+                        continue
+                    tasks_queue.remove(queued_task)
+                    batch.append(queued_task)
+                    batch_size += queued_task.request.num_outputs
+            finally:
+                manager_lock.release()
+            remaining = wait_until - time.time()
+            if batch_size >= max_batch_size or remaining <= 0 or current_state_error:
+                break
+            wake_event.wait(timeout=remaining)
+    finally:
+        weak_data['batch_key'] = None
+    return batch
+
 def thread_render(device):
     global current_state, current_state_error, current_model_path, current_vae_path
     from . import runtime
@@ -248,17 +612,30 @@ def thread_render(device):
             'error': e
         }
         return
-    weak_thread_data[threading.current_thread()] = {
+    wake_event = threading.Event() # Set by wake_render_thread when a task is queued for this thread.
+    weak_data = {
         'device': runtime.thread_data.device,
         'device_name': runtime.thread_data.device_name,
-        'alive': True
+        'alive': True,
+        'idle': False,
+        'batch_key': None, # Set while waiting for compatible tasks to batch with.
+        'wake_event': wake_event,
+        'model_key': None, # (ckpt_file, vae_file) loaded on this device.
     }
-    if runtime.thread_data.device != 'cpu' or is_alive() == 1:
+    weak_thread_data[threading.current_thread()] = weak_data
+    if runtime.thread_data.device in filter_devices:
+        current_state = ServerStates.Online
+    elif runtime.thread_data.device != 'cpu' or get_render_device_count() == 1:
         preload_model()
+        if runtime.thread_data.model is not None:
+            weak_data['model_key'] = (runtime.thread_data.ckpt_file, runtime.thread_data.vae_file)
         current_state = ServerStates.Online
     while True:
+        # Mark as idle before looking at the queue, tasks added after this point will set the wake_event.
+        weak_data['idle'] = True
+        wake_event.clear()
         task_cache.clean()
-        if not weak_thread_data[threading.current_thread()]['alive']:
+        if not weak_data['alive']:
             print(f'Shutting down thread for device {runtime.thread_data.device}')
             runtime.unload_models()
             runtime.unload_filters()
@@ -268,57 +645,130 @@ def thread_render(device):
             return
         task = thread_get_next_task()
         if task is None:
-            time.sleep(0.05)
+            wake_event.wait(timeout=IDLE_WAKE_TIMEOUT)
             continue
+        weak_data['idle'] = False
+        if is_filter_task(task) and (task.error is not None or current_state_error):
+            release_filter_slot()
         if task.error is not None:
             print(task.error)
             task.response = {"status": 'failed', "detail": str(task.error)}
             task.buffer_queue.put(json.dumps(task.response))
+            task.buffer_queue.close()
             continue
         if current_state_error:
             task.error = current_state_error
             task.response = {"status": 'failed', "detail": str(task.error)}
             task.buffer_queue.put(json.dumps(task.response))
+            task.buffer_queue.close()
+            continue
+        tasks = [task] + thread_get_batch_tasks(task, wake_event)
+        for task in tasks:
+            queued_time = time.time() - task.enqueue_time if task.enqueue_time else 0
+            print(f'Session {task.request.session_id} starting task {task.task_id} on {runtime.thread_data.device_name} after {round(queued_time, 3)}s in queue')
+            if not task.lock.acquire(blocking=False): raise Exception('Got locked task from queue.')
+        task = tasks[0] # All tasks in the batch share the same model and sampler settings.
+        if is_filter_task(task):
+            thread_filter(task)
             continue
-        print(f'Session {task.request.session_id} starting task {id(task)} on {runtime.thread_data.device_name}')
-        if not task.lock.acquire(blocking=False): raise Exception('Got locked task from queue.')
         try:
             if runtime.is_model_reload_necessary(task.request):
                 current_state = ServerStates.LoadingModel
+                weak_data['model_key'] = None
+                wait_for_model_prefetch(get_model_key(task))
                 runtime.reload_model()
+                record_model_reload()
                 current_model_path = task.request.use_stable_diffusion_model
                 current_vae_path = task.request.use_vae_model
-
-            def step_callback():
-                global current_state_error
-
-                if isinstance(current_state_error, SystemExit) or isinstance(current_state_error, StopAsyncIteration) or isinstance(task.error, StopAsyncIteration):
-                    runtime.thread_data.stop_processing = True
-                    if isinstance(current_state_error, StopAsyncIteration):
-                        task.error = current_state_error
-                        current_state_error = None
-                        print(f'Session {task.request.session_id} sent cancel signal for task {id(task)}')
-
-                    task_cache.keep(task.request.session_id, TASK_TTL)
+                weak_data['model_key'] = get_model_key(task)
+            schedule_model_prefetch(get_model_key(task))
 
             current_state = ServerStates.Rendering
-            task.response = runtime.mk_img(task.request, task.buffer_queue, task.temp_images, step_callback)
+            jobs = [runtime.RenderJob(batch_task.request, batch_task.buffer_queue, batch_task.temp_images, get_step_callback(batch_task, tasks),
+                task_output_images=batch_task.output_images, output_url=f'/image/output/{batch_task.request.session_id}/{batch_task.task_id}') for batch_task in tasks]
+            futures = runtime.mk_img_batch(jobs, get_next_requests(get_model_key(task)))
         except Exception as e:
-            task.error = e
+            for batch_task in tasks:
+                batch_task.error = e
+                complete_task(batch_task, runtime.thread_data.device_name)
             print(traceback.format_exc())
             continue
-        finally:
-            # Task completed
-            task.lock.release()
-        task_cache.keep(task.request.session_id, TASK_TTL)
-        if isinstance(task.error, StopAsyncIteration):
-            print(f'Session {task.request.session_id} task {id(task)} cancelled!')
-        elif task.error is not None:
-            print(f'Session {task.request.session_id} task {id(task)} failed!')
-        else:
-            print(f'Session {task.request.session_id} task {id(task)} completed by {runtime.thread_data.device_name}.')
+        # The images are encoded and sent by the post-processing pool, the tasks complete from there.
+        for batch_task, future in zip(tasks, futures):
+            future.add_done_callback(functools.partial(on_task_post_processed, batch_task, runtime.thread_data.device_name))
         current_state = ServerStates.Online
 
+def thread_filter(task: RenderTask):
+    # Hands the images of a filter task to the filter worker of the device, the loaded Stable Diffusion model is left as is.
+    from . import runtime
+    job = runtime.RenderJob(task.request, task.buffer_queue, task.temp_images, get_filter_stop_check(task),
+        task_output_images=task.output_images, output_url=f'/image/output/{task.request.session_id}/{task.task_id}')
+    try:
+        future = runtime.filter_images(job)
+    except Exception as e:
+        release_filter_slot()
+        task.error = e
+        complete_task(task, runtime.thread_data.device_name)
+        print(traceback.format_exc())
+        return
+    future.add_done_callback(lambda _: release_filter_slot())
+    future.add_done_callback(functools.partial(on_task_post_processed, task, runtime.thread_data.device_name))
+
+def release_filter_slot():
+    # Releases the slot of a filter task taken by thread_get_next_task, then wakes a thread for the next queued filter task.
+    from . import runtime
+    runtime.filter_task_slots.release()
+    if not manager_lock.acquire(blocking=True, timeout=LOCK_TIMEOUT):
+        print('Failed to acquire manager lock to start the next filter task.')
+        return
+    try:
+        next_task = next((queued_task for queued_task in tasks_queue if is_filter_task(queued_task)), None)
+    finally:
+        manager_lock.release()
+    if next_task is not None:
+        wake_render_thread(next_task)
+
+def on_task_post_processed(task: RenderTask, device_name, future: Future):
+    if future.exception() is not None:
+        task.error = future.exception()
+    else:
+        task.response = future.result()
+    complete_task(task, device_name)
+
+def complete_task(task: RenderTask, device_name):
+    task.lock.release()
+    task.buffer_queue.close()
+    task_cache.keep(task.request.session_id, TASK_TTL)
+    if isinstance(task.error, StopAsyncIteration):
+        print(f'Session {task.request.session_id} task {task.task_id} cancelled!')
+    elif task.error is not None:
+        print(f'Session {task.request.session_id} task {task.task_id} failed!')
+    else:
+        print(f'Session {task.request.session_id} task {task.task_id} completed by {device_name}.')
+
+def get_step_callback(task: RenderTask, batch: list):
+    from . import runtime
+    def step_callback():
+        global current_state_error
+
+        if isinstance(current_state_error, SystemExit) or isinstance(current_state_error, StopAsyncIteration) or isinstance(task.error, StopAsyncIteration):
+            runtime.thread_data.stop_processing = True
+            if isinstance(current_state_error, StopAsyncIteration):
+                # Stop without a session stops the whole batch.
+                for batch_task in batch:
+                    batch_task.error = current_state_error
+                current_state_error = None
+                print(f'Session {task.request.session_id} sent cancel signal for task {task.task_id}')
+
+            task_cache.keep(task.request.session_id, TASK_TTL)
+    return step_callback
+
+def get_filter_stop_check(task: RenderTask):
+    # Filter tasks run outside the render loop, they check this between images instead of using a step callback.
+    def is_stopped():
+        return isinstance(task.error, StopAsyncIteration) or isinstance(current_state_error, SystemExit)
+    return is_stopped
+
 def get_cached_task(session_id:str, update_ttl:bool=False):
     # By calling keep before tryGet, wont discard if was expired.
     if update_ttl and not task_cache.keep(session_id, TASK_TTL):
@@ -327,69 +777,51 @@ def get_cached_task(session_id:str, update_ttl:bool=False):
     return task_cache.tryGet(session_id)
 
 def get_devices():
+    # Served from the device inventory snapshot, does not take manager_lock.
     devices = {
-        'all': {},
+        'all': device_manager.get_device_info(),
         'active': {},
     }
 
-    def get_device_info(device):
-        if device == 'cpu':
-            return {'name': device_manager.get_processor_name()}
-            
-        mem_free, mem_total = torch.cuda.mem_get_info(device)
-        mem_free /= float(10**9)
-        mem_total /= float(10**9)
-
-        return {
-            'name': torch.cuda.get_device_name(device),
-            'mem_free': mem_free,
-            'mem_total': mem_total,
-        }
-
-    # list the compatible devices
-    gpu_count = torch.cuda.device_count()
-    for device in range(gpu_count):
-        device = f'cuda:{device}'
-        if not device_manager.is_device_compatible(device):
+    # list the activated devices
+    for rthread in tuple(render_threads): # Copy, the list is only changed while holding manager_lock.
+        if not rthread.is_alive():
             continue
+        weak_data = weak_thread_data.get(rthread)
+        if not weak_data or not 'device' in weak_data or not 'device_name' in weak_data:
+            continue
+        device = weak_data['device']
+        if device in devices['all']:
+            devices['active'][device] = devices['all'][device]
+        else:
+            devices['active'][device] = {'name': weak_data['device_name']}
 
-        devices['all'].update({device: get_device_info(device)})
-
-    devices['all'].update({'cpu': get_device_info('cpu')})
+    return devices
 
-    # list the activated devices
-    if not manager_lock.acquire(blocking=True, timeout=LOCK_TIMEOUT): raise Exception('get_devices' + ERR_LOCK_FAILED)
-    try:
-        for rthread in render_threads:
-            if not rthread.is_alive():
-                continue
+def is_alive(device=None):
+    nbr_alive = 0
+    for rthread in tuple(render_threads): # Copy, lock free for the ping endpoint.
+        if device is not None:
             weak_data = weak_thread_data.get(rthread)
-            if not weak_data or not 'device' in weak_data or not 'device_name' in weak_data:
+            if weak_data is None or not 'device' in weak_data or weak_data['device'] is None:
                 continue
-            device = weak_data['device']
-            devices['active'].update({device: get_device_info(device)})
-    finally:
-        manager_lock.release()
-
-    return devices
+            thread_device = weak_data['device']
+            if thread_device != device:
+                continue
+        if rthread.is_alive():
+            nbr_alive += 1
+    return nbr_alive
 
-def is_alive(device=None):
-    if not manager_lock.acquire(blocking=True, timeout=LOCK_TIMEOUT): raise Exception('is_alive' + ERR_LOCK_FAILED)
+def get_render_device_count():
+    # Alive render threads that can run Stable Diffusion tasks, the filter_devices are not counted.
     nbr_alive = 0
-    try:
-        for rthread in render_threads:
-            if device is not None:
-                weak_data = weak_thread_data.get(rthread)
-                if weak_data is None or not 'device' in weak_data or weak_data['device'] is None:
-                    continue
-                thread_device = weak_data['device']
-                if thread_device != device:
-                    continue
-            if rthread.is_alive():
-                nbr_alive += 1
-        return nbr_alive
-    finally:
-        manager_lock.release()
+    for rthread in tuple(render_threads):
+        weak_data = weak_thread_data.get(rthread)
+        if weak_data is not None and weak_data.get('device') in filter_devices:
+            continue
+        if rthread.is_alive():
+            nbr_alive += 1
+    return nbr_alive
 
 def start_render_thread(device):
     if not manager_lock.acquire(blocking=True, timeout=LOCK_TIMEOUT): raise Exception('start_render_thread' + ERR_LOCK_FAILED)
@@ -432,6 +864,8 @@ def stop_render_thread(device):
             thread_device = weak_data['device']
             if thread_device == device:
                 weak_data['alive'] = False
+                if 'wake_event' in weak_data:
+                    weak_data['wake_event'].set()
                 thread_to_remove = rthread
                 break
         if thread_to_remove is not None:
@@ -466,19 +900,87 @@ def update_render_threads(render_devices, active_devices):
 
     print('active devices', get_devices()['active'])
 
+def wake_render_thread(task:RenderTask):
+    '''
+    Wake the idle render thread that should pick up the task, instead of waking every waiting thread.
+    Only a hint, thread_get_next_task still decides which thread gets the task.
+    Busy threads are never woken, they check the queue again as soon as their current task ends.
+    '''
+    if not manager_lock.acquire(blocking=True, timeout=LOCK_TIMEOUT): raise Exception('wake_render_thread' + ERR_LOCK_FAILED)
+    try:
+        candidates = []
+        for rthread in render_threads:
+            if not rthread.is_alive():
+                continue
+            weak_data = weak_thread_data.get(rthread)
+            if not weak_data or not 'wake_event' in weak_data:
+                continue
+            candidates.append(weak_data)
+        if is_filter_task(task):
+            candidates.sort(key=lambda weak_data: weak_data['device'] not in filter_devices) # Devices reserved for filters first.
+        else:
+            candidates = [weak_data for weak_data in candidates if weak_data['device'] not in filter_devices or weak_data['device'] == task.render_device]
+            model_key = get_model_key(task)
+            candidates.sort(key=lambda weak_data: weak_data.get('model_key') != model_key) # Devices with the model loaded first.
+        if task.render_device:
+            targets = [weak_data for weak_data in candidates if weak_data['device'] == task.render_device]
+            if len(targets) <= 0: # Requested device is not active, any thread can return the error.
+                targets = candidates
+        else: # Use the CPU only as a last resort.
+            targets = [weak_data for weak_data in candidates if weak_data['device'] != 'cpu'] or candidates
+        batch_key = get_batch_key(task)
+        for weak_data in targets:
+            if batch_key is not None and weak_data.get('batch_key') == batch_key:
+                weak_data['wake_event'].set() # Collecting a batch this task can join.
+                return True
+        for weak_data in targets:
+            if weak_data['idle']:
+                weak_data['wake_event'].set()
+                return True
+        return False
+    finally:
+        manager_lock.release()
+
+def wake_all_render_threads():
+    if not manager_lock.acquire(blocking=True, timeout=LOCK_TIMEOUT): raise Exception('wake_all_render_threads' + ERR_LOCK_FAILED)
+    try:
+        for rthread in render_threads:
+            weak_data = weak_thread_data.get(rthread)
+            if weak_data and 'wake_event' in weak_data:
+                weak_data['wake_event'].set()
+    finally:
+        manager_lock.release()
+
 def shutdown_event(): # Signal render thread to close on shutdown
     global current_state_error
     current_state_error = SystemExit('Application shutting down.')
+    wake_all_render_threads()
 
-def render(req : ImageRequest):
+def check_session_can_queue(session_id:str):
     if is_alive() <= 0: # Render thread is dead
         raise ChildProcessError('Rendering thread has died.')
     # Alive, check if task in cache
-    task = task_cache.tryGet(req.session_id)
+    task = task_cache.tryGet(session_id)
     if task and not task.response and not task.error and not task.lock.locked():
         # Unstarted task pending, deny queueing more than one.
-        raise ConnectionRefusedError(f'Session {req.session_id} has an already pending task.')
-    #
+        raise ConnectionRefusedError(f'Session {session_id} has an already pending task.')
+
+def enqueue_task(new_task:RenderTask):
+    if task_cache.put(new_task.request.session_id, new_task, TASK_TTL):
+        # Use twice the normal timeout for adding user requests.
+        # Tries to force task_cache.put to fail before tasks_queue.put would. 
+        if manager_lock.acquire(blocking=True, timeout=LOCK_TIMEOUT * 2):
+            try:
+                new_task.enqueue_time = time.time()
+                tasks_queue.append(new_task)
+                wake_render_thread(new_task)
+                return new_task
+            finally:
+                manager_lock.release()
+    raise RuntimeError('Failed to add task to cache.')
+
+def render(req : ImageRequest):
+    check_session_can_queue(req.session_id)
     from . import runtime
     r = Request()
     r.session_id = req.session_id
@@ -504,22 +1006,40 @@ def render(req : ImageRequest):
     r.use_vae_model = req.use_vae_model
     r.show_only_filtered_image = req.show_only_filtered_image
     r.output_format = req.output_format
+    r.inline_output_images = req.inline_output_images
 
     r.stream_progress_updates = True # the underlying implementation only supports streaming
     r.stream_image_progress = req.stream_image_progress
+    r.image_progress_interval = max(1, req.image_progress_interval)
+    r.image_progress_mode = req.image_progress_mode
+    r.image_progress_scale = min(max(req.image_progress_scale, 0.125), 1)
 
     if not req.stream_progress_updates:
         r.stream_image_progress = False
 
-    new_task = RenderTask(r)
+    return enqueue_task(RenderTask(r))
 
-    if task_cache.put(r.session_id, new_task, TASK_TTL):
-        # Use twice the normal timeout for adding user requests.
-        # Tries to force task_cache.put to fail before tasks_queue.put would. 
-        if manager_lock.acquire(blocking=True, timeout=LOCK_TIMEOUT * 2):
-            try:
-                tasks_queue.append(new_task)
-                return new_task
-            finally:
-                manager_lock.release()
-    raise RuntimeError('Failed to add task to cache.')
+def filter_images(req : FilterRequest):
+    # Queue a filter-only task, it is rendered by the same threads without loading a Stable Diffusion model.
+    filters = [req.model] if isinstance(req.model, str) else list(req.model or [])
+    if len(filters) <= 0: raise ValueError('No filter model requested.')
+    for model_name in filters:
+        if filter_service.get_filter_name(model_name) is None: raise ValueError(f'Unknown filter model {model_name}')
+    init_images = ([req.init_image] if req.init_image else []) + list(req.init_images or [])
+    if len(init_images) <= 0: raise ValueError('No image to filter.')
+    check_session_can_queue(req.session_id)
+
+    r = FilterTaskRequest()
+    r.session_id = req.session_id
+    r.name = req.name
+    r.init_images = init_images
+    r.filters = filters
+    r.use_full_precision = req.use_full_precision
+    r.save_to_disk_path = req.save_to_disk_path
+    r.output_format = req.output_format
+    r.inline_output_images = req.inline_output_images
+    r.stream_progress_updates = req.stream_progress_updates
+
+    new_task = RenderTask(r)
+    new_task.render_device = req.render_device
+    return enqueue_task(new_task)
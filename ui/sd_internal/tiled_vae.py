@@ -0,0 +1,77 @@
+"""tiled_vae.py: first stage (VAE) encode and decode in overlapping tiles.
+Notes:
+    The memory of the VAE grows with the image area, large images are processed one tile at a time
+    so the peak memory only depends on the tile size.
+    Tiles overlap and are blended with linear ramps, the GroupNorm statistics differ a little
+    between tiles and the blending hides the seams.
+    Encoding samples each tile of the latent distribution like get_first_stage_encoding does for the whole image,
+    encode_moments_tiled blends the mean and std of the tiles instead, to be sampled later.
+"""
+import torch
+
+TILE_THRESHOLD = 768 * 768 # pixels - Images larger than this are tiled.
+DECODE_TILE_SIZE = 64 # latent pixels - 512 image pixels.
+DECODE_TILE_OVERLAP = 8 # latent pixels
+ENCODE_TILE_SIZE = 512 # image pixels
+ENCODE_TILE_OVERLAP = 64 # image pixels
+SCALE = 8 # Image pixels per latent pixel.
+LATENT_CHANNELS = 4
+
+def should_tile(width, height, threshold=TILE_THRESHOLD) -> bool:
+    return threshold is not None and width * height > threshold
+
+def get_tile_starts(size, tile_size, overlap):
+    if size <= tile_size:
+        return [0]
+    starts = list(range(0, size - tile_size, tile_size - overlap))
+    starts.append(size - tile_size)
+    return starts
+
+def get_blend_ramp(size, overlap, device):
+    # Weights going up over the overlap at both ends, never 0 so the image edges keep their single tile.
+    ramp = torch.ones(size, device=device)
+    if overlap > 0:
+        steps = torch.arange(1, overlap + 1, device=device, dtype=torch.float32) / (overlap + 1)
+        n = min(overlap, size)
+        ramp[:n] = steps[:n]
+        ramp[size - n:] = torch.minimum(ramp[size - n:], steps[:n].flip(0))
+    return ramp
+
+def run_tiled(x, fn, tile_size, overlap, out_channels, scale=1, reduce=1):
+    # Applies fn to the tiles of x (b, c, h, w) and blends the outputs, of shape (b, out_channels, h * scale // reduce, w * scale // reduce).
+    # tile_size, overlap and the image size must be multiples of reduce.
+    b, _, h, w = x.shape
+    tile_h, tile_w = min(tile_size, h), min(tile_size, w)
+    out_tile_h, out_tile_w = tile_h * scale // reduce, tile_w * scale // reduce
+    out_overlap = overlap * scale // reduce
+    out = weights = tile_weight = None
+    for top in get_tile_starts(h, tile_size, overlap):
+        for left in get_tile_starts(w, tile_size, overlap):
+            tile_out = fn(x[:, :, top:top + tile_h, left:left + tile_w])
+            if out is None:
+                out = torch.zeros((b, out_channels, h * scale // reduce, w * scale // reduce), device=tile_out.device, dtype=torch.float32)
+                weights = torch.zeros(out.shape[2:], device=tile_out.device, dtype=torch.float32)
+                tile_weight = get_blend_ramp(out_tile_h, out_overlap, tile_out.device)[:, None] * get_blend_ramp(out_tile_w, out_overlap, tile_out.device)[None, :]
+            out_top, out_left = top * scale // reduce, left * scale // reduce
+            out[:, :, out_top:out_top + out_tile_h, out_left:out_left + out_tile_w] += tile_out.float() * tile_weight
+            weights[out_top:out_top + out_tile_h, out_left:out_left + out_tile_w] += tile_weight
+            del tile_out
+    out /= weights
+    return out.to(x.dtype)
+
+def decode_tiled(model, z, tile_size=DECODE_TILE_SIZE, overlap=DECODE_TILE_OVERLAP):
+    # Same as model.decode_first_stage(z), z is (b, 4, h / 8, w / 8).
+    return run_tiled(z, model.decode_first_stage, tile_size, overlap, 3, scale=SCALE)
+
+def encode_tiled(model, x, tile_size=ENCODE_TILE_SIZE, overlap=ENCODE_TILE_OVERLAP):
+    # Same as model.get_first_stage_encoding(model.encode_first_stage(x)), x is (b, 3, h, w).
+    def encode(tile):
+        return model.get_first_stage_encoding(model.encode_first_stage(tile))
+    return run_tiled(x, encode, tile_size, overlap, LATENT_CHANNELS, reduce=SCALE)
+
+def encode_moments_tiled(model, x, tile_size=ENCODE_TILE_SIZE, overlap=ENCODE_TILE_OVERLAP):
+    # The mean and std of model.encode_first_stage(x) concatenated, (b, 8, h / 8, w / 8).
+    def encode(tile):
+        posterior = model.encode_first_stage(tile)
+        return torch.cat([posterior.mean, posterior.std], dim=1)
+    return run_tiled(x, encode, tile_size, overlap, 2 * LATENT_CHANNELS, reduce=SCALE)
@@ -0,0 +1,76 @@
+"""tiled_vae_benchmark.py: peak memory and time of the tiled and untiled first stage on CPU.
+Notes:
+    Run from the stable-diffusion folder, with the server PYTHONPATH and the ui folder:
+        PYTHONPATH="$PYTHONPATH:$SD_UI_PATH" python -m sd_internal.tiled_vae_benchmark --sizes 512 1024 1536
+    The VAE has random weights, only memory and time are measured.
+    Each measurement runs in its own process, the peak is the growth of the max RSS during the call.
+    Uses the resource module, not available on Windows.
+"""
+import argparse
+import multiprocessing
+import resource
+import sys
+import time
+
+CONFIG_YAML = "configs/stable-diffusion/v1-inference.yaml"
+
+class FirstStage():
+    # The first stage methods of LatentDiffusion, around a bare AutoencoderKL.
+    def __init__(self, config_yaml=CONFIG_YAML):
+        from omegaconf import OmegaConf
+        from ldm.util import instantiate_from_config
+        config = OmegaConf.load(config_yaml)
+        self.scale_factor = config.model.params.scale_factor
+        self.first_stage_model = instantiate_from_config(config.model.params.first_stage_config).eval()
+    def encode_first_stage(self, x):
+        return self.first_stage_model.encode(x)
+    def get_first_stage_encoding(self, posterior):
+        return self.scale_factor * posterior.sample()
+    def decode_first_stage(self, z):
+        return self.first_stage_model.decode(z / self.scale_factor)
+
+def get_max_rss() -> int:
+    # bytes, ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def measure(mode, size, tiled, results):
+    import torch
+    from sd_internal import tiled_vae
+    torch.manual_seed(0)
+    model = FirstStage()
+    with torch.no_grad():
+        if mode == 'decode':
+            x = torch.randn((1, tiled_vae.LATENT_CHANNELS, size // tiled_vae.SCALE, size // tiled_vae.SCALE))
+            fn = tiled_vae.decode_tiled if tiled else lambda model, x: model.decode_first_stage(x)
+        else:
+            x = torch.rand((1, 3, size, size)) * 2 - 1
+            fn = tiled_vae.encode_tiled if tiled else lambda model, x: model.get_first_stage_encoding(model.encode_first_stage(x))
+        start_rss = get_max_rss()
+        start_time = time.perf_counter()
+        fn(model, x)
+        results.put({'time': time.perf_counter() - start_time, 'peak': get_max_rss() - start_rss})
+
+def run(mode, size, tiled):
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=measure, args=(mode, size, tiled, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the tiled and untiled VAE on CPU.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 1536], help='image sizes, multiples of 64')
+    parser.add_argument('--modes', nargs='+', default=['decode', 'encode'], choices=['decode', 'encode'])
+    args = parser.parse_args()
+
+    print(f"{'mode':<8}{'size':>6}{'untiled s':>12}{'untiled MiB':>13}{'tiled s':>10}{'tiled MiB':>11}")
+    for mode in args.modes:
+        for size in args.sizes:
+            untiled, tiled = run(mode, size, False), run(mode, size, True)
+            print(f"{mode:<8}{size:>6}{untiled['time']:>12.2f}{untiled['peak'] / 1024**2:>13.0f}{tiled['time']:>10.2f}{tiled['peak'] / 1024**2:>11.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""weight_cache.py: checkpoints converted to split, memory mapped safetensors files.
+Notes:
+    The first load of a checkpoint unpickles it once, then writes the UNet, CondStage and FirstStage
+    weights to separate files with the keys already renamed for the optimizedSD models.
+    EMA weights are dropped and float weights can be stored as fp16.
+    Later loads, from any render thread, memory map these files instead of unpickling the checkpoint.
+    Converted files are keyed by the sha256 of the source checkpoint,
+    the path, size and mtime to hash lookups are persisted to avoid hashing on every load.
+    Hashing and converting only lock the checkpoint and the entry concerned, loads of other checkpoints go on.
+    Entries of removed or changed checkpoints are deleted, then the least recently used ones above max_bytes.
+    An entry is pinned while it is converted or its files are opened, cleanup never deletes pinned entries.
+"""
+import json
+import os
+import shutil
+import threading
+import traceback
+
+import torch
+
+from sd_internal.model_scanner import get_file_hash
+
+try:
+    from safetensors.torch import load_file, save_file
+except ImportError:
+    load_file = save_file = None
+
+FORMAT_VERSION = 1 # Increase when the conversion changes, old entries will be converted again.
+WEIGHT_CACHE_MAX_BYTES = 10 * 1024**3 # Converted files kept on disk.
+PARTS = ('unet', 'cs', 'fs')
+PART_PREFIXES = {'cs': 'cond_stage_model.', 'fs': 'first_stage_model.'}
+EMA_PREFIX = 'model_ema.'
+
+def is_available():
+    return save_file is not None
+
+def split_state_dict(sd, half=False):
+    # Returns {part: state_dict}, the UNet keys renamed to model1./model2. like load_model_ckpt_sd1 did.
+    parts = {part: {} for part in PARTS}
+    shared = {} # Top level buffers, copied to every part.
+    for key, value in sd.items():
+        if not isinstance(value, torch.Tensor) or key.startswith(EMA_PREFIX):
+            continue
+        if half and value.is_floating_point():
+            value = value.half()
+        sp = key.split(".")
+        if sp[0] == "model":
+            if "input_blocks" in sp or "middle_block" in sp or "time_embed" in sp:
+                parts['unet']["model1." + key[6:]] = value
+            else:
+                parts['unet']["model2." + key[6:]] = value
+        elif key.startswith(PART_PREFIXES['cs']):
+            parts['cs'][key] = value
+        elif key.startswith(PART_PREFIXES['fs']):
+            parts['fs'][key] = value
+        else:
+            shared[key] = value
+    for part_sd in parts.values():
+        part_sd.update(shared)
+    return parts
+
+def get_saveable(sd):
+    # safetensors refuses tensors sharing storage or not contiguous, copy those.
+    storages = set()
+    saveable = {}
+    for key, value in sd.items():
+        storage_ptr = value.storage().data_ptr()
+        if storage_ptr in storages or not value.is_contiguous():
+            value = value.contiguous().clone()
+        else:
+            storages.add(storage_ptr)
+        saveable[key] = value
+    return saveable
+
+def get_dir_size(dir_path: str) -> int:
+    size = 0
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.is_file():
+                size += entry.stat().st_size
+    return size
+
+class WeightCache():
+    def __init__(self, cache_dir: str, max_bytes: int = WEIGHT_CACHE_MAX_BYTES):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._index_path = os.path.join(cache_dir, 'index.json')
+        self._index = dict() # ckpt path: {'size', 'mtime', 'hash'}
+        self._lock: threading.Lock = threading.Lock() # Held while reading or changing the index, never while hashing or converting.
+        self._path_locks = dict() # ckpt path or entry dir: Lock held while hashing the checkpoint or converting the entry.
+        self._pins = dict() # entry dir: Number of loads converting or opening the entry.
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path, 'r', encoding='utf-8') as f:
+                    self._index = json.load(f)
+            except:
+                print('Could not read weight cache index from', self._index_path)
+                print(traceback.format_exc())
+        for name in os.listdir(cache_dir):
+            if name.endswith('.tmp'): # Left by an interrupted conversion.
+                shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        self.cleanup()
+    def _get_path_lock(self, path: str) -> threading.Lock:
+        with self._lock:
+            return self._path_locks.setdefault(path, threading.Lock())
+    def _save_index(self) -> None: # Call with self._lock held.
+        try:
+            tmp_path = self._index_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._index, f)
+            os.replace(tmp_path, self._index_path)
+        except:
+            print(traceback.format_exc())
+    def _get_hash(self, ckpt_path: str) -> str: # Call with the path lock of ckpt_path held.
+        stat = os.stat(ckpt_path)
+        with self._lock:
+            entry = self._index.get(ckpt_path)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                return entry['hash']
+        file_hash = get_file_hash(ckpt_path)
+        with self._lock:
+            self._index[ckpt_path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': file_hash}
+            self._save_index()
+        return file_hash
+    def _pin(self, entry_dir: str) -> None:
+        with self._lock:
+            self._pins[entry_dir] = self._pins.get(entry_dir, 0) + 1
+    def _unpin(self, entry_dir: str) -> None:
+        with self._lock:
+            self._pins[entry_dir] -= 1
+            if self._pins[entry_dir] <= 0:
+                del self._pins[entry_dir]
+    def load(self, ckpt_path: str, half: bool = False) -> dict:
+        # Returns {part: state_dict} memory mapped from the converted files, converts the checkpoint on the first call.
+        ckpt_path = os.path.abspath(ckpt_path)
+        with self._get_path_lock(ckpt_path):
+            file_hash = self._get_hash(ckpt_path)
+        entry_dir = os.path.join(self._cache_dir, f"{file_hash}-v{FORMAT_VERSION}{'-fp16' if half else ''}")
+        self._pin(entry_dir)
+        try:
+            converted = False
+            with self._get_path_lock(entry_dir): # Copies of a checkpoint share the entry.
+                if os.path.exists(entry_dir):
+                    os.utime(entry_dir) # Most recently used, see cleanup.
+                else:
+                    self._convert(ckpt_path, entry_dir, half)
+                    converted = True
+            print(f"Loading model from {entry_dir}")
+            # Memory mapped, pages are shared between threads loading the same file.
+            parts = {part: load_file(os.path.join(entry_dir, f'{part}.safetensors'), device='cpu') for part in PARTS}
+        finally:
+            self._unpin(entry_dir)
+        if converted:
+            self.cleanup(keep=entry_dir)
+        return parts
+    def cleanup(self, keep: str = None) -> None:
+        '''
+        Deletes the entries of checkpoints removed or changed since their conversion,
+        then the least recently used entries until the cache fits in max_bytes. keep: Entry dir never deleted.
+        Entries being converted or loaded are skipped.
+        '''
+        with self._lock:
+            index_size = len(self._index)
+            for ckpt_path, entry in list(self._index.items()):
+                try:
+                    stat = os.stat(ckpt_path)
+                    if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                        continue
+                except OSError:
+                    pass
+                del self._index[ckpt_path]
+            if len(self._index) != index_size:
+                self._save_index()
+            valid_hashes = set(entry['hash'] for entry in self._index.values())
+        entries = [] # (last use, size, entry dir)
+        for name in os.listdir(self._cache_dir):
+            entry_dir = os.path.join(self._cache_dir, name)
+            if not os.path.isdir(entry_dir) or name.endswith('.tmp') or entry_dir == keep:
+                continue
+            file_hash, _, version = name.partition('-v')
+            if file_hash not in valid_hashes or version.split('-')[0] != str(FORMAT_VERSION):
+                self._delete_entry(entry_dir)
+                continue
+            entries.append((os.stat(entry_dir).st_mtime, get_dir_size(entry_dir), entry_dir))
+        total_size = sum(size for _, size, _ in entries) + (get_dir_size(keep) if keep is not None and os.path.isdir(keep) else 0)
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self._max_bytes:
+                break
+            if self._delete_entry(entry_dir):
+                total_size -= size
+    def _delete_entry(self, entry_dir: str) -> bool:
+        path_lock = self._get_path_lock(entry_dir)
+        if not path_lock.acquire(blocking=False): # Being converted.
+            return False
+        try:
+            with self._lock:
+                if entry_dir in self._pins: # Being loaded.
+                    return False
+            print('Removing converted weights', entry_dir)
+            shutil.rmtree(entry_dir)
+            return True
+        except OSError as e: # Memory mapped on Windows.
+            print('Could not remove', entry_dir, str(e))
+            return False
+        finally:
+            path_lock.release()
+    def _convert(self, ckpt_path: str, entry_dir: str, half: bool) -> None: # Call with the path lock of entry_dir held.
+        print(f"Converting {ckpt_path} to {entry_dir}")
+        pl_sd = torch.load(ckpt_path, map_location="cpu")
+        sd = pl_sd["state_dict"] if "state_dict" in pl_sd else pl_sd
+        parts = split_state_dict(sd, half=half)
+        del pl_sd, sd
+        tmp_dir = entry_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        try:
+            for part, part_sd in parts.items():
+                save_file(get_saveable(part_sd), os.path.join(tmp_dir, f'{part}.safetensors'), metadata={'source': os.path.basename(ckpt_path)})
+            os.replace(tmp_dir, entry_dir) # Only complete entries are visible.
+        except:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
@@ -0,0 +1,83 @@
+"""weight_registry.py: host weights shared by the render threads using the same models.
+Notes:
+    One set of template models is kept on the CPU per key (checkpoint, VAE, precision),
+    with a count of the render threads using it.
+    Threads get copies of the templates that point to the template tensors instead of copying them.
+    Moving a copy to a device builds the device tensors from the shared ones,
+    moving it back to the CPU points it at the shared tensors again instead of copying the device tensors.
+    Templates no longer used by any thread are handed to the model cache, when there is one.
+"""
+import copy
+import functools
+import threading
+from typing import Callable, Hashable
+
+import torch
+
+def to_shared_host(module, template, *args, **kwargs):
+    # Replaces module.to, moving to the CPU reuses the template tensors.
+    device, dtype, _, _ = torch._C._nn._parse_to(*args, **kwargs)
+    if device is None or device.type != 'cpu' or dtype is not None:
+        return torch.nn.Module.to(module, *args, **kwargs)
+    for submodule, template_submodule in zip(module.modules(), template.modules()):
+        for name, template_param in template_submodule._parameters.items():
+            if template_param is not None:
+                submodule._parameters[name].data = template_param.data
+        for name, template_buffer in template_submodule._buffers.items():
+            submodule._buffers[name] = template_buffer
+    return module
+
+def make_shared_copy(template):
+    if template is None:
+        return None
+    memo = {}
+    for param in template.parameters():
+        # New Parameter objects, moving a copy to a device replaces param.data and must not change the template.
+        memo[id(param)] = torch.nn.Parameter(param.data, requires_grad=param.requires_grad)
+    for buffer in template.buffers():
+        memo[id(buffer)] = buffer
+    module = copy.deepcopy(template, memo)
+    for submodule, template_submodule in zip(module.modules(), template.modules()):
+        # Called on submodules too, optimizedSD moves model1 and model2 separately.
+        submodule.to = functools.partial(to_shared_host, submodule, template_submodule)
+    return module
+
+class WeightRegistry():
+    def __init__(self, model_cache=None):
+        self._model_cache = model_cache
+        self._lock: threading.Lock = threading.Lock()
+        self._entries = dict() # key: {'templates': {name: module}, 'refs': number of threads using them}
+        self._key_locks = dict() # key: Lock held while loading the templates.
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+    def acquire(self, key: Hashable, load_templates: Callable[[], dict]) -> dict:
+        # Returns {name: shared copy}, load_templates is only called when no thread or cache has the models.
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock: # Threads asking for the same models wait for the first one to load them.
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is None:
+                templates = self._model_cache.get(key) if self._model_cache is not None else None
+                if templates is None:
+                    templates = load_templates()
+                else:
+                    print('loaded model from the model cache', self._model_cache.get_stats())
+                entry = {'templates': templates, 'refs': 0}
+            with self._lock:
+                entry['refs'] += 1
+                self._entries[key] = entry
+        return {name: make_shared_copy(template) for name, template in entry['templates'].items()}
+    def release(self, key: Hashable) -> None:
+        with self._lock:
+            entry = self._entries[key]
+            entry['refs'] -= 1
+            if entry['refs'] > 0:
+                return
+            del self._entries[key]
+        if self._model_cache is not None:
+            self._model_cache.put(key, entry['templates'])
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'refs': sum(entry['refs'] for entry in self._entries.values())}
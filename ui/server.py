@@ -5,11 +5,12 @@ Notes:
 import json
 import traceback
 
+import base64
+import re
+
 import sys
 import os
 import socket
-import picklescan.scanner
-import rich
 
 SD_DIR = os.getcwd()
 print('started in ', SD_DIR)
@@ -28,7 +29,9 @@ STABLE_DIFFUSION_MODEL_EXTENSIONS = ['.ckpt']
 VAE_MODEL_EXTENSIONS = ['.vae.pt', '.ckpt']
 
 OUTPUT_DIRNAME = "Stable Diffusion UI" # in the user's home folder
+OUTPUT_IMAGE_URL_REGEX = re.compile(r'/image/output/([^/]+)/(\d+)/(\d+)$')
 TASK_TTL = 15 * 60 # Discard last session's task timeout
+WS_STATE_CHECK_INTERVAL = 1 # seconds - Maximum delay to push server state changes on session websockets.
 APP_CONFIG_DEFAULTS = {
     # auto: selects the cuda device with the most free memory, cuda: use the currently active cuda device.
     'render_devices': 'auto', # valid entries: 'auto', 'cpu' or 'cuda:N' (where N is a GPU index)
@@ -43,22 +46,34 @@ APP_CONFIG_DEFAULT_MODELS = [
     'sd-v1-4', # Default fallback.
 ]
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
-from starlette.responses import FileResponse, JSONResponse, StreamingResponse
-from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, JSONResponse, Response as RawResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
+import asyncio
 import logging
 #import queue, threading, time
 from typing import Any, Generator, Hashable, List, Optional, Union
 
-from sd_internal import Request, Response, task_manager
+from sd_internal import Request, Response, config_store, filter_service, runtime, task_manager
+from sd_internal.file_catalog import FileCatalog
+from sd_internal.model_cache import ModelCache, get_default_max_bytes as get_default_model_cache_size
+from sd_internal.model_scanner import ModelScanner, STATUS_CLEAN, STATUS_INFECTED
+from sd_internal.post_processing import PostProcessingPool, POST_PROCESSING_MAX_PENDING, POST_PROCESSING_WORKERS
+from sd_internal.weight_cache import WeightCache, WEIGHT_CACHE_MAX_BYTES
+from sd_internal.weight_registry import WeightRegistry
 
 app = FastAPI()
 
 modifiers_cache = None
+model_scanner = ModelScanner(os.path.join(CONFIG_DIR, 'model_scan_results.json'))
 outpath = os.path.join(os.path.expanduser("~"), OUTPUT_DIRNAME)
 
 os.makedirs(USER_UI_PLUGINS_DIR, exist_ok=True)
+os.makedirs(os.path.join(MODELS_DIR, 'stable-diffusion'), exist_ok=True)
+os.makedirs(os.path.join(MODELS_DIR, 'vae'), exist_ok=True)
+file_catalog = FileCatalog([os.path.join(MODELS_DIR, 'stable-diffusion'), os.path.join(MODELS_DIR, 'vae'), SD_DIR, CORE_UI_PLUGINS_DIR, USER_UI_PLUGINS_DIR])
 
 # don't show access log entries for URLs that start with the given prefix
 ACCESS_LOG_SUPPRESS_PATH_PREFIXES = ['/ping', '/image', '/modifier-thumbnails']
@@ -79,70 +94,10 @@ for plugins_dir, dir_prefix in UI_PLUGINS_SOURCES:
     app.mount(f'/plugins/{dir_prefix}', NoCacheStaticFiles(directory=plugins_dir), name=f"plugins-{dir_prefix}")
 
 def getConfig(default_val=APP_CONFIG_DEFAULTS):
-    try:
-        config_json_path = os.path.join(CONFIG_DIR, 'config.json')
-        if not os.path.exists(config_json_path):
-            return default_val
-        with open(config_json_path, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-            if 'net' not in config:
-                config['net'] = {}
-            if os.getenv('SD_UI_BIND_PORT') is not None:
-                config['net']['listen_port'] = int(os.getenv('SD_UI_BIND_PORT'))
-            if os.getenv('SD_UI_BIND_IP') is not None:
-                config['net']['listen_to_network'] = ( os.getenv('SD_UI_BIND_IP') == '0.0.0.0' )
-            return config
-    except Exception as e:
-        print(str(e))
-        print(traceback.format_exc())
-        return default_val
+    return config_store.get_config(default_val)
 
 def setConfig(config):
-    print( json.dumps(config) )
-    try: # config.json
-        config_json_path = os.path.join(CONFIG_DIR, 'config.json')
-        with open(config_json_path, 'w', encoding='utf-8') as f:
-            json.dump(config, f)
-    except:
-        print(traceback.format_exc())
-
-    try: # config.bat
-        config_bat_path = os.path.join(CONFIG_DIR, 'config.bat')
-        config_bat = []
-
-        if 'update_branch' in config:
-            config_bat.append(f"@set update_branch={config['update_branch']}")
-
-        config_bat.append(f"@set SD_UI_BIND_PORT={config['net']['listen_port']}")
-        bind_ip = '0.0.0.0' if config['net']['listen_to_network'] else '127.0.0.1'
-        config_bat.append(f"@set SD_UI_BIND_IP={bind_ip}")
-
-        config_bat.append(f"@set test_sd2={'Y' if config.get('test_sd2', False) else 'N'}")
-
-        if len(config_bat) > 0:
-            with open(config_bat_path, 'w', encoding='utf-8') as f:
-                f.write('\r\n'.join(config_bat))
-    except:
-        print(traceback.format_exc())
-
-    try: # config.sh
-        config_sh_path = os.path.join(CONFIG_DIR, 'config.sh')
-        config_sh = ['#!/bin/bash']
-
-        if 'update_branch' in config:
-            config_sh.append(f"export update_branch={config['update_branch']}")
-
-        config_sh.append(f"export SD_UI_BIND_PORT={config['net']['listen_port']}")
-        bind_ip = '0.0.0.0' if config['net']['listen_to_network'] else '127.0.0.1'
-        config_sh.append(f"export SD_UI_BIND_IP={bind_ip}")
-
-        config_sh.append(f"export test_sd2=\"{'Y' if config.get('test_sd2', False) else 'N'}\"")
-
-        if len(config_sh) > 1:
-            with open(config_sh_path, 'w', encoding='utf-8') as f:
-                f.write('\n'.join(config_sh))
-    except:
-        print(traceback.format_exc())
+    config_store.set_config(config)
 
 def resolve_model_to_use(model_name:str, model_type:str, model_dir:str, model_extensions:list, default_models=[]):
     config = getConfig()
@@ -161,9 +116,9 @@ def resolve_model_to_use(model_name:str, model_type:str, model_dir:str, model_ex
         # Check models directory
         models_dir_path = os.path.join(MODELS_DIR, model_dir, model_name)
         for model_extension in model_extensions:
-            if os.path.exists(models_dir_path + model_extension):
+            if file_catalog.exists(models_dir_path + model_extension):
                 return models_dir_path
-            if os.path.exists(model_name + model_extension):
+            if file_catalog.exists(model_name + model_extension):
                 # Direct Path to file
                 model_name = os.path.abspath(model_name)
                 return model_name
@@ -171,14 +126,14 @@ def resolve_model_to_use(model_name:str, model_type:str, model_dir:str, model_ex
     if model_name in default_models:
         default_model_path = os.path.join(SD_DIR, model_name)
         for model_extension in model_extensions:
-            if os.path.exists(default_model_path + model_extension):
+            if file_catalog.exists(default_model_path + model_extension):
                 return default_model_path
     # Can't find requested model, check the default paths.
     for default_model in default_models:
         for model_dir in model_dirs:
             default_model_path = os.path.join(model_dir, default_model)
             for model_extension in model_extensions:
-                if os.path.exists(default_model_path + model_extension):
+                if file_catalog.exists(default_model_path + model_extension):
                     if model_name is not None:
                         print(f'Could not find the configured custom model {model_name}{model_extension}. Using the default one: {default_model_path}{model_extension}')
                     return default_model_path
@@ -234,20 +189,6 @@ async def setAppConfig(req : SetAppConfigRequest):
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
-def is_malicious_model(file_path):
-    try:
-        scan_result = picklescan.scanner.scan_file_path(file_path)
-        if scan_result.issues_count > 0 or scan_result.infected_files > 0:
-            rich.print(":warning: [bold red]Scan %s: %d scanned, %d issue, %d infected.[/bold red]" % (file_path, scan_result.scanned_files, scan_result.issues_count, scan_result.infected_files))
-            return True
-        else:
-            rich.print("Scan %s: [green]%d scanned, %d issue, %d infected.[/green]" % (file_path, scan_result.scanned_files, scan_result.issues_count, scan_result.infected_files))
-            return False
-    except Exception as e:
-        print('error while scanning', file_path, 'error:', e)
-    return False
-
-known_models = {}
 def getModels():
     models = {
         'active': {
@@ -258,28 +199,28 @@ def getModels():
             'stable-diffusion': ['sd-v1-4'],
             'vae': [],
         },
+        'scan-status': {
+            'stable-diffusion': {},
+            'vae': {},
+        },
     }
 
     def listModels(models_dirname, model_type, model_extensions):
         models_dir = os.path.join(MODELS_DIR, models_dirname)
-        if not os.path.exists(models_dir):
-            os.makedirs(models_dir)
 
-        for file in os.listdir(models_dir):
+        for file in file_catalog.list_files(models_dir):
             for model_extension in model_extensions:
                 if not file.endswith(model_extension):
                     continue
 
                 model_path = os.path.join(models_dir, file)
-                mtime = os.path.getmtime(model_path)
-                mod_time = known_models[model_path] if model_path in known_models else -1
-                if mod_time != mtime:
-                    if is_malicious_model(model_path):
-                        models['scan-error'] = file
-                        return
-                known_models[model_path] = mtime
-
                 model_name = file[:-len(model_extension)]
+                scan_status = model_scanner.get_status(model_path, file_catalog.get_stat(model_path))
+                models['scan-status'][model_type][model_name] = scan_status
+                if scan_status == STATUS_INFECTED:
+                    models['scan-error'] = file
+                    continue
+
                 models['options'][model_type].append(model_name)
 
         models['options'][model_type] = [*set(models['options'][model_type])] # remove duplicates
@@ -291,16 +232,32 @@ def getModels():
 
     # legacy
     custom_weight_path = os.path.join(SD_DIR, 'custom-model.ckpt')
-    if os.path.exists(custom_weight_path):
+    if file_catalog.exists(custom_weight_path):
         models['options']['stable-diffusion'].append('custom-model')
 
     return models
 
+def check_model_is_safe(model_path:str, model_extensions:list):
+    # Scans still pending in the background are waited for before a model can be loaded, only clean files are loaded.
+    if model_path is None:
+        return
+    for model_extension in model_extensions:
+        if file_catalog.exists(model_path + model_extension):
+            try:
+                scan_status = model_scanner.wait_for_scan(model_path + model_extension)
+            except Exception as e:
+                raise PermissionError(f'The file {model_path}{model_extension} could not be scanned: {e}')
+            if scan_status == STATUS_INFECTED:
+                raise PermissionError(f'The file {model_path}{model_extension} is probably malware infected, please delete it.')
+            if scan_status != STATUS_CLEAN:
+                raise PermissionError(f'The file {model_path}{model_extension} could not be scanned for malware ({scan_status}), it will not be loaded.')
+            return
+
 def getUIPlugins():
     plugins = []
 
     for plugins_dir, dir_prefix in UI_PLUGINS_SOURCES:
-        for file in os.listdir(plugins_dir):
+        for file in file_catalog.list_files(plugins_dir):
             if file.endswith('.plugin.js'):
                 plugins.append(f'/plugins/{dir_prefix}/{file}')
 
@@ -311,8 +268,15 @@ def getIPConfig():
     ips[2].append(ips[0])
     return ips[2]
 
+def get_catalog_response(content, etag:str, if_none_match:str=None):
+    # The catalog only changes with the files, clients can revalidate with the ETag.
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if if_none_match == etag:
+        return RawResponse(status_code=304, headers=headers) # HTTP304 Not Modified
+    return JSONResponse(content, headers=headers)
+
 @app.get('/get/{key:path}')
-def read_web_data(key:str=None):
+def read_web_data(key:str=None, if_none_match:str=Header(default=None)):
     if not key: # /get without parameters, stable-diffusion easter egg.
         raise HTTPException(status_code=418, detail="StableDiffusion is drawing a teapot!") # HTTP418 I'm a teapot
     elif key == 'app_config':
@@ -327,15 +291,40 @@ def read_web_data(key:str=None):
             'hosts': getIPConfig(),
         }
         system_info['devices']['config'] = config.get('render_devices', "auto")
+        system_info['models'] = task_manager.get_model_stats()
+        if runtime.model_cache is not None:
+            system_info['model_cache'] = runtime.model_cache.get_stats()
+        if runtime.weight_registry is not None:
+            system_info['weight_registry'] = runtime.weight_registry.get_stats()
+        system_info['post_processing'] = runtime.post_processing_pool.get_stats()
+        system_info['filters'] = filter_service.get_stats()
         return JSONResponse(system_info, headers=NOCACHE_HEADERS)
     elif key == 'models':
-        return JSONResponse(getModels(), headers=NOCACHE_HEADERS)
+        etag = f'"{file_catalog.generation}-{model_scanner.generation}"'
+        if if_none_match == etag:
+            return get_catalog_response(None, etag, if_none_match)
+        models = getModels()
+        models['generation'] = file_catalog.generation
+        return get_catalog_response(models, etag)
     elif key == 'modifiers': return FileResponse(os.path.join(SD_UI_DIR, 'modifiers.json'), headers=NOCACHE_HEADERS)
     elif key == 'output_dir': return JSONResponse({ 'output_dir': outpath }, headers=NOCACHE_HEADERS)
-    elif key == 'ui_plugins': return JSONResponse(getUIPlugins(), headers=NOCACHE_HEADERS)
+    elif key == 'ui_plugins': return get_catalog_response(getUIPlugins(), f'"{file_catalog.generation}"', if_none_match)
     else:
         raise HTTPException(status_code=404, detail=f'Request for unknown {key}') # HTTP404 Not Found
 
+def get_session_state(task):
+    if task.lock.locked():
+        return 'running'
+    elif isinstance(task.error, StopAsyncIteration):
+        return 'stopped'
+    elif task.error:
+        return 'error'
+    elif not task.buffer_queue.empty():
+        return 'buffer'
+    elif task.response:
+        return 'completed'
+    return 'pending'
+
 @app.get('/ping') # Get server and optionally session status.
 def ping(session_id:str=None):
     if task_manager.is_alive() <= 0: # Check that render threads are alive.
@@ -347,19 +336,8 @@ def ping(session_id:str=None):
     if session_id:
         task = task_manager.get_cached_task(session_id, update_ttl=True)
         if task:
-            response['task'] = id(task)
-            if task.lock.locked():
-                response['session'] = 'running'
-            elif isinstance(task.error, StopAsyncIteration):
-                response['session'] = 'stopped'
-            elif task.error:
-                response['session'] = 'error'
-            elif not task.buffer_queue.empty():
-                response['session'] = 'buffer'
-            elif task.response:
-                response['session'] = 'completed'
-            else:
-                response['session'] = 'pending'
+            response['task'] = task.task_id
+            response['session'] = get_session_state(task)
     response['devices'] = task_manager.get_devices()
     return JSONResponse(response, headers=NOCACHE_HEADERS)
 
@@ -385,20 +363,61 @@ def update_render_devices_in_config(config, render_devices):
 
     config['render_devices'] = render_devices
 
-@app.post('/render')
-def render(req : task_manager.ImageRequest):
+def get_output_image_data(img_str:str):
+    # The UI reuses displayed images as init images, turn output urls back into base64 data.
+    if not img_str:
+        return img_str
+    match = OUTPUT_IMAGE_URL_REGEX.search(img_str)
+    if not match or img_str.startswith('data:'):
+        return img_str
+    session_id, task_id, img_id = match.group(1), int(match.group(2)), int(match.group(3))
+    task = task_manager.get_cached_task(session_id, update_ttl=False)
+    if not task or task.task_id != task_id or img_id >= len(task.output_images):
+        raise HTTPException(status_code=410, detail=f'Image {img_str} is no longer available.') # HTTP410 Gone
+    img_buffer, mime_type = task.output_images[img_id]
+    return f'data:{mime_type};base64,' + base64.b64encode(img_buffer.getvalue()).decode()
+
+def queue_render_task(req : task_manager.ImageRequest):
+    req.init_image = get_output_image_data(req.init_image)
+    req.mask = get_output_image_data(req.mask)
     try:
         save_model_to_config(req.use_stable_diffusion_model, req.use_vae_model)
         req.use_stable_diffusion_model = resolve_ckpt_to_use(req.use_stable_diffusion_model)
         req.use_vae_model = resolve_vae_to_use(req.use_vae_model)
+        check_model_is_safe(req.use_stable_diffusion_model, STABLE_DIFFUSION_MODEL_EXTENSIONS)
+        check_model_is_safe(req.use_vae_model, VAE_MODEL_EXTENSIONS)
         new_task = task_manager.render(req)
-        response = {
+        return {
             'status': str(task_manager.current_state), 
             'queue': len(task_manager.tasks_queue),
-            'stream': f'/image/stream/{req.session_id}/{id(new_task)}',
-            'task': id(new_task)
+            'stream': f'/image/stream/{req.session_id}/{new_task.task_id}',
+            'task': new_task.task_id
+        }
+    except ChildProcessError as e: # Render thread is dead
+        raise HTTPException(status_code=500, detail=f'Rendering thread has died.') # HTTP500 Internal Server Error
+    except ConnectionRefusedError as e: # Unstarted task pending, deny queueing more than one.
+        raise HTTPException(status_code=503, detail=f'Session {req.session_id} has an already pending task.') # HTTP503 Service Unavailable
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post('/render')
+def render(req : task_manager.ImageRequest):
+    return JSONResponse(queue_render_task(req), headers=NOCACHE_HEADERS)
+
+def queue_filter_task(req : task_manager.FilterRequest):
+    req.init_image = get_output_image_data(req.init_image)
+    if req.init_images:
+        req.init_images = [get_output_image_data(img_str) for img_str in req.init_images]
+    try:
+        new_task = task_manager.filter_images(req)
+        return {
+            'status': str(task_manager.current_state),
+            'queue': len(task_manager.tasks_queue),
+            'stream': f'/image/stream/{req.session_id}/{new_task.task_id}',
+            'task': new_task.task_id
         }
-        return JSONResponse(response, headers=NOCACHE_HEADERS)
+    except ValueError as e: # Unknown filter or no image.
+        raise HTTPException(status_code=400, detail=str(e)) # HTTP400 Bad Request
     except ChildProcessError as e: # Render thread is dead
         raise HTTPException(status_code=500, detail=f'Rendering thread has died.') # HTTP500 Internal Server Error
     except ConnectionRefusedError as e: # Unstarted task pending, deny queueing more than one.
@@ -406,18 +425,29 @@ def render(req : task_manager.ImageRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post('/filter') # Upscale or face correct existing images, streamed like /render tasks.
+def filter_images(req : task_manager.FilterRequest):
+    return JSONResponse(queue_filter_task(req), headers=NOCACHE_HEADERS)
+
 @app.get('/image/stream/{session_id:str}/{task_id:int}')
-def stream(session_id:str, task_id:int):
+def stream(session_id:str, task_id:int, accept:str=Header(default='')):
     #TODO Move to WebSockets ??
     task = task_manager.get_cached_task(session_id, update_ttl=True)
     if not task: raise HTTPException(status_code=410, detail='No request received.') # HTTP410 Gone
-    if (id(task) != task_id): raise HTTPException(status_code=409, detail=f'Wrong task id received. Expected:{id(task)}, Received:{task_id}') # HTTP409 Conflict
+    if (task.task_id != task_id): raise HTTPException(status_code=409, detail=f'Wrong task id received. Expected:{task.task_id}, Received:{task_id}') # HTTP409 Conflict
+    is_sse = 'text/event-stream' in accept
     if task.buffer_queue.empty() and not task.lock.locked():
         if task.response:
             #print(f'Session {session_id} sending cached response')
+            if is_sse:
+                return StreamingResponse(iter([f'data: {json.dumps(task.response)}\n\n']), media_type='text/event-stream', headers=NOCACHE_HEADERS)
             return JSONResponse(task.response, headers=NOCACHE_HEADERS)
-        raise HTTPException(status_code=425, detail='Too Early, task not started yet.') # HTTP425 Too Early
+        if task.error is not None and task.buffer_queue.closed:
+            raise HTTPException(status_code=425, detail='Too Early, task data is not available.') # HTTP425 Too Early
+        # Still queued, the stream waits on the buffer queue until the task starts and completes.
     #print(f'Session {session_id} opened live render stream {id(task.buffer_queue)}')
+    if is_sse:
+        return StreamingResponse(task.read_buffer_generator(sse=True), media_type='text/event-stream', headers=NOCACHE_HEADERS)
     return StreamingResponse(task.read_buffer_generator(), media_type='application/json')
 
 @app.get('/image/stop')
@@ -433,6 +463,18 @@ def stop(session_id:str=None):
     task.error = StopAsyncIteration('')
     return {'OK'}
 
+@app.get('/image/output/{session_id:str}/{task_id:int}/{img_id:int}')
+def get_output_image(session_id:str, task_id:int, img_id:int, if_none_match:str=Header(default=None)):
+    task = task_manager.get_cached_task(session_id, update_ttl=True)
+    if not task or task.task_id != task_id: raise HTTPException(status_code=410, detail=f'Session {session_id} task {task_id} is no longer available.') # HTTP410 Gone
+    if img_id >= len(task.output_images): raise HTTPException(status_code=404, detail=f'Task {task_id} has no image {img_id}.') # HTTP404 Not Found
+    img_buffer, mime_type = task.output_images[img_id]
+    # Output images never change, the url is enough to identify the content.
+    headers = {'ETag': f'"{task_id}-{img_id}"', 'Cache-Control': f'private, max-age={TASK_TTL}'}
+    if if_none_match == headers['ETag']:
+        return RawResponse(status_code=304, headers=headers) # HTTP304 Not Modified
+    return RawResponse(content=img_buffer.getvalue(), media_type=mime_type, headers=headers)
+
 @app.get('/image/tmp/{session_id}/{img_id:int}')
 def get_image(session_id, img_id):
     task = task_manager.get_cached_task(session_id, update_ttl=True)
@@ -445,13 +487,110 @@ def get_image(session_id, img_id):
     except KeyError as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.websocket('/ws/{session_id:str}')
+async def session_socket(websocket:WebSocket, session_id:str):
+    '''
+    One channel per session, replaces polling /ping, /image/stream and /image/tmp.
+    Server to client text frames (JSON):
+        {"type": "state", "status": ..., "task": ..., "session": ...} when the server or session state changes.
+        {"type": "progress", "task": ..., "data": {...}} for each task stream message, the final one contains a "status".
+        {"type": "render", ...}, {"type": "filter", ...} and {"type": "stop", ...} in reply to commands, or {"type": "error", "status_code": ..., "detail": ...}
+    Server to client binary frames: 4 bytes big-endian temp image index, followed by the JPEG preview.
+    Client to server text frames (JSON): {"type": "render", "request": {...}}, {"type": "filter", "request": {...}} or {"type": "stop"}
+    Reads the same task stream as /image/stream, use only one of them per session.
+    '''
+    await websocket.accept()
+    wake_event = asyncio.Event()
+    waiter = (asyncio.get_running_loop(), wake_event)
+
+    async def receive_commands():
+        while True:
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                raise WebSocketDisconnect(message.get('code', 1000))
+            try:
+                if message.get('text') is None:
+                    raise HTTPException(status_code=400, detail='Commands must be sent as JSON text frames.') # HTTP400 Bad Request
+                msg = json.loads(message['text'])
+                if not isinstance(msg, dict):
+                    raise HTTPException(status_code=400, detail='Commands must be JSON objects.') # HTTP400 Bad Request
+                if msg.get('type') == 'render':
+                    req = task_manager.ImageRequest(**msg.get('request', {}))
+                    req.session_id = session_id
+                    await websocket.send_json({'type': 'render', **await run_in_threadpool(queue_render_task, req)})
+                elif msg.get('type') == 'filter':
+                    req = task_manager.FilterRequest(**msg.get('request', {}))
+                    req.session_id = session_id
+                    await websocket.send_json({'type': 'filter', **await run_in_threadpool(queue_filter_task, req)})
+                elif msg.get('type') == 'stop':
+                    stop(session_id=session_id)
+                    await websocket.send_json({'type': 'stop', 'status': 'OK'})
+                else:
+                    raise HTTPException(status_code=400, detail=f'Unknown command {msg.get("type")}') # HTTP400 Bad Request
+                wake_event.set()
+            except HTTPException as e:
+                await websocket.send_json({'type': 'error', 'status_code': e.status_code, 'detail': e.detail})
+            except ValidationError as e:
+                await websocket.send_json({'type': 'error', 'status_code': 422, 'detail': e.errors()}) # HTTP422 Unprocessable Entity
+            except ValueError as e: # Bad frame, the socket stays open for the next commands.
+                await websocket.send_json({'type': 'error', 'status_code': 400, 'detail': f'Invalid JSON: {e}'}) # HTTP400 Bad Request
+
+    async def send_updates():
+        task = None
+        last_state = None
+        try:
+            while True:
+                wake_event.clear() # Clear before reading, updates received while reading will set the event again.
+                cached_task = task_manager.get_cached_task(session_id, update_ttl=True)
+                if cached_task is not task:
+                    if task: task.buffer_queue.remove_waiter(waiter)
+                    task = cached_task
+                    if task: task.buffer_queue.add_waiter(waiter)
+                state = {'type': 'state', 'status': str(task_manager.current_state)}
+                if task_manager.current_state_error and not isinstance(task_manager.current_state_error, StopAsyncIteration):
+                    state['detail'] = str(task_manager.current_state_error)
+                if task:
+                    state['task'] = task.task_id
+                    state['session'] = get_session_state(task)
+                if state != last_state:
+                    await websocket.send_json(state)
+                    last_state = state
+                while task and not task.buffer_queue.empty():
+                    data = json.loads(task.buffer_queue.get(block=False))
+                    task.buffer_queue.task_done()
+                    await websocket.send_json({'type': 'progress', 'task': task.task_id, 'data': data})
+                    if 'step' not in data:
+                        continue
+                    for img_id in range(len(data.get('output', []))):
+                        img_data = task.temp_images[img_id]
+                        if img_data:
+                            await websocket.send_bytes(img_id.to_bytes(4, 'big') + img_data.getvalue())
+                try:
+                    await asyncio.wait_for(wake_event.wait(), timeout=WS_STATE_CHECK_INTERVAL)
+                except asyncio.TimeoutError: pass
+        finally:
+            if task: task.buffer_queue.remove_waiter(waiter)
+
+    tasks = [asyncio.create_task(receive_commands()), asyncio.create_task(send_updates())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for done_task in done:
+            if isinstance(done_task.exception(), WebSocketDisconnect):
+                continue
+            if done_task.exception():
+                print('Session', session_id, 'websocket error:', done_task.exception())
+    finally:
+        for pending_task in tasks:
+            pending_task.cancel()
+
 @app.get('/')
 def read_root():
     return FileResponse(os.path.join(SD_UI_DIR, 'index.html'), headers=NOCACHE_HEADERS)
 
 @app.on_event("shutdown")
 def shutdown_event(): # Signal render thread to close on shutdown
-    task_manager.current_state_error = SystemExit('Application shutting down.')
+    task_manager.shutdown_event()
+    config_store.config_store.flush()
 
 # don't log certain requests
 class LogSuppressFilter(logging.Filter):
@@ -469,6 +608,36 @@ getModels()
 # Start the task_manager
 task_manager.default_model_to_load = resolve_ckpt_to_use()
 task_manager.default_vae_to_load = resolve_vae_to_use()
+try:
+    check_model_is_safe(task_manager.default_model_to_load, STABLE_DIFFUSION_MODEL_EXTENSIONS)
+    check_model_is_safe(task_manager.default_vae_to_load, VAE_MODEL_EXTENSIONS)
+except PermissionError as e:
+    print(str(e))
+    task_manager.default_model_to_load = None
+    task_manager.default_vae_to_load = None
+
+weight_cache_config = getConfig().get('weight_cache', {})
+if isinstance(weight_cache_config, bool): # Older configs only turn it on or off.
+    weight_cache_config = {} if weight_cache_config else {'max_bytes': 0}
+if weight_cache_config.get('max_bytes', WEIGHT_CACHE_MAX_BYTES) > 0:
+    runtime.weight_cache = WeightCache(os.path.join(MODELS_DIR, 'converted'), int(weight_cache_config.get('max_bytes', WEIGHT_CACHE_MAX_BYTES)))
+model_cache_config = getConfig().get('model_cache', {})
+model_cache_max_bytes = int(model_cache_config.get('max_bytes', get_default_model_cache_size()))
+if model_cache_max_bytes > 0:
+    print('Keeping up to', round(model_cache_max_bytes / 1024**3, 2), 'GiB of unloaded models in RAM')
+    runtime.model_cache = ModelCache(model_cache_max_bytes)
+runtime.weight_registry = WeightRegistry(runtime.model_cache)
+runtime.vram_budget = getConfig().get('vram_budget', None) # bytes
+runtime.vae_tile_threshold = getConfig().get('vae_tile_threshold', runtime.vae_tile_threshold) # pixels
+runtime.vae_decode_batch_size = int(getConfig().get('vae_decode_batch_size', runtime.vae_decode_batch_size))
+post_processing_config = getConfig().get('post_processing', {})
+if post_processing_config:
+    runtime.post_processing_pool = PostProcessingPool(int(post_processing_config.get('workers', POST_PROCESSING_WORKERS)), int(post_processing_config.get('max_pending', POST_PROCESSING_MAX_PENDING)))
+
+render_batch = getConfig().get('render_batch', {})
+task_manager.max_batch_size = int(render_batch.get('max_size', 1))
+task_manager.max_batch_wait = float(render_batch.get('max_wait', 0))
+task_manager.filter_devices = set(getConfig().get('filter_devices', [])) # Devices from render_devices that only run /filter tasks.
 
 def update_render_threads():
     config = getConfig()